@@ -0,0 +1,4 @@
+"""
+Benchmark suites, run as modules from the repository root (e.g. `python -m benchmarks.watchers --help`). Each run writes
+its results as JSON to benchmarks/results/ so that runs can be compared
+"""
@@ -0,0 +1,295 @@
+"""
+Checkout load test - runs `make_application()` in a separate process, with ElectrumX, kraken and fixer.io replaced by
+local stand-ins, and drives the customer flow through it at a fixed concurrency:
+
+    GET /api/invoice -> PUT /api/invoice -> /api/payment websocket -> mempool payment -> confirmation
+
+    python -m benchmarks.checkout --customers 500 --concurrency 50 --coins BTC,LTC
+
+Reports the throughput and latency of each endpoint, the time from a payment (or the confirming block) to the
+websocket update, and the checkouts completed per second
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from pathlib import Path
+
+# The app secret is read at import time, and would otherwise be generated into data/.env
+os.environ.setdefault("APP_SECRET", "tuxpay-benchmarks")
+
+import aiohttp  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+from benchmarks.harness import bootstrap, setup_wallets, summarize, peak_rss_mb, write_results  # noqa: E402
+
+ROOT = Path(__file__).parent.parent
+# Quoted prices of the rate stub, in USD (kraken) and per EUR (fixer.io)
+COIN_PRICE = 100.0
+FOREX_RATES = {"AUD": 1.6, "CAD": 1.5, "USD": 1.2, "GBP": 0.9, "JPY": 130.0, "EUR": 1.0, "RUB": 90.0}
+
+
+async def start_rate_stub() -> web.AppRunner:
+    """
+    Serves the kraken ticker and the fixer.io latest rates endpoints on a local port
+    """
+    async def kraken_ticker(request):
+        pairs = request.query.get("pair", "").split(",")
+        return web.json_response({"error": [], "result": {
+            x: {"a": [str(COIN_PRICE * 1.001), "1", "1"], "b": [str(COIN_PRICE * 0.999), "1", "1"]} for x in pairs}})
+
+    async def fixer_latest(request):
+        return web.json_response({"success": True, "base": "EUR", "rates": FOREX_RATES})
+
+    app = web.Application()
+    app.router.add_get("/0/public/Ticker", kraken_ticker)
+    app.router.add_get("/api/latest", fixer_latest)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    return runner
+
+
+def runner_url(runner: web.AppRunner) -> str:
+    return "http://127.0.0.1:{}".format(runner.addresses[0][1])
+
+
+def serve(args):
+    """
+    Server process: the application, configured against the stand-ins started by the load generator
+    """
+    import uvicorn
+
+    standins = dict(x.split(":") for x in args.standins.split(","))
+    overrides = {"CURRENCY.fixerio_api_key": "benchmarks", "CURRENCY.kraken_api_url": args.rates,
+                 "CURRENCY.fixerio_api_url": args.rates, "CURRENCY.enabled_currencies": ",".join(FOREX_RATES)}
+    for symbol, port in standins.items():
+        overrides.update({f"COIN_{symbol}.electrumx_servers": f"127.0.0.1 t{port}",
+                          f"COIN_{symbol}.electrumx_no_public_fallback": "TRUE",
+                          f"COIN_{symbol}.electrumx_disable_standby": "TRUE",
+                          f"COIN_{symbol}.required_confirmations": args.confirmations})
+    bootstrap(standins, database_uri=args.database, overrides=overrides)
+    setup_wallets(standins)
+
+    from modules.application import make_application
+    from modules.exchanges import exchangeRates
+    from modules.models import database
+
+    # Keep the stub rates out of the rate cache of the installation
+    cache = Path(tempfile.mkdtemp(prefix="tuxpay-bench-"))
+    exchangeRates.coins_file, exchangeRates.fixer_rates = cache / "coins.json", cache / "currencies.json"
+    exchangeRates._pairs, exchangeRates._currencies = {}, {}
+    # The admin frontend is served from its build output, which isn't needed here
+    (ROOT / "admin" / "dist").mkdir(parents=True, exist_ok=True)
+
+    app = make_application()
+    app.add_event_handler("startup", database.connect)
+    app.add_event_handler("shutdown", database.disconnect)
+    uvicorn.run(app, host="127.0.0.1", port=args.serve, log_level="warning", access_log=False)
+
+
+def free_port() -> int:
+    import socket
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def create_invoices(count: int, currency: str) -> list:
+    """
+    Inserts `count` open invoices, returns their customer tokens
+    """
+    from modules.authentication import to_short_jwt
+    from modules.models import database, Invoice
+
+    now = datetime.datetime.utcnow()
+    await database.execute_many(Invoice.insert(), [
+        {"id": i + 1, "uuid": str(uuid.uuid4()), "amount_cents": 1000 + i, "currency": currency,
+         "creation_date": now, "expiry_date": now + datetime.timedelta(hours=1), "status": "pending"}
+        for i in range(count)])
+    return [to_short_jwt({"id": i + 1}) for i in range(count)]
+
+
+async def wait_for_server(url: str, process: subprocess.Popen, timeout: float = 60):
+    expires = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < expires:
+            if process.poll() is not None:
+                raise RuntimeError(f"application exited with {process.returncode}")
+            try:
+                async with session.get(f"{url}/api/invoice"):
+                    return
+            except aiohttp.ClientConnectionError:
+                await asyncio.sleep(0.2)
+    raise TimeoutError("application did not start")
+
+
+class Checkout:
+    """
+    Runs the customer flows and collects their timings
+    """
+
+    def __init__(self, args, url: str, servers: dict):
+        self.args = args
+        self.url = url
+        self.servers = servers
+        self.latency = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.blocks = []
+        self.completed = 0
+
+    async def timed(self, name: str, request):
+        started = time.monotonic()
+        async with request as response:
+            body = await response.json()
+            if response.status != 200:
+                raise RuntimeError(f"{name} returned {response.status}: {body}")
+        self.latency[name].append(time.monotonic() - started)
+        return body
+
+    async def customer(self, session: aiohttp.ClientSession, token: str, symbol: str):
+        started = time.monotonic()
+        await self.timed("GET /api/invoice", session.get(f"{self.url}/api/invoice", params={"token": token}))
+        body = await self.timed("PUT /api/invoice", session.put(f"{self.url}/api/invoice",
+                                                                json={"token": token, "payment_coin": symbol}))
+        payment = body['payment']
+
+        connecting = time.monotonic()
+        async with session.ws_connect(f"{self.url.replace('http', 'ws', 1)}/api/payment") as ws:
+            self.latency["WS /api/payment"].append(time.monotonic() - connecting)
+            await ws.send_str(json.dumps({"uuid": payment['uuid']}))
+            if self.args.think_time:
+                await asyncio.sleep(self.args.think_time)
+
+            paid_at = time.monotonic()
+            await self.servers[symbol].pay(payment['scripthash'], payment['amount_sats'], address=payment['address'])
+            updates = {}
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    break
+                updates.setdefault(json.loads(msg.data).get("status"), time.monotonic())
+                if "confirmed" in updates:
+                    break
+
+        if "paid" in updates:
+            self.latency["payment to websocket"].append(updates["paid"] - paid_at)
+        if "confirmed" not in updates:
+            raise RuntimeError(f"payment ended as {list(updates) or 'unknown'}")
+        confirming = [x for x in self.blocks if x > paid_at][self.args.confirmations - 1:]
+        if confirming:
+            self.latency["block to websocket"].append(updates["confirmed"] - confirming[0])
+        self.latency["checkout"].append(time.monotonic() - started)
+        self.completed += 1
+
+    async def miner(self):
+        while True:
+            await asyncio.sleep(self.args.block_interval)
+            self.blocks.append(time.monotonic())
+            for server in self.servers.values():
+                await server.mine()
+
+    async def run(self, tokens: list) -> dict:
+        coins = list(self.servers)
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.args.concurrency * 2)
+        timeout = aiohttp.ClientTimeout(total=self.args.timeout)
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            async def worker(i, token):
+                async with semaphore:
+                    try:
+                        await asyncio.wait_for(self.customer(session, token, coins[i % len(coins)]),
+                                               self.args.timeout)
+                    except Exception as e:
+                        self.errors[type(e).__name__] += 1
+
+            miner = asyncio.create_task(self.miner())
+            started = time.monotonic()
+            await asyncio.gather(*(worker(i, token) for i, token in enumerate(tokens)))
+            duration = time.monotonic() - started
+            miner.cancel()
+
+        return {
+            "duration_sec": round(duration, 3),
+            "checkouts": self.completed,
+            "checkouts_per_sec": round(self.completed / duration, 2),
+            "errors": dict(self.errors),
+            "endpoints": {name: {"per_sec": round(len(values) / duration, 2), **summarize(values)}
+                          for name, values in self.latency.items()},
+        }
+
+
+async def run(args) -> dict:
+    from tests.electrumx_server import StandInServer
+
+    coins = args.coins.split(",")
+    database_uri = bootstrap(coins)
+
+    from modules.coins import ALL_COINS
+    from modules.models import database, create_db
+
+    create_db()
+    await database.connect()
+    tokens = await create_invoices(args.customers, args.currency)
+    await database.disconnect()
+
+    rates = await start_rate_stub()
+    servers = {x: await StandInServer(genesis_hash=ALL_COINS[x].GENESIS).start() for x in coins}
+    port = free_port()
+    process = subprocess.Popen([
+        sys.executable, "-m", "benchmarks.checkout", "--serve", str(port), "--database", database_uri,
+        "--rates", runner_url(rates), "--confirmations", str(args.confirmations),
+        "--standins", ",".join(f"{k}:{v.port}" for k, v in servers.items())], cwd=ROOT)
+    try:
+        url = f"http://127.0.0.1:{port}"
+        await wait_for_server(url, process)
+        results = await Checkout(args, url, servers).run(tokens)
+    finally:
+        process.send_signal(signal.SIGINT)
+        process.wait(timeout=30)
+        for server in servers.values():
+            await server.stop()
+        await rates.cleanup()
+
+    results['generator_peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--customers", type=int, default=200, help="checkouts to run")
+    parser.add_argument("--concurrency", type=int, default=20, help="checkouts running at the same time")
+    parser.add_argument("--coins", default="BTC", help="comma separated coin symbols, customers pay with each in turn")
+    parser.add_argument("--currency", default="USD", help="invoice currency, anything but USD goes through fixer.io")
+    parser.add_argument("--confirmations", type=int, default=2, help="required confirmations")
+    parser.add_argument("--block-interval", type=float, default=2, help="seconds between blocks")
+    parser.add_argument("--think-time", type=float, default=0, help="seconds between opening the websocket and paying")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds a single checkout may take")
+    parser.add_argument("--output", help="results file, defaults to benchmarks/results/checkout-<timestamp>.json")
+    # Internal - runs the application process
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--database", help=argparse.SUPPRESS)
+    parser.add_argument("--rates", help=argparse.SUPPRESS)
+    parser.add_argument("--standins", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args)
+
+    results = asyncio.run(run(args))
+    params = {k: v for k, v in vars(args).items() if k not in ("serve", "database", "rates", "standins")}
+    path = write_results("checkout", params, results, output=args.output)
+    print(json.dumps(results, indent=2))
+    print(f"Results written to {path}")
+
+
+if __name__ == '__main__':
+    main()
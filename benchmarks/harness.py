@@ -0,0 +1,191 @@
+"""
+Shared plumbing of the benchmark suites: an isolated configuration (fresh database, benchmark wallets), local ElectrumX
+stand-ins, measurements and result files.
+
+`bootstrap` has to run before anything imports `modules.models` or `modules.coins`, as both read the configuration at
+import time
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from modules import config
+
+RESULTS_DIR = Path(__file__).parent / "results"
+# Root seed of the benchmark wallets, these never hold funds
+BENCH_SEED = hashlib.sha512(b"tuxpay benchmarks").digest()
+
+
+def bootstrap(coins: Iterable[str] = ("BTC",), database_uri: Optional[str] = None,
+              overrides: Optional[Dict[str, str]] = None) -> str:
+    """
+    Points the configuration at a fresh sqlite database and enables only `coins`. `overrides` are set in the [global]
+    section, or in a coin section when prefixed with it ("COIN_BTC.required_confirmations"). Returns the database uri
+    """
+    coins = list(coins)
+    if database_uri is None:
+        database_uri = f"sqlite:///{tempfile.mkdtemp(prefix='tuxpay-bench-')}/bench.db"
+
+    sections = {"global": {"database_uri": database_uri, "debug": "FALSE", "payment_callback_url": ""},
+                "EMAIL": {"email_notifications": "FALSE"}}
+    for symbol in coins:
+        sections[f"COIN_{symbol}"] = {"enabled": "TRUE", "required_confirmations": "2", "electrumx_servers": ""}
+    for key, value in (overrides or {}).items():
+        section, _, key = key.rpartition(".")
+        sections.setdefault(section or "global", {})[key] = str(value)
+
+    for section in config._config.sections():
+        if section.startswith("COIN_") and section[5:] not in coins:
+            config._config.set(section, "enabled", "FALSE")
+    for section, values in sections.items():
+        if not config._config.has_section(section):
+            config._config.add_section(section)
+        for key, value in values.items():
+            config._config.set(section, key, value)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    return database_uri
+
+
+def setup_wallets(coins: Iterable[str]):
+    """
+    Derives the benchmark wallets of `coins` (as the setup script does) and registers the coins in `ALL_COINS`
+    """
+    from modules.coins import ALL_COINS, BitcoinMainnet, BitcoinCashMainnet, DashMainnet, LitecoinMainnet
+    from modules.electrum_mods.functions import BIP32Node
+
+    node = BIP32Node.from_rootseed(BENCH_SEED, xtype='standard')
+    for network in (BitcoinMainnet, BitcoinCashMainnet, DashMainnet, LitecoinMainnet):
+        if network.symbol not in coins:
+            continue
+        path = network.default_xpub_derivation_path
+        xpub = node.subkey_at_private_derivation(path).to_xpub(net=network)
+        config.xpubs[network.symbol] = {"xpub": xpub, "derivation_path": path}
+        network.xpub_node = BIP32Node.from_xkey(xpub, net=network)
+        network.xpub_derivation = path
+        ALL_COINS[network.symbol] = network
+
+
+async def start_standins(coins: Iterable[str]) -> dict:
+    """
+    Starts an ElectrumX stand-in per coin, and points the coin's client at it. Returns {symbol: StandInServer}
+    """
+    from modules.coins import ALL_COINS
+    from tests.electrumx_server import StandInServer, offline_client
+
+    servers = {}
+    for symbol in coins:
+        network = ALL_COINS[symbol]
+        servers[symbol] = await StandInServer(genesis_hash=network.GENESIS).start()
+        network.electrumX = offline_client(servers[symbol], symbol=symbol, genesis_hash=network.GENESIS,
+                                           required_capabilities=network.electrumX.required_capabilities)
+    return servers
+
+
+def rpc_counts(servers: dict) -> Dict[str, int]:
+    """
+    Requests served so far by the stand-ins, per method
+    """
+    counts = {}
+    for server in servers.values():
+        for method, count in server.requests.items():
+            counts[method] = counts.get(method, 0) + count
+    return counts
+
+
+def rpc_delta(before: Dict[str, int], after: Dict[str, int]) -> Dict[str, int]:
+    return {k: v - before.get(k, 0) for k, v in after.items() if v - before.get(k, 0)}
+
+
+class LoopLag:
+    """
+    Samples the event loop lag, i.e. how late a sleep of `interval` seconds wakes up
+    """
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> 'LoopLag':
+        self._task = asyncio.create_task(self._sample())
+        return self
+
+    async def _sample(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.samples.append(time.monotonic() - started - self.interval)
+
+    def stop(self) -> dict:
+        self._task.cancel()
+        return summarize(self.samples)
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """
+    Nearest rank percentile
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(seconds: List[float]) -> dict:
+    """
+    Distribution of a list of durations, in ms
+    """
+    def ms(x):
+        return None if x is None else round(x * 1000, 3)
+
+    return {
+        "count": len(seconds),
+        "mean_ms": ms(sum(seconds) / len(seconds)) if seconds else None,
+        "p50_ms": ms(percentile(seconds, 50)),
+        "p90_ms": ms(percentile(seconds, 90)),
+        "p99_ms": ms(percentile(seconds, 99)),
+        "max_ms": ms(max(seconds)) if seconds else None,
+    }
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kB on linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(name: str, params: dict, results: dict, output: Optional[str] = None) -> Path:
+    """
+    Writes the results of a run as JSON, to `output` or to benchmarks/results/<name>-<timestamp>.json
+    """
+    path = Path(output) if output else RESULTS_DIR / f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps({
+        "benchmark": name,
+        "timestamp": time.time(),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": params,
+        "results": results,
+    }, indent=2))
+    return path
@@ -0,0 +1,234 @@
+"""
+Transaction library micro-benchmarks - times `modules.electrum_mods.tux_tx` on the sweep hot path and traces its
+allocations, for legacy (DASH p2pkh), segwit (BTC p2wpkh) and BCH forkid (p2pkh) sweeps of increasing size:
+
+    python -m benchmarks.transactions --sizes 100,1000,10000 --sign-sizes 100,1000
+
+Cases:
+  deserialize - parsing a signed sweep from hex, and an unsigned sweep from PSBT bytes
+  serialize   - serializing a signed sweep to hex, computing its txid, and serializing an unsigned sweep as PSBT
+  preimage    - one signing pass of `serialize_preimage` (every input), without the ECDSA signatures
+  sighash     - one signing pass of `signature_hash` (every input) from shared preimage parts, without the ECDSA
+                signatures
+  sign        - `sign` of an unsigned sweep, ECDSA included
+  estimate    - `estimated_size` of an unsigned sweep, as used for its fee
+"""
+import argparse
+import hashlib
+import json
+import logging
+import statistics
+import struct
+import time
+import tracemalloc
+from typing import Callable, Optional
+
+from benchmarks.harness import BENCH_SEED, write_results
+
+CASES = ("deserialize", "serialize", "preimage", "sighash", "sign", "estimate")
+# A DER signature of the usual length (71 bytes), for sweeps that only need to look signed
+DUMMY_SIGNATURE = "3044022011" + "11" * 31 + "022022" + "22" * 31
+
+
+def scenarios():
+    from modules.coins import BitcoinMainnet, BitcoinCashMainnet, DashMainnet
+    return {
+        "legacy": (DashMainnet, "p2pkh"),
+        "segwit": (BitcoinMainnet, "p2wpkh"),
+        "forkid": (BitcoinCashMainnet, "p2pkh"),
+    }
+
+
+class SweepFactory:
+    """
+    Builds sweeps of `n` inputs, each spending its own funding transaction, to a single output
+    """
+
+    def __init__(self, net, txin_type: str, keys: int = 16):
+        from modules.electrum_mods.functions import ecc, hash_160
+
+        self.net = net
+        self.txin_type = txin_type
+        self.keys = []
+        for i in range(keys):
+            secret = hashlib.sha256(BENCH_SEED + i.to_bytes(4, "little")).digest()
+            pubkey = ecc.ECPrivkey(secret).get_public_key_bytes(compressed=True)
+            pkh = hash_160(pubkey).hex()
+            script = f"0014{pkh}" if txin_type == "p2wpkh" else f"76a914{pkh}88ac"
+            self.keys.append((secret, pubkey, bytes.fromhex(script)))
+        self.funding = []
+
+    def funding_tx(self, i: int):
+        """
+        A one input, one output transaction paying the key of input `i`
+        """
+        from modules.electrum_mods.tux_tx import Transaction
+
+        while len(self.funding) <= i:
+            k = len(self.funding)
+            script = self.keys[k % len(self.keys)][2]
+            raw = b"".join([
+                struct.pack("<i", 1), b"\x01", hashlib.sha256(k.to_bytes(4, "little")).digest(), b"\x00" * 4,
+                b"\x00", b"\xff" * 4, b"\x01", struct.pack("<q", 100000 + k), bytes([len(script)]), script,
+                b"\x00" * 4])
+            tx = Transaction(raw)
+            tx.txid()
+            self.funding.append(tx)
+        return self.funding[i]
+
+    def unsigned(self, n: int):
+        from modules.electrum_mods.tux_tx import PartialTransaction, PartialTxInput, PartialTxOutput, TxOutpoint
+
+        inputs = []
+        for i in range(n):
+            funding = self.funding_tx(i)
+            txin = PartialTxInput(prevout=TxOutpoint(txid=bytes.fromhex(funding.txid()), out_idx=0))
+            txin.utxo = funding
+            txin.script_type = self.txin_type
+            txin.pubkeys = [self.keys[i % len(self.keys)][1]]
+            txin.num_sig = 1
+            inputs.append(txin)
+        total = sum(x.value_sats() for x in inputs)
+        outputs = [PartialTxOutput(scriptpubkey=self.keys[0][2], value=total - 1000 * n)]
+        return PartialTransaction.from_io(inputs, outputs, locktime=0, version=self.net.TX_VERSION)
+
+    def signed(self, n: int):
+        """
+        A complete sweep, with dummy signatures
+        """
+        tx = self.unsigned(n)
+        sighash = "%02x" % self.net.SIGHASH_FLAG
+        for i, txin in enumerate(tx.inputs()):
+            tx.add_signature_to_txin(txin_idx=i, signing_pubkey=txin.pubkeys[0].hex(), sig=DUMMY_SIGNATURE + sighash)
+        tx.finalize_psbt()
+        return tx
+
+    def keypairs(self) -> dict:
+        return {pubkey.hex(): (secret, True) for secret, pubkey, _ in self.keys}
+
+
+def measure(func: Callable, repeat: int, setup: Optional[Callable] = None) -> dict:
+    """
+    Times `func(setup())` `repeat` times, then traces the allocations of one more call
+    """
+    times = []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        started = time.perf_counter()
+        func(arg)
+        times.append(time.perf_counter() - started)
+
+    arg = setup() if setup else None
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    func(arg)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "min_ms": round(min(times) * 1000, 3),
+        "median_ms": round(statistics.median(times) * 1000, 3),
+        "peak_alloc_kb": round((peak - baseline) / 1024, 1),
+        "retained_kb": round((current - baseline) / 1024, 1),
+    }
+
+
+def run_case(case: str, factory: SweepFactory, n: int, repeat: int) -> dict:
+    from modules.electrum_mods.tux_tx import Transaction, PartialTransaction, LegacyPreimageParts
+
+    net = factory.net
+    if case == "deserialize":
+        raw = factory.signed(n).serialize()
+        psbt = factory.unsigned(n).serialize_as_bytes(force_psbt=True)
+        return {
+            "network_tx": measure(lambda _: Transaction(raw).deserialize(), repeat),
+            "psbt": measure(lambda _: PartialTransaction.from_raw_psbt(psbt), repeat),
+            "bytes": len(raw) // 2,
+        }
+    if case == "serialize":
+        signed = factory.signed(n)
+        unsigned = factory.unsigned(n)
+
+        def serialize(_):
+            signed.invalidate_ser_cache()
+            signed.serialize()
+
+        def txid(_):
+            signed.invalidate_ser_cache()
+            signed.txid()
+
+        return {
+            "network_tx": measure(serialize, repeat),
+            "txid": measure(txid, repeat),
+            "psbt": measure(lambda _: unsigned.serialize_as_bytes(force_psbt=True), repeat),
+        }
+    if case == "preimage":
+        tx = factory.unsigned(n)
+
+        def preimages(_):
+            shared = tx._calc_bip143_shared_txdigest_fields()
+            for i in range(n):
+                tx.serialize_preimage(i, net, bip143_shared_txdigest_fields=shared)
+
+        return {"signing_pass": measure(preimages, repeat)}
+    if case == "sighash":
+        tx = factory.unsigned(n)
+
+        def sighashes(_):
+            shared = tx._calc_bip143_shared_txdigest_fields()
+            parts = LegacyPreimageParts(tx)
+            for i in range(n):
+                tx.signature_hash(i, net, bip143_shared_txdigest_fields=shared, legacy_preimage_parts=parts)
+
+        return {"signing_pass": measure(sighashes, repeat)}
+    if case == "sign":
+        keypairs = factory.keypairs()
+        return {"sign": measure(lambda tx: tx.sign(keypairs, net), repeat, setup=lambda: factory.unsigned(n))}
+    if case == "estimate":
+        tx = factory.unsigned(n)
+        return {"estimated_size": measure(lambda _: tx.estimated_size(net), repeat),
+                "vbytes": tx.estimated_size(net)}
+    raise ValueError(f"unknown case: {case}")
+
+
+def run(args) -> dict:
+    from modules.electrum_mods.tux_mods import NetworkLock
+
+    # `sign` logs every signature it adds
+    logging.getLogger().setLevel(logging.WARNING)
+    sizes = [int(x) for x in args.sizes.split(",")]
+    sign_sizes = [int(x) for x in args.sign_sizes.split(",")]
+    cases = args.cases.split(",")
+
+    results = {}
+    for name, (net, txin_type) in scenarios().items():
+        if name not in args.scenarios.split(","):
+            continue
+        with NetworkLock(net):
+            factory = SweepFactory(net, txin_type)
+            for case in cases:
+                for n in (sign_sizes if case in ("preimage", "sighash", "sign") else sizes):
+                    result = run_case(case, factory, n, args.repeat)
+                    results.setdefault(name, {}).setdefault(case, {})[n] = result
+                    print(f"{name:>7} {case:>12} {n:>6} inputs: {json.dumps(result)}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="100,1000,10000", help="comma separated input counts")
+    parser.add_argument("--sign-sizes", default="100,1000",
+                        help="comma separated input counts of the preimage, sighash and sign cases "
+                             "(legacy preimages are O(n^2))")
+    parser.add_argument("--scenarios", default="legacy,segwit,forkid", help="comma separated scenarios")
+    parser.add_argument("--cases", default=",".join(CASES), help="comma separated cases")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per measurement")
+    parser.add_argument("--output", help="results file, defaults to benchmarks/results/transactions-<timestamp>.json")
+    args = parser.parse_args()
+
+    results = run(args)
+    path = write_results("transactions", vars(args), results, output=args.output)
+    print(f"Results written to {path}")
+
+
+if __name__ == '__main__':
+    main()
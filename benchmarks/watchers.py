@@ -0,0 +1,227 @@
+"""
+Watcher scale benchmark - watches thousands of pending payments across coins against local ElectrumX stand-ins, and
+drives them through mempool arrivals, blocks and expiries.
+
+    python -m benchmarks.watchers --payments 2000 --coins BTC,LTC
+
+Reports event loop lag, peak RSS, the time to rehydrate the watchers, RPC counts per block, the time from a
+notification to the database commit of the status change, and the websocket fan-out latency of `views.payment`
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import time
+import uuid
+from collections import defaultdict
+
+from benchmarks.harness import bootstrap, setup_wallets, start_standins, rpc_counts, rpc_delta, LoopLag, \
+    summarize, peak_rss_mb, write_results
+
+
+class ProbeWebSocket:
+    """
+    Stands in for a starlette websocket, recording when each status update is sent
+    """
+
+    def __init__(self, payment_uuid: str):
+        self.uuid = payment_uuid
+        self.sent = {}
+        self.closed = asyncio.Event()
+
+    async def accept(self):
+        pass
+
+    async def receive_text(self):
+        return json.dumps({"uuid": self.uuid})
+
+    async def send_text(self, text):
+        self.sent.setdefault(json.loads(text).get("status"), time.monotonic())
+
+    async def close(self):
+        self.closed.set()
+
+
+def track_status_commits(database, table) -> dict:
+    """
+    Wraps `database.execute` to timestamp the status changes written to `table`, returns {row id: {status: time}}
+    """
+    from sqlalchemy.sql.dml import Update
+
+    commits = defaultdict(dict)
+    execute = database.execute
+
+    async def timed_execute(query, values=None):
+        result = await execute(query, values)
+        if isinstance(query, Update) and query.table is table:
+            params = query.compile().params
+            if 'status' in params:
+                commits[params.get('id_1')].setdefault(params['status'], time.monotonic())
+        return result
+
+    database.execute = timed_execute
+    return commits
+
+
+async def create_payments(coins, count: int, expiry_sec: float) -> list:
+    """
+    Inserts `count` pending payments per coin (each with its own invoice), returns the payment rows
+    """
+    from modules.coins import ALL_COINS
+    from modules.models import database, Invoice, Payment
+
+    now = datetime.datetime.utcnow()
+    invoices, payments = [], []
+    for symbol in coins:
+        network = ALL_COINS[symbol]
+        height = await network.current_block
+        for i in range(count):
+            address = network.make_address(index=i)
+            row_id = len(payments) + 1
+            invoices.append({"id": row_id, "uuid": str(uuid.uuid4()), "amount_cents": 1000, "currency": "USD",
+                             "creation_date": now, "expiry_date": now + datetime.timedelta(hours=1),
+                             "status": "pending"})
+            payments.append({"id": row_id, "invoice_id": row_id, "symbol": symbol, "uuid": str(uuid.uuid4()),
+                             "creation_date": now, "creation_height": height,
+                             "expiry_date": now + datetime.timedelta(seconds=expiry_sec),
+                             "scripthash": network.address_to_scripthash(address), "amount_sats": 10000 + i,
+                             "derivation_path": f"{network.xpub_derivation}/0/{i}", "derivation_account": 0,
+                             "derivation_index": i, "address": address, "last_update": 0, "status": "pending"})
+    await database.execute_many(Invoice.insert(), invoices)
+    await database.execute_many(Payment.insert(), payments)
+    return payments
+
+
+async def wait_for(predicate, timeout: float, interval: float = 0.05) -> bool:
+    expires = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > expires:
+            return False
+        await asyncio.sleep(interval)
+    return True
+
+
+def latencies(commits: dict, started: dict, status: str) -> list:
+    return [commits[k][status] - t for k, t in started.items() if status in commits.get(k, {})]
+
+
+async def run(args) -> dict:
+    coins = args.coins.split(",")
+    bootstrap(coins, overrides={"watcher_rehydration_concurrency": args.concurrency,
+                                **{f"COIN_{x}.required_confirmations": args.confirmations for x in coins}})
+    setup_wallets(coins)
+
+    from modules.coins import ALL_COINS
+    from modules.models import database, create_db, Payment
+    from modules.watchers import rehydrate_watchers
+    from views.payment import watch_payment as websocket_watch_payment
+
+    servers = await start_standins(coins)
+    create_db()
+    await database.connect()
+    commits = track_status_commits(database, Payment)
+    lag = LoopLag().start()
+    results = {}
+
+    payments = await create_payments(coins, args.payments, args.expiry)
+    paid = [x for i, x in enumerate(payments) if i % args.payments < args.payments * args.paid_ratio]
+    paid_ids = {x['id'] for x in paid}
+    unpaid = [x for x in payments if x['id'] not in paid_ids]
+
+    started = time.monotonic()
+    await rehydrate_watchers()
+    results['rehydrate_sec'] = round(time.monotonic() - started, 3)
+    results['rehydrate_rpc'] = rpc_counts(servers)
+
+    sockets = {x['id']: ProbeWebSocket(x['uuid']) for x in paid[:args.websockets]}
+    for socket in sockets.values():
+        asyncio.create_task(websocket_watch_payment(socket))
+    await asyncio.sleep(0.5)
+
+    # Mempool arrivals
+    before = rpc_counts(servers)
+    pay_times = {}
+    for i, payment in enumerate(paid):
+        pay_times[payment['id']] = time.monotonic()
+        await servers[payment['symbol']].pay(payment['scripthash'], payment['amount_sats'],
+                                             address=payment['address'])
+        if args.arrival_interval and i % args.batch_size == args.batch_size - 1:
+            await asyncio.sleep(args.arrival_interval)
+    settled = await wait_for(lambda: all('paid' in commits[x] for x in pay_times), args.timeout)
+    results['mempool'] = {
+        "settled": settled,
+        "rpc": rpc_delta(before, rpc_counts(servers)),
+        "notification_to_commit": summarize(latencies(commits, pay_times, 'paid')),
+        "websocket_fanout": summarize([x.sent['paid'] - pay_times[k] for k, x in sockets.items()
+                                       if 'paid' in x.sent]),
+    }
+
+    # Blocks, until the payments have enough confirmations
+    blocks = []
+    block_times = []
+    for _ in range(args.confirmations + args.extra_blocks):
+        before = rpc_counts(servers)
+        block_times.append(time.monotonic())
+        for server in servers.values():
+            await server.mine()
+        await asyncio.sleep(args.block_interval)
+        blocks.append(rpc_delta(before, rpc_counts(servers)))
+    confirm_times = {x: block_times[args.confirmations - 1] for x in pay_times}
+    settled = await wait_for(lambda: all('confirmed' in commits[x] for x in pay_times), args.timeout)
+    results['blocks'] = {
+        "settled": settled,
+        "rpc_per_block": blocks,
+        "notification_to_commit": summarize(latencies(commits, confirm_times, 'confirmed')),
+        "websocket_fanout": summarize([x.sent['confirmed'] - confirm_times[k] for k, x in sockets.items()
+                                       if 'confirmed' in x.sent]),
+    }
+
+    # Expiries - pending watchers only wake up on notifications, so the expiry is noticed on the next one
+    await asyncio.sleep(max(0.0, args.expiry - (time.monotonic() - started)) + 1)
+    before = rpc_counts(servers)
+    storm_time = time.monotonic()
+    for server in servers.values():
+        await server.storm(1)
+    expire_times = {x['id']: storm_time for x in unpaid}
+    settled = await wait_for(lambda: all('expired' in commits[x] for x in expire_times), args.timeout)
+    results['expiry'] = {
+        "settled": settled,
+        "rpc": rpc_delta(before, rpc_counts(servers)),
+        "notification_to_commit": summarize(latencies(commits, expire_times, 'expired')),
+    }
+
+    results['loop_lag'] = lag.stop()
+    results['peak_rss_mb'] = peak_rss_mb()
+    results['watched'] = {symbol: network.watched_payments.metrics() for symbol, network in ALL_COINS.items()}
+
+    await database.disconnect()
+    for server in servers.values():
+        await server.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--payments", type=int, default=1000, help="pending payments per coin")
+    parser.add_argument("--coins", default="BTC", help="comma separated coin symbols")
+    parser.add_argument("--paid-ratio", type=float, default=0.5, help="share of the payments that get paid")
+    parser.add_argument("--websockets", type=int, default=100, help="paid payments followed over a websocket")
+    parser.add_argument("--confirmations", type=int, default=2, help="required confirmations")
+    parser.add_argument("--extra-blocks", type=int, default=1, help="blocks mined past the required confirmations")
+    parser.add_argument("--block-interval", type=float, default=2, help="seconds between blocks")
+    parser.add_argument("--batch-size", type=int, default=100, help="mempool arrivals per batch")
+    parser.add_argument("--arrival-interval", type=float, default=0.1, help="seconds between arrival batches")
+    parser.add_argument("--expiry", type=float, default=30, help="seconds until unpaid payments expire")
+    parser.add_argument("--concurrency", type=int, default=10, help="watcher rehydration concurrency")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for each phase to settle")
+    parser.add_argument("--output", help="results file, defaults to benchmarks/results/watchers-<timestamp>.json")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    path = write_results("watchers", vars(args), results, output=args.output)
+    print(json.dumps(results, indent=2))
+    print(f"Results written to {path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -84,7 +84,7 @@ class _BitcoinCashMainnet(CoinNetwork):
 
     def estimate_tx_size(self, tx: 'PartialTransaction'):
         assert not tx.is_complete()
-        return len(tx.serialize()) // 2
+        return tx.estimated_legacy_size()
 
 
 class _BitcoinCashTestnet(_BitcoinCashMainnet):
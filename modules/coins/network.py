@@ -1,24 +1,55 @@
 import asyncio
 import datetime
-import json
+import time
 import warnings
 from pathlib import Path
 from typing import Tuple, Optional, TYPE_CHECKING
 
 import aiorpcx
+from sqlalchemy import and_
 
 from modules import config
 from modules.electrum_mods.functions import BIP32Node, pubkey_to_address, address_to_script, \
     script_to_scripthash, constants
-from modules.electrumx import ElectrumX, ElectrumError
-from modules.helpers import inv_dict, timestamp
+from modules.coins.registry import WatchRegistry, WatchedPayment
+from modules.electrumx import ElectrumX, ElectrumError, UnsupportedMethodError, scripthash_status, \
+    project_history, SUBSCRIPTION_QUEUE_SIZE, Capability
+from modules.helpers import inv_dict, timestamp, unix_time
 from modules.logging import logger
-from modules.models import database, Payment, Invoice
+from modules.models import database, Payment, Invoice, PaymentTransaction
 from modules.webhooks import send_webhook
 
 if TYPE_CHECKING:
     from modules.electrum_mods import PartialTransaction
 
+# Columns of a PaymentTransaction that are kept up to date by the payment watcher
+STORED_TX_FIELDS = ("height", "confirmations", "amount_sats", "time")
+
+
+def compact_verbose_transaction(tx: dict, address: str, height: int, decimals: int) -> dict:
+    """
+    See `CoinNetwork.compact_transaction`
+    """
+    amount_sats = 0
+    for vout in tx['vout']:
+        if "addresses" in vout['scriptPubKey']:
+            addresses = vout['scriptPubKey']['addresses']
+        elif "address" in vout['scriptPubKey']:
+            addresses = [vout['scriptPubKey']['address']]
+        else:
+            # nulldata and non-standard outputs can't pay an address
+            continue
+        if address in addresses:
+            amount_sats += int(round(vout['value'] * 10 ** decimals))
+
+    return {
+        "txid": tx['txid'],
+        "height": height,
+        "confirmations": 0,
+        "amount_sats": amount_sats,
+        "time": datetime.datetime.utcfromtimestamp(tx['time']) if tx.get('time') else None
+    }
+
 
 class CoinNetwork(constants.AbstractNet):
     symbol = ""
@@ -30,7 +61,6 @@ class CoinNetwork(constants.AbstractNet):
     kraken = ""
     electrumX = None
     decimals = 8
-    watched_payments = {}
 
     TESTNET = False
     SIGHASH_FLAG = 0x00000001
@@ -43,7 +73,10 @@ class CoinNetwork(constants.AbstractNet):
     PEER_DEFAULT_PORTS = {'t': 50001, 's': 50002}
 
     def __init__(self):
-        self.electrumX = ElectrumX(self.symbol, default_ports=self.PEER_DEFAULT_PORTS)
+        # Raw mode parses transactions locally, so servers that can't serve verbose transactions are usable too
+        self.raw_transactions = config.check("electrumx_raw_transactions", coin=self.symbol)
+        self.electrumX = ElectrumX(self.symbol, default_ports=self.PEER_DEFAULT_PORTS, genesis_hash=self.GENESIS,
+                                   required_capabilities=() if self.raw_transactions else (Capability.VERBOSE_TX,))
         self.XPRV_HEADERS_INV = inv_dict(self.XPRV_HEADERS)
         self.XPUB_HEADERS_INV = inv_dict(self.XPUB_HEADERS)
 
@@ -53,6 +86,12 @@ class CoinNetwork(constants.AbstractNet):
         self._current_block: Optional[int] = None
         self._current_feerate: Optional[Tuple[int, float]] = None
         self._svg_icon = None
+        self.watched_payments = WatchRegistry(grace_period=int(config.get("watcher_grace_period_sec", default=300)))
+
+        # Last known history of each watched scripthash, and transactions keyed by tx_hash -> (height, tx). In raw mode
+        # the cached tx is the list of (scriptpubkey, value) outputs, with a height of None as it never changes
+        self.known_history = {}
+        self.tx_cache = {}
 
         xpub = config.xpubs.get(self.symbol)
         if xpub is None:
@@ -116,7 +155,7 @@ class CoinNetwork(constants.AbstractNet):
             if self._current_block is not None:
                 return self._current_block
 
-            self._block_queue = asyncio.Queue()
+            self._block_queue = asyncio.Queue(maxsize=SUBSCRIPTION_QUEUE_SIZE)
             ret = await self.electrumX.call(ElectrumX.blockchain_headers_subscribe, [], self._block_queue)
             self._current_block = int(ret[0]['height'])
         asyncio.create_task(self.watch_blocks())
@@ -155,158 +194,392 @@ class CoinNetwork(constants.AbstractNet):
         """
         return config.get(key, coin=self.symbol, default=default)
 
-    async def get_transactions(self, script_hash, ignored_tx_hashes=None):
-        transactions = {}
+    def watch_state(self) -> dict:
+        """
+        Returns the warm state of the open payment watchers, used to avoid refetching every payment's history after a
+        restart (see `restore_watch_state`)
+        """
+        scripthashes = {x.scripthash for x in self.watched_payments.values() if x.is_open}
+        return {
+            "scripthashes": {sh: {"history": self.known_history[sh]} for sh in scripthashes if sh in self.known_history}
+        }
+
+    def restore_watch_state(self, state: dict):
+        scripthashes = state.get("scripthashes") or {}
+        # Read in full first, so that a malformed snapshot doesn't get partially restored
+        self.known_history.update({sh: list(dat['history']) for sh, dat in scripthashes.items()})
+        logger.info(f"{self.symbol} - restored watcher state of {len(scripthashes)} scripthashes")
+
+    def prune_watch_state(self) -> int:
+        """
+        Drops the known history (and cached transactions) of the scripthashes without an open payment watcher, such as
+        the ones restored for payments that were closed in the meantime. Returns the number of dropped scripthashes
+        """
+        watched = {x.scripthash for x in self.watched_payments.values() if x.is_open}
+        stale = [sh for sh in self.known_history if sh not in watched]
+        for sh in stale:
+            for tx in self.known_history.pop(sh):
+                self.tx_cache.pop(tx['tx_hash'], None)
+        return len(stale)
+
+    def history_unchanged(self, script_hash, status: Optional[str]) -> bool:
+        """
+        Whether the status hash sent by the server matches the one computed from the history we already know
+        """
+        return script_hash in self.known_history and status == scripthash_status(self.known_history[script_hash])
+
+    def history_settled(self, script_hash) -> bool:
+        """
+        Whether every transaction in the known history of a scripthash has confirmed
+        """
+        return script_hash in self.known_history and all(x['height'] > 0 for x in self.known_history[script_hash])
+
+    async def sync_history(self, script_hash, status: Optional[str]):
+        """
+        Brings the known history of a scripthash up to date with the status hash sent by the server. New activity is
+        usually limited to the mempool (new transactions, or ones that have just been mined), so the history is first
+        projected from the mempool and only downloaded in full if that doesn't match the status
+        """
+        if self.history_unchanged(script_hash, status):
+            return
+        if script_hash in self.known_history and status is not None:
+            mempool = await self.get_mempool(script_hash)
+            if mempool is not None:
+                history = project_history(self.known_history[script_hash], mempool, await self.current_block)
+                if scripthash_status(history) == status:
+                    self.known_history[script_hash] = history
+                    return
+        await self.fetch_history(script_hash)
+
+    async def fetch_history(self, script_hash) -> list:
         history = await self.electrum_call(ElectrumX.blockchain_scripthash_get_history, [script_hash])
-        for tx in history:
-            tx_hash = tx.get("tx_hash")
+        self.known_history[script_hash] = [{k: v for k, v in x.items() if k in ('tx_hash', 'height', 'fee')}
+                                           for x in history]
+        return self.known_history[script_hash]
+
+    async def get_mempool(self, script_hash) -> Optional[list]:
+        """
+        Returns the unconfirmed transactions of a scripthash, or None if the server doesn't support the call
+        """
+        if not self.electrumX.supports(ElectrumX.blockchain_scripthash_get_mempool):
+            return None
+        try:
+            return await self.electrum_call(ElectrumX.blockchain_scripthash_get_mempool, [script_hash])
+        except UnsupportedMethodError:
+            return None
+
+    async def precheck_payment(self, payment: WatchedPayment, status: Optional[str],
+                               transactions: list) -> Optional[list]:
+        """
+        Classifies the common payment states without downloading any verbose transactions, using the scripthash balance
+        (and mempool, where the server supports it):
+         - nothing has been received: returns an empty list
+         - the recorded transactions are the whole history, add up to the confirmed balance, and are all confirmed above
+           the required threshold: returns them with up to date confirmation counts
+        Returns None if the transaction detail is needed to update the payment record
+        """
+        if status is None:
+            # No history at all
+            return []
+
+        script_hash = payment.scripthash
+        try:
+            balance = await self.electrum_call(ElectrumX.blockchain_scripthash_get_balance, [script_hash])
+        except UnsupportedMethodError:
+            return None
+        mempool = await self.get_mempool(script_hash)
+        # The mempool listing is exact, the unconfirmed balance is a net amount
+        has_unconfirmed = bool(mempool) if mempool is not None else balance['unconfirmed'] != 0
+
+        if not transactions:
+            if payment.status == 'pending' and balance['confirmed'] == 0 and not has_unconfirmed:
+                return []
+            return None
+
+        if has_unconfirmed or balance['confirmed'] < payment.amount_sats:
+            return None
+
+        heights = {x['tx_hash']: x['height'] for x in await self.fetch_history(script_hash)}
+        # Anything the records don't account for, such as a top up received while the watcher was down, needs the
+        # transaction detail
+        if set(heights) != {tx['txid'] for tx in transactions} or \
+                sum(tx['amount_sats'] for tx in transactions) != balance['confirmed']:
+            return None
+        current_block = await self.current_block
+        req_confirmations = int(self.config('required_confirmations', default=6))
+        if any(heights.get(tx['txid'], 0) <= 0 or current_block - heights[tx['txid']] + 1 < req_confirmations
+               for tx in transactions):
+            return None
+        return [dict(tx, height=heights[tx['txid']], confirmations=current_block - heights[tx['txid']] + 1)
+                for tx in transactions]
+
+    def compact_transaction(self, tx: dict, address: str, height: int) -> dict:
+        """
+        Reduces a verbose transaction to the record kept against a payment: the amount paid to the payment address and
+        where/when it was mined
+        """
+        return compact_verbose_transaction(tx, address, height, self.decimals)
+
+    async def compact_raw_transaction(self, tx_hash: str, script: bytes, height: int) -> dict:
+        """
+        Same as `compact_transaction`, from the raw transaction parsed locally. Outputs are matched against the payment
+        script rather than decoded addresses, and there is no block time
+        """
+        if tx_hash not in self.tx_cache or self.tx_cache[tx_hash][0] is not None:
+            from modules.electrum_mods.tux_tx import Transaction
+            raw = await self.electrum_call(ElectrumX.blockchain_transaction_get, [tx_hash])
+            self.tx_cache[tx_hash] = (None, [(x.scriptpubkey, x.value) for x in Transaction(raw).outputs()])
+
+        return {
+            "txid": tx_hash,
+            "height": height,
+            "confirmations": 0,
+            "amount_sats": sum(value for scriptpubkey, value in self.tx_cache[tx_hash][1] if scriptpubkey == script),
+            "time": None
+        }
+
+    async def get_transactions(self, script_hash, address, recorded_tx=None, ignored_tx_hashes=None,
+                               refetch_history=True) -> dict:
+        """
+        Returns the compact transaction records of a scripthash. Confirmed transactions that are already recorded at the
+        same height are reused, anything else is reduced from the verbose transaction (via the transaction cache), or
+        from the raw transaction when `electrumx_raw_transactions` is enabled
+        """
+        script = bytes.fromhex(self.address_to_script(address)) if self.raw_transactions else None
+        if refetch_history or script_hash not in self.known_history:
+            await self.fetch_history(script_hash)
+
+        recorded_tx = recorded_tx or {}
+        transactions = {}
+        current_block = await self.current_block
+        for tx in self.known_history[script_hash]:
+            tx_hash, height = tx['tx_hash'], tx['height']
             if ignored_tx_hashes and tx_hash in ignored_tx_hashes:
                 continue
-            transactions[tx_hash] = await self.electrum_call(ElectrumX.blockchain_transaction_get, [tx_hash, True])
-            if 'fee' in tx:
-                transactions[tx_hash]['mempool_fee'] = tx['fee']
+
+            record = recorded_tx.get(tx_hash)
+            if self.raw_transactions and (record is None or record['height'] != height):
+                record = await self.compact_raw_transaction(tx_hash, script, height)
+                if 'fee' in tx:
+                    record['mempool_fee'] = tx['fee']
+            elif not self.raw_transactions and (record is None or height <= 0 or record['height'] != height):
+                # Verbose transactions are refetched when their height changes (confirmed or reorged), as the block
+                # related fields will have changed, confirmations are calculated locally otherwise
+                if tx_hash not in self.tx_cache or self.tx_cache[tx_hash][0] != height:
+                    self.tx_cache[tx_hash] = (height, await self.electrum_call(
+                        ElectrumX.blockchain_transaction_get, [tx_hash, True]))
+                verbose_tx = self.tx_cache[tx_hash][1]
+                record = self.compact_transaction(verbose_tx, address, height)
+                if verbose_tx.get('instantlock'):
+                    record['instantlock'] = True
+                if 'fee' in tx:
+                    record['mempool_fee'] = tx['fee']
+
+            transactions[tx_hash] = dict(record, confirmations=max(0, current_block - height + 1) if height > 0 else 0)
         return transactions
 
-    async def watch_payment(self, payment: dict):
+    @staticmethod
+    async def save_payment_transactions(payment_id: int, transactions: list, recorded_tx: dict) -> bool:
+        """
+        Writes the compact transaction records of a payment, only touching the rows that have changed.
+        Returns True if anything was written
+        """
+        current = {tx['txid']: {k: tx[k] for k in STORED_TX_FIELDS} for tx in transactions}
+        inserts = [dict(values, payment_id=payment_id, txid=txid) for txid, values in current.items()
+                   if txid not in recorded_tx]
+        updates = {txid: values for txid, values in current.items()
+                   if txid in recorded_tx and values != {k: recorded_tx[txid][k] for k in STORED_TX_FIELDS}}
+        removed = [txid for txid in recorded_tx if txid not in current]
+        if not (inserts or updates or removed):
+            return False
+
+        async with database.transaction():
+            if inserts:
+                await database.execute_many(PaymentTransaction.insert(), inserts)
+            for txid, values in updates.items():
+                await database.execute(PaymentTransaction.update()
+                                       .where(and_(PaymentTransaction.c.payment_id == payment_id,
+                                                   PaymentTransaction.c.txid == txid))
+                                       .values(**values))
+            if removed:
+                await database.execute(PaymentTransaction.delete()
+                                       .where(and_(PaymentTransaction.c.payment_id == payment_id,
+                                                   PaymentTransaction.c.txid.in_(removed))))
+        return True
+
+    async def watch_payment(self, payment: dict, ready: Optional[asyncio.Event] = None):
         logger.info(f"Watching payment {payment['uuid']}")
 
-        queue = asyncio.Queue()
-        self.watched_payments[payment['uuid']] = payment
-        original_payment = payment.copy()
+        queue = asyncio.Queue(maxsize=SUBSCRIPTION_QUEUE_SIZE)
+        payment = self.watched_payments.watch(payment)
 
         first_loop = True
         awaiting_mempool = True
         awaiting_confirmations = True
         current_block = await self.current_block
-        script_hash = payment['scripthash']
+        script_hash = payment.scripthash
         ignored_tx_hashes = set()
+        recorded_tx = {x['txid']: {k: x[k] for k in ('txid',) + STORED_TX_FIELDS} for x in await database.fetch_all(
+            PaymentTransaction.select().where(PaymentTransaction.c.payment_id == payment.id))}
+        payment.transactions = list(recorded_tx.values())
 
         while True:
+            valid_tx = None
+            history_synced = False
             if awaiting_mempool:
                 if first_loop:
-                    first_loop = False
                     logger.info(f"Subscribing to scripthash")
-                    await self.electrum_call(ElectrumX.blockchain_scripthash_subscribe, [script_hash], queue)
+                    _, status = await self.electrum_call(ElectrumX.blockchain_scripthash_subscribe,
+                                                         [script_hash], queue)
                 else:
                     logger.info(f"Waiting for scripthash changes")
-                    await queue.get()
+                    _, status = await queue.get()
                     logger.info(f"Done waiting")
+                refetch_history = not self.history_unchanged(script_hash, status)
+                if first_loop and refetch_history:
+                    valid_tx = await self.precheck_payment(payment, status, payment.transactions)
+                first_loop = False
             elif awaiting_confirmations:
                 logger.info("waiting for new block")
                 while current_block == await self.current_block:
                     await asyncio.sleep(1)
                 current_block = await self.current_block
+                if queue.empty():
+                    # Confirmations are calculated locally, as the scripthash stays subscribed until the payment has
+                    # confirmed, and reorgs or double spends are notified. The history is still synced if anything is
+                    # unconfirmed, or before the payment is confirmed from it, in case the notification is late
+                    req_confirmations = int(self.config('required_confirmations', default=6))
+                    confirming = sum(tx['amount_sats'] for tx in payment.transactions if tx['height'] > 0 and
+                                     current_block - tx['height'] + 1 >= req_confirmations) >= payment.amount_sats
+                    refetch_history = confirming or not self.history_settled(script_hash)
+                    if refetch_history:
+                        await self.fetch_history(script_hash)
+                        history_synced = True
+                else:
+                    while not queue.empty():
+                        _, status = queue.get_nowait()
+                    refetch_history = not self.history_unchanged(script_hash, status)
             else:
-                logger.info(f"Finished watching payment {payment['uuid']}")
+                logger.info(f"Finished watching payment {payment.uuid}")
+                await self.unsubscribe_electrumx(ElectrumX.blockchain_scripthash_unsubscribe, [script_hash], queue)
+                for tx in self.known_history.pop(script_hash, []):
+                    self.tx_cache.pop(tx['tx_hash'], None)
                 break
 
-            logger.info(f"Payment Update: {payment['uuid']} - {script_hash}")
-            all_transactions = await self.get_transactions(script_hash, ignored_tx_hashes=ignored_tx_hashes)
-
-            # Check if "received"
-            valid_tx = []
-            for x in all_transactions.values():
-                if 'time' not in x:
-                    valid_tx.append(x)
-                elif datetime.datetime.utcfromtimestamp(x.get('time', 0) or 0) > payment['creation_date']:
-                    valid_tx.append(x)
-                else:
-                    ignored_tx_hashes.add(x.get("tx_hash"))
+            logger.info(f"Payment Update: {payment.uuid} - {script_hash}"
+                        f"{'' if refetch_history else ' (status unchanged, skipping history download)'}")
+            if valid_tx is None:
+                if refetch_history and not history_synced:
+                    await self.sync_history(script_hash, status)
+                all_transactions = await self.get_transactions(script_hash, payment.address, recorded_tx=recorded_tx,
+                                                               ignored_tx_hashes=ignored_tx_hashes,
+                                                               refetch_history=False)
+
+                # Check if "received"
+                valid_tx = []
+                for x in all_transactions.values():
+                    if x['time'] is not None:
+                        valid = unix_time(x['time']) > payment.creation_time
+                    else:
+                        # Without a block time (mempool or raw transactions), anything mined at or below the tip at
+                        # the time the payment was created predates it
+                        valid = x['height'] <= 0 or not payment.creation_height or x['height'] > payment.creation_height
+                    if valid:
+                        valid_tx.append(x)
+                    else:
+                        ignored_tx_hashes.add(x['txid'])
+            else:
+                logger.info(f"Payment {payment.uuid} classified from scripthash balance")
 
-            payment['transactions'] = valid_tx
+            payment.transactions = valid_tx
 
             mempool_sats = 0
             chain_sats = 0
             confirmed_sats = 0
             req_confirmations = int(self.config('required_confirmations', default=6))
             for tx in valid_tx:
-                for vout in tx['vout']:
-                    if "addresses" in vout['scriptPubKey']:
-                        addresses = vout['scriptPubKey']['addresses']
-                    elif "address" in vout['scriptPubKey']:
-                        addresses = [vout['scriptPubKey']['address']]
-                    else:
-                        raise ElectrumError("No Addresses in vout")
-
-                    for addr in addresses:
-                        if addr == payment['address']:
-                            sats = int(round(vout['value'] * 10 ** self.decimals))
-                            mempool_sats += sats
-                            confirmations = tx.get("confirmations", 0)
-
-                            # If instantsend lock is present, treat as if 1 confirmation
-                            if confirmations == 0 and tx.get("instantlock"):
-                                warnings.warn("test instantlock")
-                                confirmations = 1
-
-                            if confirmations > 0 or req_confirmations == 0:
-                                chain_sats += sats
-
-                            if confirmations >= req_confirmations:
-                                if req_confirmations == 0 and confirmations == 0:
-                                    warnings.warn("Check zeroconf fees")
-                                    # CHECK IF mempool_fee is greater than the coins current next-block feerate
-                                    mempool_fee = tx.get("mempool_fee")
-                                    # If ElectrumX doesn't return this it will need to get calculated manually
-                                confirmed_sats += sats
-
-            if datetime.datetime.utcnow() > payment['expiry_date'] and payment['status'] == "pending":
-                payment['status'] = "expired"
-                payment['last_update'] = timestamp()
+                sats = tx['amount_sats']
+                if not sats:
+                    continue
+                mempool_sats += sats
+                confirmations = tx['confirmations']
+
+                # If instantsend lock is present, treat as if 1 confirmation
+                if confirmations == 0 and tx.get("instantlock"):
+                    warnings.warn("test instantlock")
+                    confirmations = 1
+
+                if confirmations > 0 or req_confirmations == 0:
+                    chain_sats += sats
+
+                if confirmations >= req_confirmations:
+                    if req_confirmations == 0 and confirmations == 0:
+                        warnings.warn("Check zeroconf fees")
+                        # CHECK IF mempool_fee is greater than the coins current next-block feerate
+                        mempool_fee = tx.get("mempool_fee")
+                        # If ElectrumX doesn't return this it will need to get calculated manually
+                    confirmed_sats += sats
+
+            now = int(time.time())
+            if now > payment.expiry_time and payment.status == "pending":
+                payment.status = "expired"
+                payment.last_update = timestamp()
                 awaiting_confirmations = False
             else:
-                if confirmed_sats >= payment['amount_sats']:
+                if confirmed_sats >= payment.amount_sats:
                     awaiting_confirmations = False
-                    if payment['status'] != "confirmed":
-                        payment['status'] = "confirmed"
-                        payment['payment_date'] = payment['payment_date'] or datetime.datetime.utcnow()
-                        payment['paid_amount_sats'] = payment['paid_amount_sats'] or mempool_sats
-                        payment['last_update'] = timestamp()
-
-                if mempool_sats >= payment['amount_sats']:
-                    if payment['status'] == 'pending':
-                        payment['status'] = 'paid'
-                        payment['payment_date'] = payment['payment_date'] or datetime.datetime.utcnow()
-                        payment['paid_amount_sats'] = payment['paid_amount_sats'] or mempool_sats
-                        payment['last_update'] = timestamp()
-
-            if awaiting_mempool:
-                if payment['status'] in ('expired', 'confirmed') or chain_sats > payment['amount_sats']:
-                    awaiting_mempool = False
-                    await self.unsubscribe_electrumx("blockchain.scripthash.unsubscribe",
-                                                     [payment['scripthash']], queue)
-
-            changes = {k: payment[k] for k, v in original_payment.items() if v != payment[k] and k != "transactions"}
-            if (tx_serialized := json.dumps(valid_tx)) != original_payment.get('transactions'):
-                changes['transactions'] = tx_serialized
-
+                    if payment.status != "confirmed":
+                        payment.status = "confirmed"
+                        payment.payment_time = payment.payment_time or now
+                        payment.paid_amount_sats = payment.paid_amount_sats or mempool_sats
+                        payment.last_update = timestamp()
+
+                if mempool_sats >= payment.amount_sats:
+                    if payment.status == 'pending':
+                        payment.status = 'paid'
+                        payment.payment_time = payment.payment_time or now
+                        payment.paid_amount_sats = payment.paid_amount_sats or mempool_sats
+                        payment.last_update = timestamp()
+
+            if awaiting_mempool and (not payment.is_open or chain_sats >= payment.amount_sats):
+                awaiting_mempool = False
+
+            if await self.save_payment_transactions(payment.id, valid_tx, recorded_tx):
+                recorded_tx = {tx['txid']: tx for tx in valid_tx}
+
+            changes = payment.pop_changes()
             if changes:
                 await database.execute(Payment.update()
-                                       .where(Payment.c.id == payment['id'])
+                                       .where(Payment.c.id == payment.id)
                                        .values(**changes))
 
                 # If the payment changes, the invoice should as well, calculate the invoice status now
-                invoice = await database.fetch_one(Invoice.select().where(Invoice.c.id == payment['invoice_id']))
+                invoice = await database.fetch_one(Invoice.select().where(Invoice.c.id == payment.invoice_id))
                 invoice = dict(invoice)
                 original_invoice = invoice.copy()
 
-                if payment['status'] == 'confirmed' and invoice['status'] in ('pending', 'paid'):
+                if payment.status == 'confirmed' and invoice['status'] in ('pending', 'paid'):
                     invoice['status'] = "confirmed"
-                elif payment['status'] == 'paid' and invoice['status'] == 'pending':
+                elif payment.status == 'paid' and invoice['status'] == 'pending':
                     invoice['status'] = "paid"
 
                 if invoice['status'] != original_invoice['status']:
                     if config.get("payment_callback_url"):
-                        asyncio.create_task(send_webhook(invoice, payment))
+                        payment_row = await database.fetch_one(Payment.select().where(Payment.c.id == payment.id))
+                        transactions = [{k: tx[k] for k in ('txid',) + STORED_TX_FIELDS} for tx in valid_tx]
+                        asyncio.create_task(send_webhook(invoice, dict(payment_row, transactions=transactions)))
                     await database.execute(Invoice.update().where(Invoice.c.id == invoice['id']).values(
-                        **{"status": invoice['status'], "payment_date": payment['payment_date']}))
+                        **{"status": invoice['status'], "payment_date": payment.payment_date}))
 
                 if invoice['status'] == 'confirmed':
                     if config.check("email_notifications", namespace="EMAIL"):
                         from modules.email import email_invoice
                         asyncio.create_task(email_invoice(invoice))
 
-            self.watched_payments[payment['uuid']] = payment
+            self.watched_payments.updated(payment)
+            if ready is not None:
+                # initial sync is complete
+                ready.set()
 
     def make_address(self, xpub_node: BIP32Node = None, account=0, index=0) -> str:
         assert isinstance(index, int) and index >= 0
@@ -327,16 +600,25 @@ class CoinNetwork(constants.AbstractNet):
     async def electrum_call(self, method, params=None, queue=None):
         return await self.electrumX.call(method, params, queue=queue)
 
+    async def broadcast_transaction(self, raw_tx: str) -> str:
+        """
+        Broadcasts a signed transaction to several ElectrumX servers at once, returns the txid
+        """
+        return await self.electrumX.broadcast(raw_tx)
+
     async def unsubscribe_electrumx(self, method, params=None, queue=None):
         assert queue is not None
-        logger.info(f"Unsubscribing from {method} {params}")
         await self.electrumX.get_session()
+        if not self.electrumX.unsubscribe(queue):
+            # Other consumers are still subscribed
+            return
+        if not self.electrumX.supports(method):
+            return
+        logger.info(f"Unsubscribing from {method} {params}")
         try:
             await self.electrumX.session.send_request(method, params)
-        except aiorpcx.RPCError:
-            # not all servers implement this
-            pass
-        self.electrumX.unsubscribe(queue)
+        except aiorpcx.RPCError as e:
+            logger.info(f"{method} failed: {e}")
 
     def estimate_tx_size(self, tx: 'PartialTransaction'):
         return tx.estimated_size(self)
@@ -0,0 +1,163 @@
+import datetime
+import time
+from collections import deque
+from typing import Dict, Optional
+
+from modules.helpers import unix_time
+
+TERMINAL_STATUSES = ('expired', 'confirmed')
+
+
+def _tracked(name: str, flag: int):
+    """
+    Property backed by the `_<name>` slot, that flags the owner as dirty when its value changes
+    """
+    slot = f"_{name}"
+
+    def fget(self):
+        return getattr(self, slot)
+
+    def fset(self, value):
+        if getattr(self, slot) != value:
+            setattr(self, slot, value)
+            self._dirty |= flag
+
+    return property(fget, fset)
+
+
+class WatchedPayment:
+    """
+    Compact state of a watched payment, holding only what the payment watcher needs. Amounts are in sats and times are
+    unix timestamps. Changes to the persisted fields are flagged, so only those get written back to the database
+    """
+    __slots__ = ('id', 'invoice_id', 'uuid', 'scripthash', 'address', 'amount_sats', 'creation_time', 'creation_height',
+                 'expiry_time', 'transactions', 'finished_at', '_status', '_paid_amount_sats', '_payment_time',
+                 '_last_update', '_dirty')
+
+    STATUS, PAID_AMOUNT, PAYMENT_TIME, LAST_UPDATE = 1, 2, 4, 8
+
+    status = _tracked('status', STATUS)
+    paid_amount_sats = _tracked('paid_amount_sats', PAID_AMOUNT)
+    payment_time = _tracked('payment_time', PAYMENT_TIME)
+    last_update = _tracked('last_update', LAST_UPDATE)
+
+    def __init__(self, uuid: str, scripthash: str, status: str = "pending", last_update: int = 0):
+        self.id = None
+        self.invoice_id = None
+        self.uuid = uuid
+        self.scripthash = scripthash
+        self.address = None
+        self.amount_sats = 0
+        self.creation_time = 0
+        self.creation_height = None
+        self.expiry_time = 0
+        self.transactions = []
+        self.finished_at: Optional[float] = None
+        self._status = status
+        self._paid_amount_sats = None
+        self._payment_time = None
+        self._last_update = last_update
+        self._dirty = 0
+
+    @classmethod
+    def from_row(cls, payment) -> 'WatchedPayment':
+        self = cls(payment['uuid'], payment['scripthash'], status=payment['status'],
+                   last_update=payment['last_update'] or 0)
+        self.id = payment['id']
+        self.invoice_id = payment['invoice_id']
+        self.address = payment['address']
+        self.amount_sats = payment['amount_sats']
+        self.creation_time = unix_time(payment['creation_date'])
+        self.creation_height = payment.get('creation_height')
+        self.expiry_time = unix_time(payment['expiry_date'])
+        self._paid_amount_sats = payment['paid_amount_sats']
+        self._payment_time = unix_time(payment['payment_date'])
+        return self
+
+    @property
+    def is_open(self):
+        return self._status not in TERMINAL_STATUSES
+
+    @property
+    def payment_date(self) -> Optional[datetime.datetime]:
+        return None if self._payment_time is None else datetime.datetime.utcfromtimestamp(self._payment_time)
+
+    def pop_changes(self) -> dict:
+        """
+        Returns the `Payment` column values that have changed since the last call
+        """
+        changes = {}
+        if self._dirty & self.STATUS:
+            changes['status'] = self._status
+        if self._dirty & self.PAID_AMOUNT:
+            changes['paid_amount_sats'] = self._paid_amount_sats
+        if self._dirty & self.PAYMENT_TIME:
+            changes['payment_date'] = self.payment_date
+        if self._dirty & self.LAST_UPDATE:
+            changes['last_update'] = self._last_update
+        self._dirty = 0
+        return changes
+
+
+class WatchRegistry:
+    """
+    Per coin registry of the watched payments. Payments that reach a terminal status are kept around for a grace period,
+    so that anything polling them sees the final status, and are dropped after that
+    """
+
+    def __init__(self, grace_period: float = 300):
+        self.grace_period = grace_period
+        self._payments: Dict[str, WatchedPayment] = {}
+        # (finished_at, uuid), in finishing order as the grace period is the same for every payment
+        self._finished = deque()
+
+    def __contains__(self, uuid):
+        return uuid in self._payments
+
+    def __getitem__(self, uuid) -> WatchedPayment:
+        return self._payments[uuid]
+
+    def __len__(self):
+        return len(self._payments)
+
+    def get(self, uuid) -> Optional[WatchedPayment]:
+        return self._payments.get(uuid)
+
+    def values(self):
+        return self._payments.values()
+
+    def watch(self, payment) -> WatchedPayment:
+        """
+        Registers a payment row, replacing any previous entry of the same payment
+        """
+        self.prune()
+        entry = self._payments[payment['uuid']] = WatchedPayment.from_row(payment)
+        return entry
+
+    def updated(self, entry: WatchedPayment):
+        """
+        Starts the grace period of payments that have reached a terminal status
+        """
+        if not entry.is_open and entry.finished_at is None:
+            entry.finished_at = time.monotonic()
+            self._finished.append((entry.finished_at, entry.uuid))
+        self.prune()
+
+    def prune(self) -> int:
+        """
+        Drops the payments whose grace period has run out, returns the number of dropped payments
+        """
+        dropped = 0
+        cutoff = time.monotonic() - self.grace_period
+        while self._finished and self._finished[0][0] <= cutoff:
+            finished_at, uuid = self._finished.popleft()
+            # The payment may have been re-registered since
+            if uuid in self._payments and self._payments[uuid].finished_at == finished_at:
+                del self._payments[uuid]
+            dropped += 1
+        return dropped
+
+    def metrics(self) -> dict:
+        self.prune()
+        finished = sum(1 for x in self._payments.values() if x.finished_at is not None)
+        return {"watched": len(self._payments) - finished, "finished": finished}
@@ -29,6 +29,7 @@
 import base64
 import binascii
 import copy
+import hashlib
 import io
 import itertools
 import struct
@@ -73,6 +74,45 @@ class MissingTxInputAmount(Exception):
 
 SIGHASH_ALL = 1
 
+_INT16 = struct.Struct('<h')
+_UINT16 = struct.Struct('<H')
+_INT32 = struct.Struct('<i')
+_UINT32 = struct.Struct('<I')
+_INT64 = struct.Struct('<q')
+_UINT64 = struct.Struct('<Q')
+
+
+def compact_size(size: int) -> bytes:
+    """The bytes counterpart of `var_int`"""
+    if size < 253:
+        return bytes((size,))
+    if size < 2 ** 16:
+        return b'\xfd' + _UINT16.pack(size)
+    if size < 2 ** 32:
+        return b'\xfe' + _UINT32.pack(size)
+    return b'\xff' + _UINT64.pack(size)
+
+
+def compact_size_len(size: int) -> int:
+    """`len(compact_size(size))`"""
+    return 1 if size < 253 else 3 if size < 2 ** 16 else 5 if size < 2 ** 32 else 9
+
+
+def push_size(size: int) -> int:
+    """Length of the script op pushing `size` bytes of data"""
+    if size < 0x4c:  # OP_PUSHDATA1
+        return 1 + size
+    if size <= 0xff:
+        return 2 + size
+    if size <= 0xffff:
+        return 3 + size
+    return 5 + size
+
+
+def int32_to_bytes(i: int) -> bytes:
+    # like int_to_hex(i, 4), negative values are two's complement
+    return i.to_bytes(4, byteorder='little', signed=i < 0)
+
 
 class TxOutput:
     scriptpubkey: bytes
@@ -88,16 +128,12 @@ class TxOutput:
                    value=value)
 
     def serialize_to_network(self) -> bytes:
-        buf = int.to_bytes(self.value, 8, byteorder="little", signed=False)
         script = self.scriptpubkey
-        buf += bytes.fromhex(var_int(len(script.hex()) // 2))
-        buf += script
-        return buf
+        return _UINT64.pack(self.value) + compact_size(len(script)) + script
 
     @classmethod
     def from_network_bytes(cls, raw: bytes) -> 'TxOutput':
-        vds = BCDataStream()
-        vds.write(raw)
+        vds = BCDataStream(raw)
         txout = parse_output(vds)
         if vds.can_read_more():
             raise SerializationError('extra junk at the end of TxOutput bytes')
@@ -147,9 +183,53 @@ class TxOutput:
 
 
 class BIP143SharedTxDigestFields(NamedTuple):
-    hashPrevouts: str
-    hashSequence: str
-    hashOutputs: str
+    hashPrevouts: bytes
+    hashSequence: bytes
+    hashOutputs: bytes
+
+
+class LegacyPreimageParts:
+    """The parts of the pre-segwit signature preimages that every input of a signing pass shares. Each preimage
+    serializes all inputs with empty scripts (41 bytes each) except the one being signed, so the preimages are spliced
+    together from these parts, and their hashes resume from the running hash of the inputs before the signed one"""
+    INPUT_SIZE = 41
+
+    def __init__(self, tx: 'Transaction'):
+        inputs = tx.inputs()
+        outputs = tx.outputs()
+        self.head = int32_to_bytes(tx.version) + compact_size(len(inputs))
+        self.inputs = memoryview(b''.join(txin.prevout.serialize_to_network() + b'\x00' + _UINT32.pack(txin.nsequence)
+                                          for txin in inputs))
+        self.tail = compact_size(len(outputs)) + b''.join(o.serialize_to_network() for o in outputs) + \
+            _UINT32.pack(tx.locktime)
+        self._prefix = hashlib.sha256(self.head)
+        self._prefix_index = 0
+
+    def _signed_input(self, txin_index: int, script: bytes) -> Tuple[bytes, int]:
+        start = txin_index * self.INPUT_SIZE
+        end = start + self.INPUT_SIZE
+        return self.inputs[start:end - 5].tobytes() + compact_size(len(script)) + script + self.inputs[end - 4:end], end
+
+    def preimage(self, txin_index: int, script: bytes, hash_type: int) -> bytes:
+        signed_input, end = self._signed_input(txin_index, script)
+        return b''.join((self.head, self.inputs[:txin_index * self.INPUT_SIZE], signed_input, self.inputs[end:],
+                         self.tail, _UINT32.pack(hash_type)))
+
+    def sighash(self, txin_index: int, script: bytes, hash_type: int) -> bytes:
+        """sha256d of the preimage, linear over a signing pass that goes through the inputs in order"""
+        if txin_index < self._prefix_index:
+            self._prefix = hashlib.sha256(self.head)
+            self._prefix_index = 0
+        self._prefix.update(self.inputs[self._prefix_index * self.INPUT_SIZE:txin_index * self.INPUT_SIZE])
+        self._prefix_index = txin_index
+
+        signed_input, end = self._signed_input(txin_index, script)
+        h = self._prefix.copy()
+        h.update(signed_input)
+        h.update(self.inputs[end:])
+        h.update(self.tail)
+        h.update(_UINT32.pack(hash_type))
+        return hashlib.sha256(h.digest()).digest()
 
 
 class TxOutpoint(NamedTuple):
@@ -170,7 +250,7 @@ class TxOutpoint(NamedTuple):
         return [self.txid.hex(), self.out_idx]
 
     def serialize_to_network(self) -> bytes:
-        return self.txid[::-1] + bytes.fromhex(int_to_hex(self.out_idx, 4))
+        return self.txid[::-1] + _UINT32.pack(self.out_idx)
 
     def is_coinbase(self) -> bool:
         return self.txid == bytes(32)
@@ -222,8 +302,7 @@ class TxInput:
         return d
 
     def witness_elements(self) -> Sequence[bytes]:
-        vds = BCDataStream()
-        vds.write(self.witness)
+        vds = BCDataStream(self.witness)
         n = vds.read_compact_size()
         return list(vds.read_bytes(vds.read_compact_size()) for i in range(n))
 
@@ -234,22 +313,56 @@ class TxInput:
 
 
 class BCDataStream(object):
-    """Workalike python implementation of Bitcoin's CDataStream class."""
+    """Workalike python implementation of Bitcoin's CDataStream class.
 
-    def __init__(self):
-        self.input = None  # type: Optional[bytearray]
+    Reads go through a memoryview of the buffer: integers are unpacked in place, and only the fields that are
+    returned as bytes get copied. A buffer passed to the constructor is read as is (it is copied on the first write)
+    """
+
+    def __init__(self, data: Union[bytes, bytearray, memoryview] = None):
+        self.input = data  # type: Optional[Union[bytes, bytearray, memoryview]]
         self.read_cursor = 0
+        self._view = None  # type: Optional[memoryview]
+        self._owned = data is None
 
     def clear(self):
+        self._release()
         self.input = None
         self.read_cursor = 0
+        self._owned = True
 
-    def write(self, _bytes: Union[bytes, bytearray]):  # Initialize with string of _bytes
-        assert isinstance(_bytes, (bytes, bytearray))
-        if self.input is None:
-            self.input = bytearray(_bytes)
+    @property
+    def view(self) -> memoryview:
+        if self._view is None:
+            if self.input is None:
+                raise SerializationError("call write(bytes) before trying to deserialize")
+            self._view = memoryview(self.input)
+        return self._view
+
+    def _release(self):
+        # a bytearray can't be resized while a memoryview of it exists
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+
+    def write(self, _bytes: Union[bytes, bytearray, memoryview]):  # Initialize with string of _bytes
+        assert isinstance(_bytes, (bytes, bytearray, memoryview))
+        self._release()
+        if self.input is None or not self._owned:
+            self.input = bytearray(self.input or b'') + _bytes
+            self._owned = True
         else:
-            self.input += bytearray(_bytes)
+            self.input += _bytes
+
+    def read(self, size: int = -1) -> bytes:
+        """File-like read, for the PSBT parser: at most `size` bytes (the rest by default), b'' at the end"""
+        if self.input is None:
+            return b''
+        view = self.view
+        end = len(view) if size is None or size < 0 else min(len(view), self.read_cursor + size)
+        result = bytes(view[self.read_cursor:end])
+        self.read_cursor = max(self.read_cursor, end)
+        return result
 
     def read_string(self, encoding='ascii'):
         # Strings are encoded depending on length:
@@ -264,7 +377,7 @@ class BCDataStream(object):
 
         length = self.read_compact_size()
 
-        return self.read_bytes(length).decode(encoding)
+        return str(self.read_view(length), encoding)
 
     def write_string(self, string, encoding='ascii'):
         string = to_bytes(string, encoding)
@@ -272,19 +385,19 @@ class BCDataStream(object):
         self.write_compact_size(len(string))
         self.write(string)
 
-    def read_bytes(self, length: int) -> bytes:
-        if self.input is None:
-            raise SerializationError("call write(bytes) before trying to deserialize")
+    def read_view(self, length: int) -> memoryview:
+        """Reads `length` bytes without copying them, the view is only valid until the next write"""
+        view = self.view
         assert length >= 0
-        input_len = len(self.input)
         read_begin = self.read_cursor
         read_end = read_begin + length
-        if 0 <= read_begin <= read_end <= input_len:
-            result = self.input[read_begin:read_end]  # type: bytearray
-            self.read_cursor += length
-            return bytes(result)
-        else:
+        if read_end > len(view):
             raise SerializationError('attempt to read past end of buffer')
+        self.read_cursor = read_end
+        return view[read_begin:read_end]
+
+    def read_bytes(self, length: int) -> bytes:
+        return bytes(self.read_view(length))
 
     def write_bytes(self, _bytes: Union[bytes, bytearray], length: int):
         assert len(_bytes) == length, len(_bytes)
@@ -296,60 +409,61 @@ class BCDataStream(object):
         return self.read_cursor < len(self.input)
 
     def read_boolean(self) -> bool:
-        return self.read_bytes(1) != b'\x00'
+        return self.read_view(1)[0] != 0
 
     def read_int16(self):
-        return self._read_num('<h')
+        return self._read_num(_INT16)
 
     def read_uint16(self):
-        return self._read_num('<H')
+        return self._read_num(_UINT16)
 
     def read_int32(self):
-        return self._read_num('<i')
+        return self._read_num(_INT32)
 
     def read_uint32(self):
-        return self._read_num('<I')
+        return self._read_num(_UINT32)
 
     def read_int64(self):
-        return self._read_num('<q')
+        return self._read_num(_INT64)
 
     def read_uint64(self):
-        return self._read_num('<Q')
+        return self._read_num(_UINT64)
 
     def write_boolean(self, val):
         return self.write(b'\x01' if val else b'\x00')
 
     def write_int16(self, val):
-        return self._write_num('<h', val)
+        return self._write_num(_INT16, val)
 
     def write_uint16(self, val):
-        return self._write_num('<H', val)
+        return self._write_num(_UINT16, val)
 
     def write_int32(self, val):
-        return self._write_num('<i', val)
+        return self._write_num(_INT32, val)
 
     def write_uint32(self, val):
-        return self._write_num('<I', val)
+        return self._write_num(_UINT32, val)
 
     def write_int64(self, val):
-        return self._write_num('<q', val)
+        return self._write_num(_INT64, val)
 
     def write_uint64(self, val):
-        return self._write_num('<Q', val)
+        return self._write_num(_UINT64, val)
 
     def read_compact_size(self):
+        view = self.view
         try:
-            size = self.input[self.read_cursor]
-            self.read_cursor += 1
-            if size == 253:
-                size = self._read_num('<H')
-            elif size == 254:
-                size = self._read_num('<I')
-            elif size == 255:
-                size = self._read_num('<Q')
-            return size
+            size = view[self.read_cursor]
         except IndexError as e:
             raise SerializationError("attempt to read past end of buffer") from e
+        self.read_cursor += 1
+        if size == 253:
+            size = self._read_num(_UINT16)
+        elif size == 254:
+            size = self._read_num(_UINT32)
+        elif size == 255:
+            size = self._read_num(_UINT64)
+        return size
 
     def write_compact_size(self, size):
         if size < 0:
@@ -358,27 +472,26 @@ class BCDataStream(object):
             self.write(bytes([size]))
         elif size < 2 ** 16:
             self.write(b'\xfd')
-            self._write_num('<H', size)
+            self._write_num(_UINT16, size)
         elif size < 2 ** 32:
             self.write(b'\xfe')
-            self._write_num('<I', size)
+            self._write_num(_UINT32, size)
         elif size < 2 ** 64:
             self.write(b'\xff')
-            self._write_num('<Q', size)
+            self._write_num(_UINT64, size)
         else:
             raise Exception(f"size {size} too large for compact_size")
 
-    def _read_num(self, format):
+    def _read_num(self, fmt: struct.Struct):
         try:
-            (i,) = struct.unpack_from(format, self.input, self.read_cursor)
-            self.read_cursor += struct.calcsize(format)
-        except Exception as e:
+            (i,) = fmt.unpack_from(self.view, self.read_cursor)
+        except struct.error as e:
             raise SerializationError(e) from e
+        self.read_cursor += fmt.size
         return i
 
-    def _write_num(self, format, num):
-        s = struct.pack(format, num)
-        self.write(s)
+    def _write_num(self, fmt: struct.Struct, num):
+        self.write(fmt.pack(num))
 
 
 def script_GetOp(_bytes: bytes):
@@ -512,7 +625,7 @@ def get_address_from_output_script(_bytes: bytes, *, net=None) -> Optional[str]:
 
 
 def parse_input(vds: BCDataStream) -> TxInput:
-    prevout_hash = vds.read_bytes(32)[::-1]
+    prevout_hash = bytes(vds.read_view(32)[::-1])
     prevout_n = vds.read_uint32()
     prevout = TxOutpoint(txid=prevout_hash, out_idx=prevout_n)
     script_sig = vds.read_bytes(vds.read_compact_size())
@@ -521,9 +634,12 @@ def parse_input(vds: BCDataStream) -> TxInput:
 
 
 def parse_witness(vds: BCDataStream, txin: TxInput) -> None:
+    # The serialized witness is kept as is, compact sizes are canonical in valid transactions
+    start = vds.read_cursor
     n = vds.read_compact_size()
-    witness_elements = list(vds.read_bytes(vds.read_compact_size()) for i in range(n))
-    txin.witness = bytes.fromhex(construct_witness(witness_elements))
+    for i in range(n):
+        vds.read_view(vds.read_compact_size())
+    txin.witness = bytes(vds.view[start:vds.read_cursor])
 
 
 def parse_output(vds: BCDataStream) -> TxOutput:
@@ -545,7 +661,7 @@ def multisig_script(public_keys: Sequence[str], m: int) -> str:
 
 
 class Transaction:
-    _cached_network_ser: Optional[str]
+    _cached_network_ser: Optional[bytes]
 
     def __str__(self):
         return self.serialize()
@@ -554,10 +670,11 @@ class Transaction:
         if raw is None:
             self._cached_network_ser = None
         elif isinstance(raw, str):
-            self._cached_network_ser = raw.strip() if raw else None
-            assert is_hex_str(self._cached_network_ser)
+            raw = raw.strip()
+            assert is_hex_str(raw)
+            self._cached_network_ser = bytes.fromhex(raw) if raw else None
         elif isinstance(raw, (bytes, bytearray)):
-            self._cached_network_ser = raw.hex()
+            self._cached_network_ser = bytes(raw)
         else:
             raise Exception(f"cannot initialize transaction from {raw}")
         self._inputs = None  # type: List[TxInput]
@@ -612,9 +729,7 @@ class Transaction:
         if self._inputs is not None:
             return
 
-        raw_bytes = bytes.fromhex(self._cached_network_ser)
-        vds = BCDataStream()
-        vds.write(raw_bytes)
+        vds = BCDataStream(self._cached_network_ser)
         self._version = vds.read_int32()
         n_vin = vds.read_compact_size()
         is_segwit = (n_vin == 0)
@@ -750,6 +865,29 @@ class Transaction:
             return construct_script([redeem_script])
         raise UnknownTxinType(f'cannot construct scriptSig for txin_type: {_type}')
 
+    @classmethod
+    def estimated_input_script_size(cls, txin: TxInput) -> int:
+        """`len(input_script_bytes(txin, estimate_size=True))`, counted without building the script for the
+        pre-segwit script types"""
+        if txin.script_sig is not None:
+            return len(txin.script_sig)
+        if txin.is_coinbase_input():
+            return 0
+        assert isinstance(txin, PartialTxInput)
+
+        if not ((txin.is_p2sh_segwit() and txin.redeem_script) or txin.is_native_segwit()):
+            # signatures are guessed to be 72 bytes long, as in get_siglist
+            pubkey_size = len(txin.pubkeys[0]) if txin.pubkeys else 33
+            if txin.script_type == 'p2pk':
+                return push_size(72)
+            if txin.script_type == 'p2pkh':
+                return push_size(72) + push_size(pubkey_size)
+            if txin.script_type == 'p2sh' and 1 <= txin.num_sig <= len(txin.pubkeys) <= 15:
+                # OP_0, the signatures, and the redeem script: OP_m, the pubkeys, OP_n, OP_CHECKMULTISIG
+                redeem_script_size = 3 + len(txin.pubkeys) * push_size(pubkey_size)
+                return 1 + txin.num_sig * push_size(72) + push_size(redeem_script_size)
+        return len(cls.input_script_bytes(txin, estimate_size=True))
+
     @classmethod
     def get_preimage_script(cls, txin: 'PartialTxInput') -> str:
         if txin.witness_script:
@@ -774,22 +912,33 @@ class Transaction:
         else:
             raise UnknownTxinType(f'cannot construct preimage_script for txin_type: {txin.script_type}')
 
+    @classmethod
+    def input_script_bytes(cls, txin: TxInput, *, estimate_size=False) -> bytes:
+        if txin.script_sig is not None:
+            return txin.script_sig
+        return bytes.fromhex(cls.input_script(txin, estimate_size=estimate_size))
+
+    @classmethod
+    def witness_bytes(cls, txin: TxInput, *, estimate_size=False) -> bytes:
+        if txin.witness is not None:
+            return txin.witness
+        return bytes.fromhex(cls.serialize_witness(txin, estimate_size=estimate_size))
+
     @classmethod
     def serialize_input(cls, txin: TxInput, script: str) -> str:
-        # Prev hash and index
-        s = txin.prevout.serialize_to_network().hex()
-        # Script length, script, sequence
-        s += var_int(len(script) // 2)
-        s += script
-        s += int_to_hex(txin.nsequence, 4)
-        return s
+        return cls.serialize_input_bytes(txin, bytes.fromhex(script)).hex()
+
+    @classmethod
+    def serialize_input_bytes(cls, txin: TxInput, script: bytes) -> bytes:
+        # Prev hash and index, script length, script, sequence
+        return txin.prevout.serialize_to_network() + compact_size(len(script)) + script + _UINT32.pack(txin.nsequence)
 
     def _calc_bip143_shared_txdigest_fields(self) -> BIP143SharedTxDigestFields:
         inputs = self.inputs()
         outputs = self.outputs()
-        hashPrevouts = bh2u(sha256d(b''.join(txin.prevout.serialize_to_network() for txin in inputs)))
-        hashSequence = bh2u(sha256d(bytes.fromhex(''.join(int_to_hex(txin.nsequence, 4) for txin in inputs))))
-        hashOutputs = bh2u(sha256d(bytes.fromhex(''.join(o.serialize_to_network().hex() for o in outputs))))
+        hashPrevouts = sha256d(b''.join(txin.prevout.serialize_to_network() for txin in inputs))
+        hashSequence = sha256d(b''.join(_UINT32.pack(txin.nsequence) for txin in inputs))
+        hashOutputs = sha256d(b''.join(o.serialize_to_network() for o in outputs))
         return BIP143SharedTxDigestFields(hashPrevouts=hashPrevouts,
                                           hashSequence=hashSequence,
                                           hashOutputs=hashOutputs)
@@ -803,12 +952,12 @@ class Transaction:
         self._cached_txid = None
 
     def serialize(self) -> str:
-        if not self._cached_network_ser:
-            self._cached_network_ser = self.serialize_to_network(estimate_size=False, include_sigs=True)
-        return self._cached_network_ser
+        return Transaction.serialize_as_bytes(self).hex()
 
     def serialize_as_bytes(self) -> bytes:
-        return bytes.fromhex(self.serialize())
+        if not self._cached_network_ser:
+            self._cached_network_ser = self.serialize_to_network_bytes(estimate_size=False, include_sigs=True)
+        return self._cached_network_ser
 
     def serialize_to_network(self, *, estimate_size=False, include_sigs=True, force_legacy=False) -> str:
         """Serialize the transaction as used on the Bitcoin network, into hex.
@@ -816,31 +965,36 @@ class Transaction:
         `force_legacy` signals to use the pre-segwit format
         note: (not include_sigs) implies force_legacy
         """
+        return self.serialize_to_network_bytes(estimate_size=estimate_size, include_sigs=include_sigs,
+                                               force_legacy=force_legacy).hex()
+
+    def serialize_to_network_bytes(self, *, estimate_size=False, include_sigs=True, force_legacy=False) -> bytes:
+        """Same as `serialize_to_network`, into bytes"""
         self.deserialize()
-        nVersion = int_to_hex(self.version, 4)
-        nLocktime = int_to_hex(self.locktime, 4)
         inputs = self.inputs()
         outputs = self.outputs()
 
-        def create_script_sig(txin: TxInput) -> str:
-            if include_sigs:
-                return self.input_script(txin, estimate_size=estimate_size)
-            return ''
-
-        txins = var_int(len(inputs)) + ''.join(self.serialize_input(txin, create_script_sig(txin))
-                                               for txin in inputs)
-        txouts = var_int(len(outputs)) + ''.join(o.serialize_to_network().hex() for o in outputs)
-
         use_segwit_ser_for_estimate_size = estimate_size and self.is_segwit(guess_for_address=True)
         use_segwit_ser_for_actual_use = not estimate_size and self.is_segwit()
         use_segwit_ser = use_segwit_ser_for_estimate_size or use_segwit_ser_for_actual_use
-        if include_sigs and not force_legacy and use_segwit_ser:
-            marker = '00'
-            flag = '01'
-            witness = ''.join(self.serialize_witness(x, estimate_size=estimate_size) for x in inputs)
-            return nVersion + marker + flag + txins + txouts + witness + nLocktime
-        else:
-            return nVersion + txins + txouts + nLocktime
+        use_segwit_ser = include_sigs and not force_legacy and use_segwit_ser
+
+        buf = io.BytesIO()
+        buf.write(int32_to_bytes(self.version))
+        if use_segwit_ser:
+            buf.write(b'\x00\x01')  # marker, flag
+        buf.write(compact_size(len(inputs)))
+        for txin in inputs:
+            script_sig = self.input_script_bytes(txin, estimate_size=estimate_size) if include_sigs else b''
+            buf.write(self.serialize_input_bytes(txin, script_sig))
+        buf.write(compact_size(len(outputs)))
+        for o in outputs:
+            buf.write(o.serialize_to_network())
+        if use_segwit_ser:
+            for txin in inputs:
+                buf.write(self.witness_bytes(txin, estimate_size=estimate_size))
+        buf.write(_UINT32.pack(self.locktime))
+        return buf.getvalue()
 
     def to_qr_data(self) -> str:
         """Returns tx as data to be put into a QR code. No side-effects."""
@@ -858,11 +1012,11 @@ class Transaction:
             if not all_segwit and not self.is_complete():
                 return None
             try:
-                ser = self.serialize_to_network(force_legacy=True)
+                ser = self.serialize_to_network_bytes(force_legacy=True)
             except UnknownTxinType:
                 # we might not know how to construct scriptSig for some scripts
                 return None
-            self._cached_txid = bh2u(sha256d(bytes.fromhex(ser))[::-1])
+            self._cached_txid = sha256d(ser)[::-1].hex()
         return self._cached_txid
 
     def wtxid(self) -> Optional[str]:
@@ -870,11 +1024,11 @@ class Transaction:
         if not self.is_complete():
             return None
         try:
-            ser = self.serialize_to_network()
+            ser = self.serialize_to_network_bytes()
         except UnknownTxinType:
             # we might not know how to construct scriptSig/witness for some scripts
             return None
-        return bh2u(sha256d(bytes.fromhex(ser))[::-1])
+        return sha256d(ser)[::-1].hex()
 
     def add_info_from_wallet(self, wallet: 'Abstract_Wallet', **kwargs) -> None:
         return  # no-op
@@ -893,18 +1047,35 @@ class Transaction:
         if net.segwit:
             weight = self.estimated_weight()
             return self.virtual_size_from_weight(weight)
+        elif self.is_complete():
+            return len(Transaction.serialize_as_bytes(self))
         else:
-            return (len(self.serialize()) // 2 if not self.is_complete() or self._cached_network_ser is None
-                    else len(self._cached_network_ser) // 2)  # ASCII hex string
+            return self.estimated_legacy_size()
+
+    def estimated_legacy_size(self) -> int:
+        """Return the estimated size in bytes of a transaction without witnesses, the length of
+        `serialize_to_network_bytes(estimate_size=True)` counted from the input script types and output scripts"""
+        self.deserialize()
+        inputs = self.inputs()
+        outputs = self.outputs()
+        # version, locktime and the input and output counts
+        size = 8 + compact_size_len(len(inputs)) + compact_size_len(len(outputs))
+        for txin in inputs:
+            script_size = self.estimated_input_script_size(txin)
+            # outpoint, script and sequence
+            size += 40 + compact_size_len(script_size) + script_size
+        for o in outputs:
+            size += 8 + compact_size_len(len(o.scriptpubkey)) + len(o.scriptpubkey)
+        return size
 
     @classmethod
     def estimated_input_weight(cls, txin, is_segwit_tx):
         """Return an estimate of serialized input weight in weight units."""
-        script = cls.input_script(txin, estimate_size=True)
-        input_size = len(cls.serialize_input(txin, script)) // 2
+        script = cls.input_script_bytes(txin, estimate_size=True)
+        input_size = len(cls.serialize_input_bytes(txin, script))
 
         if txin.is_segwit(guess_for_address=True):
-            witness_size = len(cls.serialize_witness(txin, estimate_size=True)) // 2
+            witness_size = len(cls.witness_bytes(txin, estimate_size=True))
         else:
             witness_size = 1 if is_segwit_tx else 0
 
@@ -924,9 +1095,9 @@ class Transaction:
     def estimated_total_size(self):
         """Return an estimated total transaction size in bytes."""
         if not self.is_complete() or self._cached_network_ser is None:
-            return len(self.serialize_to_network(estimate_size=True)) // 2
+            return len(self.serialize_to_network_bytes(estimate_size=True))
         else:
-            return len(self._cached_network_ser) // 2  # ASCII hex string
+            return len(self._cached_network_ser)
 
     def estimated_witness_size(self):
         """Return an estimate of witness size in bytes."""
@@ -934,8 +1105,8 @@ class Transaction:
         if not self.is_segwit(guess_for_address=estimate):
             return 0
         inputs = self.inputs()
-        witness = ''.join(self.serialize_witness(x, estimate_size=estimate) for x in inputs)
-        witness_size = len(witness) // 2 + 2  # include marker and flag
+        witness_size = sum(len(self.witness_bytes(x, estimate_size=estimate)) for x in inputs)
+        witness_size += 2  # include marker and flag
         return witness_size
 
     def estimated_base_size(self):
@@ -1117,9 +1288,9 @@ class PSBTSection:
     def create_psbt_writer(cls, fd):
         def wr(key_type: int, val: bytes, key: bytes = b''):
             full_key = cls.get_fullkey_from_keytype_and_key(key_type, key)
-            fd.write(bytes.fromhex(var_int(len(full_key))))  # key_size
+            fd.write(compact_size(len(full_key)))  # key_size
             fd.write(full_key)  # key
-            fd.write(bytes.fromhex(var_int(len(val))))  # val_size
+            fd.write(compact_size(len(val)))  # val_size
             fd.write(val)  # val
 
         return wr
@@ -1134,7 +1305,7 @@ class PSBTSection:
 
     @classmethod
     def get_fullkey_from_keytype_and_key(cls, key_type: int, key: bytes) -> bytes:
-        key_type_bytes = bytes.fromhex(var_int(key_type))
+        key_type_bytes = compact_size(key_type)
         return key_type_bytes + key
 
     def _serialize_psbt_section(self, fd):
@@ -1322,7 +1493,7 @@ class PartialTxInput(TxInput, PSBTSection):
         if self.witness_utxo:
             wr(PSBTInputType.WITNESS_UTXO, self.witness_utxo.serialize_to_network())
         if self.utxo:
-            wr(PSBTInputType.NON_WITNESS_UTXO, bytes.fromhex(self.utxo.serialize_to_network(include_sigs=True)))
+            wr(PSBTInputType.NON_WITNESS_UTXO, self.utxo.serialize_to_network_bytes(include_sigs=True))
         for pk, val in sorted(self.part_sigs.items()):
             wr(PSBTInputType.PARTIAL_SIG, val, pk)
         if self.sighash is not None:
@@ -1422,8 +1593,8 @@ class PartialTxInput(TxInput, PSBTSection):
             clear_fields_when_finalized()
             return  # already finalized
         if self.is_complete():
-            self.script_sig = bytes.fromhex(Transaction.input_script(self))
-            self.witness = bytes.fromhex(Transaction.serialize_witness(self))
+            self.script_sig = Transaction.input_script_bytes(self)
+            self.witness = Transaction.witness_bytes(self)
             clear_fields_when_finalized()
 
     def combine_with_other_txin(self, other_txin: 'TxInput') -> None:
@@ -1643,85 +1814,86 @@ class PartialTransaction(Transaction):
         # We parse the raw stream twice. The first pass is used to find the
         # PSBT_GLOBAL_UNSIGNED_TX key in the global section and set 'tx'.
         # The second pass does everything else.
-        with io.BytesIO(raw[5:]) as fd:  # parsing "first pass"
-            while True:
-                try:
-                    kt, key, val = PSBTSection.get_next_kv_from_fd(fd)
-                except StopIteration:
-                    break
-                try:
-                    kt = PSBTGlobalType(kt)
-                except ValueError:
-                    pass  # unknown type
-                if kt == PSBTGlobalType.UNSIGNED_TX:
-                    if tx is not None:
-                        raise SerializationError(f"duplicate key: {repr(kt)}")
-                    if key: raise SerializationError(f"key for {repr(kt)} must be empty")
-                    unsigned_tx = Transaction(val.hex())
-                    for txin in unsigned_tx.inputs():
-                        if txin.script_sig or txin.witness:
-                            raise SerializationError(f"PSBT {repr(kt)} must have empty scriptSigs and witnesses")
-                    tx = PartialTransaction.from_tx(unsigned_tx)
+        psbt = memoryview(raw)[5:]
+        fd = BCDataStream(psbt)  # parsing "first pass"
+        while True:
+            try:
+                kt, key, val = PSBTSection.get_next_kv_from_fd(fd)
+            except StopIteration:
+                break
+            try:
+                kt = PSBTGlobalType(kt)
+            except ValueError:
+                pass  # unknown type
+            if kt == PSBTGlobalType.UNSIGNED_TX:
+                if tx is not None:
+                    raise SerializationError(f"duplicate key: {repr(kt)}")
+                if key: raise SerializationError(f"key for {repr(kt)} must be empty")
+                unsigned_tx = Transaction(val)
+                for txin in unsigned_tx.inputs():
+                    if txin.script_sig or txin.witness:
+                        raise SerializationError(f"PSBT {repr(kt)} must have empty scriptSigs and witnesses")
+                tx = PartialTransaction.from_tx(unsigned_tx)
 
         if tx is None:
             raise SerializationError(f"PSBT missing required global section PSBT_GLOBAL_UNSIGNED_TX")
 
-        with io.BytesIO(raw[5:]) as fd:  # parsing "second pass"
-            # global section
-            while True:
-                try:
-                    kt, key, val = PSBTSection.get_next_kv_from_fd(fd)
-                except StopIteration:
-                    break
-                try:
-                    kt = PSBTGlobalType(kt)
-                except ValueError:
-                    pass  # unknown type
-                if DEBUG_PSBT_PARSING: print(f"{repr(kt)} {key.hex()} {val.hex()}")
-                if kt == PSBTGlobalType.UNSIGNED_TX:
-                    pass  # already handled during "first" parsing pass
-                elif kt == PSBTGlobalType.XPUB:
-                    bip32node = BIP32Node.from_bytes(key)
-                    if bip32node in tx.xpubs:
-                        raise SerializationError(f"duplicate key: {repr(kt)}")
-                    xfp, path = unpack_bip32_root_fingerprint_and_int_path(val)
-                    if bip32node.depth != len(path):
-                        raise SerializationError(f"PSBT global xpub has mismatching depth ({bip32node.depth}) "
-                                                 f"and derivation prefix len ({len(path)})")
-                    child_number_of_xpub = int.from_bytes(bip32node.child_number, 'big')
-                    if not ((bip32node.depth == 0 and child_number_of_xpub == 0)
-                            or (bip32node.depth != 0 and child_number_of_xpub == path[-1])):
-                        raise SerializationError(
-                            f"PSBT global xpub has inconsistent child_number and derivation prefix")
-                    tx.xpubs[bip32node] = xfp, path
-                elif kt == PSBTGlobalType.VERSION:
-                    if len(val) > 4:
-                        raise SerializationError(f"value for {repr(kt)} has unexpected length: {len(val)} > 4")
-                    psbt_version = int.from_bytes(val, byteorder='little', signed=False)
-                    if psbt_version > 0:
-                        raise SerializationError(
-                            f"Only PSBTs with version 0 are supported. Found version: {psbt_version}")
-                    if key: raise SerializationError(f"key for {repr(kt)} must be empty")
-                else:
-                    full_key = PSBTSection.get_fullkey_from_keytype_and_key(kt, key)
-                    if full_key in tx._unknown:
-                        raise SerializationError(f'duplicate key. PSBT global key for unknown type: {full_key}')
-                    tx._unknown[full_key] = val
+        fd = BCDataStream(psbt)  # parsing "second pass"
+        # global section
+        while True:
+            try:
+                kt, key, val = PSBTSection.get_next_kv_from_fd(fd)
+            except StopIteration:
+                break
             try:
-                # inputs sections
-                for txin in tx.inputs():
-                    if DEBUG_PSBT_PARSING: print("-> new input starts")
-                    txin._populate_psbt_fields_from_fd(fd)
-                # outputs sections
-                for txout in tx.outputs():
-                    if DEBUG_PSBT_PARSING: print("-> new output starts")
-                    txout._populate_psbt_fields_from_fd(fd)
-            except UnexpectedEndOfStream:
-                raise UnexpectedEndOfStream(
-                    'Unexpected end of stream. Num input and output maps provided does not match unsigned tx.') from None
-
-            if fd.read(1) != b'':
-                raise SerializationError("extra junk at the end of PSBT")
+                kt = PSBTGlobalType(kt)
+            except ValueError:
+                pass  # unknown type
+            if DEBUG_PSBT_PARSING: print(f"{repr(kt)} {key.hex()} {val.hex()}")
+            if kt == PSBTGlobalType.UNSIGNED_TX:
+                pass  # already handled during "first" parsing pass
+            elif kt == PSBTGlobalType.XPUB:
+                bip32node = BIP32Node.from_bytes(key)
+                if bip32node in tx.xpubs:
+                    raise SerializationError(f"duplicate key: {repr(kt)}")
+                xfp, path = unpack_bip32_root_fingerprint_and_int_path(val)
+                if bip32node.depth != len(path):
+                    raise SerializationError(f"PSBT global xpub has mismatching depth ({bip32node.depth}) "
+                                             f"and derivation prefix len ({len(path)})")
+                child_number_of_xpub = int.from_bytes(bip32node.child_number, 'big')
+                if not ((bip32node.depth == 0 and child_number_of_xpub == 0)
+                        or (bip32node.depth != 0 and child_number_of_xpub == path[-1])):
+                    raise SerializationError(
+                        f"PSBT global xpub has inconsistent child_number and derivation prefix")
+                tx.xpubs[bip32node] = xfp, path
+            elif kt == PSBTGlobalType.VERSION:
+                if len(val) > 4:
+                    raise SerializationError(f"value for {repr(kt)} has unexpected length: {len(val)} > 4")
+                psbt_version = int.from_bytes(val, byteorder='little', signed=False)
+                if psbt_version > 0:
+                    raise SerializationError(
+                        f"Only PSBTs with version 0 are supported. Found version: {psbt_version}")
+                if key: raise SerializationError(f"key for {repr(kt)} must be empty")
+            else:
+                full_key = PSBTSection.get_fullkey_from_keytype_and_key(kt, key)
+                if full_key in tx._unknown:
+                    raise SerializationError(f'duplicate key. PSBT global key for unknown type: {full_key}')
+                tx._unknown[full_key] = val
+        try:
+            # inputs sections
+            for txin in tx.inputs():
+                if DEBUG_PSBT_PARSING: print("-> new input starts")
+                txin._populate_psbt_fields_from_fd(fd)
+            # outputs sections
+            for txout in tx.outputs():
+                if DEBUG_PSBT_PARSING: print("-> new output starts")
+                txout._populate_psbt_fields_from_fd(fd)
+        except UnexpectedEndOfStream:
+            raise UnexpectedEndOfStream(
+                'Unexpected end of stream. Num input and output maps provided does not match unsigned tx.') from None
+
+        if fd.read(1) != b'':
+            raise SerializationError("extra junk at the end of PSBT")
 
         for txin in tx.inputs():
             txin.validate_data()
@@ -1745,7 +1917,7 @@ class PartialTransaction(Transaction):
         wr = PSBTSection.create_psbt_writer(fd)
         fd.write(b'psbt\xff')
         # global section
-        wr(PSBTGlobalType.UNSIGNED_TX, bytes.fromhex(self.serialize_to_network(include_sigs=False)))
+        wr(PSBTGlobalType.UNSIGNED_TX, self.serialize_to_network_bytes(include_sigs=False))
         for bip32node, (xfp, path) in sorted(self.xpubs.items()):
             val = pack_bip32_root_fingerprint_and_int_path(xfp, path)
             wr(PSBTGlobalType.XPUB, val, key=bip32node.to_bytes())
@@ -1768,7 +1940,8 @@ class PartialTransaction(Transaction):
         """Pulls in all data from other_tx we don't yet have (e.g. signatures).
         other_tx must be concerning the same unsigned tx.
         """
-        if self.serialize_to_network(include_sigs=False) != other_tx.serialize_to_network(include_sigs=False):
+        if (self.serialize_to_network_bytes(include_sigs=False)
+                != other_tx.serialize_to_network_bytes(include_sigs=False)):
             raise Exception('A Combiner must not combine two different PSBTs.')
         # BIP-174: "The resulting PSBT must contain all of the key-value pairs from each of the PSBTs.
         #           The Combiner must remove any duplicate key-value pairs, in accordance with the specification."
@@ -1851,15 +2024,22 @@ class PartialTransaction(Transaction):
             return None
 
     def serialize_preimage(self, txin_index: int, net: CoinNetwork, *,
-                           bip143_shared_txdigest_fields: BIP143SharedTxDigestFields = None) -> str:
-        inputs = self.inputs()
-        outputs = self.outputs()
-        txin = inputs[txin_index]
+                           bip143_shared_txdigest_fields: BIP143SharedTxDigestFields = None,
+                           legacy_preimage_parts: LegacyPreimageParts = None) -> str:
+        return self.serialize_preimage_bytes(txin_index, net,
+                                             bip143_shared_txdigest_fields=bip143_shared_txdigest_fields,
+                                             legacy_preimage_parts=legacy_preimage_parts).hex()
+
+    def serialize_preimage_bytes(self, txin_index: int, net: CoinNetwork, *,
+                                 bip143_shared_txdigest_fields: BIP143SharedTxDigestFields = None,
+                                 legacy_preimage_parts: LegacyPreimageParts = None) -> bytes:
+        txin = self.inputs()[txin_index]
 
-        nVersion = int_to_hex(self.version, 4)
-        nLocktime = int_to_hex(self.locktime, 4)
-        nHashType = int_to_hex(txin.sighash if txin.sighash is not None else net.SIGHASH_FLAG, 4)
-        preimage_script = self.get_preimage_script(txin)
+        nVersion = int32_to_bytes(self.version)
+        nLocktime = _UINT32.pack(self.locktime)
+        hash_type = txin.sighash if txin.sighash is not None else net.SIGHASH_FLAG
+        nHashType = _UINT32.pack(hash_type)
+        preimage_script = bytes.fromhex(self.get_preimage_script(txin))
         if txin.is_segwit() or net.symbol in ('BCH', 'tBCH'):
 
             if bip143_shared_txdigest_fields is None:
@@ -1867,22 +2047,35 @@ class PartialTransaction(Transaction):
             hashPrevouts = bip143_shared_txdigest_fields.hashPrevouts
             hashSequence = bip143_shared_txdigest_fields.hashSequence
             hashOutputs = bip143_shared_txdigest_fields.hashOutputs
-            outpoint = txin.prevout.serialize_to_network().hex()
-            scriptCode = var_int(len(preimage_script) // 2) + preimage_script
-            amount = int_to_hex(txin.value_sats(), 8)
-            nSequence = int_to_hex(txin.nsequence, 4)
-            preimage = nVersion + hashPrevouts + hashSequence + outpoint + scriptCode + amount + nSequence + \
-                       hashOutputs + nLocktime + nHashType
+            outpoint = txin.prevout.serialize_to_network()
+            scriptCode = compact_size(len(preimage_script)) + preimage_script
+            amount = _UINT64.pack(txin.value_sats())
+            nSequence = _UINT32.pack(txin.nsequence)
+            preimage = b''.join((nVersion, hashPrevouts, hashSequence, outpoint, scriptCode, amount, nSequence,
+                                 hashOutputs, nLocktime, nHashType))
         else:
-            txins = var_int(len(inputs)) + ''.join(
-                self.serialize_input(txin, preimage_script if txin_index == k else '') for k, txin in enumerate(inputs))
-            txouts = var_int(len(outputs)) + ''.join(o.serialize_to_network().hex() for o in outputs)
-            preimage = nVersion + txins + txouts + nLocktime + nHashType
+            if legacy_preimage_parts is None:
+                legacy_preimage_parts = LegacyPreimageParts(self)
+            preimage = legacy_preimage_parts.preimage(txin_index, preimage_script, hash_type)
         return preimage
 
+    def signature_hash(self, txin_index: int, net: CoinNetwork, *,
+                       bip143_shared_txdigest_fields: BIP143SharedTxDigestFields = None,
+                       legacy_preimage_parts: LegacyPreimageParts = None) -> bytes:
+        """The hash signed for an input, sha256d of its preimage"""
+        txin = self.inputs()[txin_index]
+        if txin.is_segwit() or net.symbol in ('BCH', 'tBCH'):
+            return sha256d(self.serialize_preimage_bytes(
+                txin_index, net, bip143_shared_txdigest_fields=bip143_shared_txdigest_fields))
+        if legacy_preimage_parts is None:
+            legacy_preimage_parts = LegacyPreimageParts(self)
+        return legacy_preimage_parts.sighash(txin_index, bytes.fromhex(self.get_preimage_script(txin)),
+                                             txin.sighash if txin.sighash is not None else net.SIGHASH_FLAG)
+
     def sign(self, keypairs, net: CoinNetwork) -> None:
         # keypairs:  pubkey_hex -> (secret_bytes, is_compressed)
         bip143_shared_txdigest_fields = self._calc_bip143_shared_txdigest_fields()
+        legacy_preimage_parts = LegacyPreimageParts(self)
         for i, txin in enumerate(self.inputs()):
             pubkeys = [pk.hex() for pk in txin.pubkeys]
             for pubkey in pubkeys:
@@ -1892,21 +2085,22 @@ class PartialTransaction(Transaction):
                     continue
                 logger.info(f"adding signature for {pubkey}")
                 sec, compressed = keypairs[pubkey]
-                sig = self.sign_txin(i, sec, net, bip143_shared_txdigest_fields=bip143_shared_txdigest_fields)
+                sig = self.sign_txin(i, sec, net, bip143_shared_txdigest_fields=bip143_shared_txdigest_fields,
+                                     legacy_preimage_parts=legacy_preimage_parts)
                 self.add_signature_to_txin(txin_idx=i, signing_pubkey=pubkey, sig=sig)
 
         logger.debug(f"is_complete {self.is_complete()}")
         self.invalidate_ser_cache()
 
-    def sign_txin(self, txin_index, privkey_bytes, net: CoinNetwork, *, bip143_shared_txdigest_fields=None) -> str:
+    def sign_txin(self, txin_index, privkey_bytes, net: CoinNetwork, *, bip143_shared_txdigest_fields=None,
+                  legacy_preimage_parts=None) -> str:
         txin = self.inputs()[txin_index]
         txin.validate_data(for_signing=True)
-        pre_hash = sha256d(bytes.fromhex(self.serialize_preimage(txin_index, net,
-                                                                 bip143_shared_txdigest_fields=bip143_shared_txdigest_fields)))
+        pre_hash = self.signature_hash(txin_index, net, bip143_shared_txdigest_fields=bip143_shared_txdigest_fields,
+                                       legacy_preimage_parts=legacy_preimage_parts)
         privkey = ecc.ECPrivkey(privkey_bytes)
         sig = privkey.sign_transaction(pre_hash)
-        sig = bh2u(sig) + int_to_hex(net.SIGHASH_FLAG)[:2]
-        return sig
+        return (sig + bytes((net.SIGHASH_FLAG & 0xff,))).hex()
 
     def is_complete(self) -> bool:
         return all([txin.is_complete() for txin in self.inputs()])
@@ -1954,12 +2148,15 @@ class PartialTransaction(Transaction):
             return
         if len(self.inputs()) != len(signatures):
             raise Exception('expected {} signatures; got {}'.format(len(self.inputs()), len(signatures)))
+        bip143_shared_txdigest_fields = self._calc_bip143_shared_txdigest_fields()
+        legacy_preimage_parts = LegacyPreimageParts(self)
         for i, txin in enumerate(self.inputs()):
             pubkeys = [pk.hex() for pk in txin.pubkeys]
             sig = signatures[i]
             if bytes.fromhex(sig) in list(txin.part_sigs.values()):
                 continue
-            pre_hash = sha256d(bytes.fromhex(self.serialize_preimage(i, net)))
+            pre_hash = self.signature_hash(i, net, bip143_shared_txdigest_fields=bip143_shared_txdigest_fields,
+                                           legacy_preimage_parts=legacy_preimage_parts)
             sig_string = ecc.sig_string_from_der_sig(bytes.fromhex(sig[:-2]))
             for recid in range(4):
                 try:
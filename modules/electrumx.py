@@ -1,22 +1,26 @@
 import asyncio
+import atexit
 import datetime
+import gzip
+import hashlib
 import itertools
 import json
 import random
 import socket
 import ssl
+import time
 import traceback
 from collections import defaultdict
 from pathlib import Path
-from typing import List, Optional
+from typing import List, Optional, Dict, Any
 
 import aiorpcx
 from aiorpcx import SOCKSProxy, SOCKSFailure
 from aiorpcx.jsonrpc import ProtocolError, Notification, CodeMessageError
 from aiorpcx.rawsocket import RSClient
-from sqlalchemy import and_
+from sqlalchemy import and_, select, bindparam
 
-from modules.helpers import read_json, to_json, EPOCH
+from modules.helpers import read_json, EPOCH
 from modules.logging import logger
 from modules.models import ElectrumServer, database
 from modules import config
@@ -30,27 +34,330 @@ class NoServersError(ElectrumError):
     pass
 
 
+class UnsupportedMethodError(ElectrumError):
+    pass
+
+
+class DeadlineExceeded(ElectrumError):
+    pass
+
+
+class IncapableServerError(ElectrumError):
+    pass
+
+
+def scripthash_status(history: List[dict]) -> Optional[str]:
+    """
+    Computes the electrum status hash of a scripthash history (as returned by `blockchain.scripthash.get_history`),
+    this is the value sent by the server in `blockchain.scripthash.subscribe` notifications
+    """
+    if not history:
+        return None
+    status = "".join(f"{x['tx_hash']}:{x['height']:d}:" for x in history)
+    return hashlib.sha256(status.encode('ascii')).hexdigest()
+
+
+def project_history(history: List[dict], mempool: List[dict], height: int) -> List[dict]:
+    """
+    Best guess of a scripthash history given its current mempool (as returned by `blockchain.scripthash.get_mempool`),
+    assuming the confirmed part hasn't changed and previously unconfirmed transactions that have left the mempool were
+    mined at `height`. The guess has to be checked against the status hash sent by the server
+    """
+    in_mempool = {x['tx_hash'] for x in mempool}
+    confirmed = [x for x in history if x['height'] > 0]
+    mined = [{'tx_hash': x['tx_hash'], 'height': height} for x in history
+             if x['height'] <= 0 and x['tx_hash'] not in in_mempool]
+    return confirmed + mined + [{k: v for k, v in x.items() if k in ('tx_hash', 'height', 'fee')} for x in mempool]
+
+
+# Default size of subscription consumer queues, see `SubscriptionMux`
+SUBSCRIPTION_QUEUE_SIZE = 16
+# Default cap of a single incoming message, in bytes. 1mb is used for electrum
+MAX_MESSAGE_SIZE = 1_000_000
+
+CLIENT_NAME = "tuxpay"
+PROTOCOL_MIN = "1.4"
+PROTOCOL_MAX = "1.4.2"
+# Largest number of requests sent in a single batch
+MAX_BATCH_SIZE = 100
+
+
+class Capability:
+    VERBOSE_TX = "verbose_tx"
+    BATCH = "batch"
+    SCRIPTHASH_UNSUBSCRIBE = "scripthash_unsubscribe"
+    MEMPOOL = "mempool"
+
+
+def protocol_tuple(version: str) -> tuple:
+    try:
+        return tuple(int(x) for x in str(version).split("."))
+    except ValueError:
+        return 0,
+
+
+def server_capabilities(software: str, protocol: str) -> set:
+    """
+    Works out the optional features a server supports from its `server.version` response
+    """
+    capabilities = {Capability.BATCH, Capability.MEMPOOL}
+    # electrs doesn't index full transactions, so it can't return them verbose
+    if not str(software).lower().startswith("electrs"):
+        capabilities.add(Capability.VERBOSE_TX)
+    if protocol_tuple(protocol) >= (1, 4, 2):
+        capabilities.add(Capability.SCRIPTHASH_UNSUBSCRIBE)
+    return capabilities
+
+
+# Delay (in seconds) before the next candidate server is dialed while connecting, see `ElectrumX.race_sessions`
+CONNECT_STAGGER = 0.25
+
+# Propagation checks after a broadcast has been accepted, see `ElectrumX.broadcast`
+PROPAGATION_CHECKS = 5
+PROPAGATION_INTERVAL = 2
+
+# The mutable columns of a saved server, written by a single `execute_many` in `ElectrumX.save_server_list`. `databases`
+# applies each row to a Core statement with `.values()`, which can't bind a per-row WHERE clause, so the statement is
+# compiled to (portable) sql once, and the rows are bound to it as is
+SERVER_COLUMNS = [c.name for c in ElectrumServer.c if c.name not in ('id', 'symbol', 'host')]
+SERVER_UPDATE = str(ElectrumServer.update()
+                    .where(ElectrumServer.c.id == bindparam('server_id'))
+                    .values({c: bindparam(c) for c in SERVER_COLUMNS}))
+
+# Retry backoff (in seconds) - doubles with every attempt, up to the cap
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30
+
+
+def backoff_delay(attempt: int) -> float:
+    """
+    Exponential backoff with jitter, `attempt` starts at 1
+    """
+    return min(BACKOFF_CAP, BACKOFF_BASE * 2 ** (attempt - 1)) * random.uniform(0.5, 1)
+
+
+class RetryBudget:
+    """
+    Token bucket limiting how often failed calls are retried, shared by every caller of a coin's ElectrumX client so
+    that a failure storm is spread out over time rather than retried as fast as possible
+    """
+
+    def __init__(self, capacity: float = 20, refill_rate: float = 1):
+        self.capacity = capacity
+        self.refill_rate = refill_rate  # tokens per second
+        self.tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.refill_rate)
+        self._updated = now
+
+    def acquire(self) -> float:
+        """
+        Takes a token, returns how long (in seconds) the caller needs to wait before it is available
+        """
+        self._refill()
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.refill_rate
+
+
+class CircuitBreaker:
+    """
+    Per host circuit breaker. After `threshold` consecutive failures the host is skipped (open) for `reset_timeout`
+    seconds, then a single attempt is allowed through (half-open) - success closes the breaker again, failure re-opens
+    it for twice as long (up to `max_timeout`)
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+    def __init__(self, threshold: int = 3, reset_timeout: float = 30, max_timeout: float = 900):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.max_timeout = max_timeout
+        self.failures = 0
+        self.opened = 0
+        self.open_until = 0.0
+        self._state = self.CLOSED
+
+    @property
+    def state(self):
+        if self._state == self.OPEN and time.monotonic() >= self.open_until:
+            self._state = self.HALF_OPEN
+        return self._state
+
+    @property
+    def available(self):
+        return self.state != self.OPEN
+
+    def record_success(self):
+        self.failures = 0
+        self.opened = 0
+        self._state = self.CLOSED
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+            self.opened += 1
+            self.open_until = time.monotonic() + min(self.max_timeout, self.reset_timeout * 2 ** (self.opened - 1))
+            self._state = self.OPEN
+
+
+class SubscriptionMux:
+    """
+    Routes subscription notifications to any number of consumer queues, keyed by `(method, *params)`.
+    Notifications are fanned out with `put_nowait`, when a bounded consumer queue is full its oldest message is
+    dropped rather than blocking the session (subscription messages carry the latest state, so only the newest matters)
+    """
+
+    def __init__(self):
+        self.consumers: Dict[tuple, List[asyncio.Queue]] = {}
+        self.cache: Dict[tuple, Any] = {}
+        # Reverse index, so unsubscribing doesn't need to scan every key
+        self._keys: Dict[asyncio.Queue, List[tuple]] = {}
+
+    @staticmethod
+    def key(method: str, params: List) -> tuple:
+        return (method, *params)
+
+    def __contains__(self, key):
+        return key in self.consumers
+
+    def __len__(self):
+        return len(self.consumers)
+
+    def items(self):
+        return self.consumers.items()
+
+    def add(self, key: tuple, queue: asyncio.Queue) -> bool:
+        """
+        Adds a consumer of `key`, returns True if it is the first one
+        """
+        queues = self.consumers.setdefault(key, [])
+        if queue not in queues:
+            queues.append(queue)
+            self._keys.setdefault(queue, []).append(key)
+        return len(queues) == 1
+
+    def remove(self, queue: asyncio.Queue) -> List[tuple]:
+        """
+        Removes a consumer from every key it is subscribed to, returns the keys that no longer have any consumers
+        """
+        released = []
+        for key in self._keys.pop(queue, []):
+            queues = self.consumers[key]
+            queues.remove(queue)
+            if not queues:
+                del self.consumers[key]
+                self.cache.pop(key, None)
+                released.append(key)
+        return released
+
+    def discard(self, key: tuple, queues: List[asyncio.Queue]):
+        """
+        Removes the given consumers of a single key
+        """
+        consumers = self.consumers.get(key, [])
+        for queue in queues:
+            if queue in consumers:
+                consumers.remove(queue)
+                self._keys[queue].remove(key)
+                if not self._keys[queue]:
+                    del self._keys[queue]
+        if key in self.consumers and not consumers:
+            del self.consumers[key]
+            self.cache.pop(key, None)
+
+    def publish(self, key: tuple, message):
+        for queue in self.consumers.get(key, ()):
+            self.put(queue, message)
+
+    @staticmethod
+    def put(queue: asyncio.Queue, message):
+        try:
+            queue.put_nowait(message)
+        except asyncio.QueueFull:
+            queue.get_nowait()
+            queue.put_nowait(message)
+
+
+def recording_path(path, tag: str) -> Path:
+    """
+    Adds a tag to the name of a recording, ahead of its extensions (traffic.jsonl.gz -> traffic-BTC.jsonl.gz)
+    """
+    path = Path(path)
+    stem, dot, extensions = path.name.partition(".")
+    return path.with_name(f"{stem}-{tag}{dot}{extensions}")
+
+
+class TrafficRecorder:
+    """
+    Writes the ElectrumX traffic of a coin to a gzipped JSON lines file, for `modules.electrumx_replay`. The first line
+    is a header, followed by
+        ["call", sent, received, host, method, params, result, error]
+        ["notify", received, host, method, args]
+    with times in seconds since the start of the recording. Errors are [code, message], or "timeout"
+    """
+
+    def __init__(self, path, symbol: str):
+        self.path, self._file = self._create(Path(path))
+        self.started = time.monotonic()
+        self._write({"symbol": symbol, "started": time.time()})
+        atexit.register(self.close)
+
+    @staticmethod
+    def _create(path: Path):
+        # An earlier recording is never overwritten, the new one is numbered instead
+        for i in itertools.count():
+            candidate = path if i == 0 else recording_path(path, str(i))
+            try:
+                return candidate, gzip.open(candidate, 'xt', encoding='utf-8')
+            except FileExistsError:
+                continue
+
+    def elapsed(self, since: Optional[float] = None) -> float:
+        return round((since or time.monotonic()) - self.started, 4)
+
+    def _write(self, entry):
+        if not self._file.closed:
+            self._file.write(json.dumps(entry, separators=(',', ':')) + "\n")
+
+    def call(self, host: str, method: str, params, sent: float, result=None, error=None):
+        self._write(["call", self.elapsed(sent), self.elapsed(), host, method, params, result, error])
+
+    def notification(self, host: str, method: str, args):
+        self._write(["notify", self.elapsed(), host, method, args])
+
+    def close(self):
+        self._file.close()
+
+
 class NotificationSession(aiorpcx.RPCSession):
-    def __init__(self, *args, host_string="", **kwargs):
+    def __init__(self, *args, host_string="", max_message_size=MAX_MESSAGE_SIZE,
+                 recorder: Optional[TrafficRecorder] = None, **kwargs):
         super(NotificationSession, self).__init__(*args, **kwargs)
         self.host_string = host_string
-        self.subscriptions = defaultdict(list)
-        self.cache = {}
+        self.max_message_size = max_message_size
+        self.recorder = recorder
+        self.subscriptions = SubscriptionMux()
         self.default_timeout = 10  # in seconds
         self._msg_counter = itertools.count(start=1)
         self._keepalive: Optional[asyncio.Task] = None
         self.cost_hard_limit = 0  # disable aiorpcx resource limits
+        self.unsupported_methods = set()
+        # Set by `ElectrumX.negotiate`
+        self.protocol_version: Optional[str] = None
+        self.capabilities = set()
 
     async def handle_request(self, request):
         logger.debug(f"--> {request}")
         try:
             if isinstance(request, Notification):
-                params, result = request.args[:-1], request.args[-1]
-                key = to_json([request.method, params])
+                if self.recorder is not None:
+                    self.recorder.notification(self.host_string, request.method, request.args)
+                key = (request.method, *request.args[:-1])
                 if key in self.subscriptions:
-                    self.cache[key] = result
-                    for queue in self.subscriptions[key]:
-                        await queue.put(request.args)
+                    self.subscriptions.cache[key] = request.args[-1]
+                    self.subscriptions.publish(key, request.args)
                 else:
                     raise Exception(f'unexpected notification')
             else:
@@ -64,6 +371,7 @@ class NotificationSession(aiorpcx.RPCSession):
         # aiorpcx. the timeout arg here in most cases should not be set
         msg_id = next(self._msg_counter)
         logger.debug(f"<-- {args} {kwargs} (id: {msg_id})")
+        sent = time.monotonic()
         try:
             # note: RPCSession.send_request raises TaskTimeout in case of a timeout.
             # TaskTimeout is a subclass of CancelledError, which is *suppressed* in TaskGroups
@@ -71,18 +379,26 @@ class NotificationSession(aiorpcx.RPCSession):
                 super().send_request(*args, **kwargs),
                 timeout)
         except (aiorpcx.TaskTimeout, asyncio.TimeoutError) as e:
+            self._record(args, sent, error="timeout")
             raise ConnectionError(f'request timed out: {args} (id: {msg_id})') from e
         except CodeMessageError as e:
             logger.debug(f"--> {repr(e)} (id: {msg_id})")
+            self._record(args, sent, error=[e.code, e.message])
             raise
         else:
             logger.debug(f"--> {response} (id: {msg_id})")
+            self._record(args, sent, result=response)
             return response
 
-    async def keep_alive(self):
+    def _record(self, args, sent, result=None, error=None):
+        if self.recorder is not None:
+            method, params = args[0], list(args[1]) if len(args) > 1 and args[1] is not None else []
+            self.recorder.call(self.host_string, method, params, sent, result=result, error=error)
+
+    async def keep_alive(self, idle=False):
         while True:
             await asyncio.sleep(30)
-            if self.subscriptions:
+            if idle or self.subscriptions:
                 try:
                     async with aiorpcx.timeout_after(5):
                         await self.send_request("server.ping", [])
@@ -94,34 +410,91 @@ class NotificationSession(aiorpcx.RPCSession):
     async def subscribe(self, method: str, params: List, queue: asyncio.Queue):
         # note: until the cache is written for the first time,
         # each 'subscribe' call might make a request on the network.
-        key = to_json([method, params])
-        self.subscriptions[key] = [queue]
-        if key in self.cache:
-            result = self.cache[key]
+        key = SubscriptionMux.key(method, params)
+        self.subscriptions.add(key, queue)
+        if key in self.subscriptions.cache:
+            result = self.subscriptions.cache[key]
         else:
             result = await self.send_request(method, params)
-            self.cache[key] = result
+            self.subscriptions.cache[key] = result
+
+        if self._keepalive is None:
+            self._keepalive = asyncio.create_task(self.keep_alive())
+
+        SubscriptionMux.put(queue, params + [result])
+
+    async def resubscribe(self, subscriptions: SubscriptionMux):
+        """
+        Re-establishes the subscriptions of another (failed) session. The requests are pipelined rather than made one
+        after the other, consumers receive the current result just as they would from `subscribe`
+        """
+        items = list(subscriptions.items())
+        if not items:
+            return
+        # As in `subscribe`, the consumers are registered before the requests are sent, as notifications (such as a
+        # new block) can arrive before every response has
+        added = {}
+        uncached = set()
+        for key, queues in items:
+            added[key] = [x for x in queues if x not in self.subscriptions.consumers.get(key, [])]
+            if key not in self.subscriptions.cache:
+                uncached.add(key)
+            for queue in queues:
+                self.subscriptions.add(key, queue)
+
+        async def request(keys: List[tuple]):
+            try:
+                if len(keys) > 1:
+                    results = await self._send_batch(keys)
+                else:
+                    results = [await self.send_request(keys[0][0], list(keys[0][1:]))]
+            except BaseException:
+                for key in keys:
+                    self.subscriptions.discard(key, added[key])
+                raise
+            for key, result in zip(keys, results):
+                if key in uncached and key in self.subscriptions.cache:
+                    # A notification has arrived first (a batch is answered once all of its requests are), the
+                    # response is older than it
+                    continue
+                self.subscriptions.cache[key] = result
+                self.subscriptions.publish(key, list(key[1:]) + [result])
+
+        if Capability.BATCH in self.capabilities and len(items) > 1:
+            await asyncio.gather(*[request([key for key, _ in items[i:i + MAX_BATCH_SIZE]])
+                                   for i in range(0, len(items), MAX_BATCH_SIZE)])
+        else:
+            await asyncio.gather(*[request([key]) for key, _ in items])
 
         if self._keepalive is None:
             self._keepalive = asyncio.create_task(self.keep_alive())
 
-        await queue.put(params + [result])
+    async def _send_batch(self, keys: List[tuple]) -> list:
+        sent = time.monotonic()
+        async with self.send_batch() as batch:
+            for key in keys:
+                batch.add_request(key[0], list(key[1:]))
+        for key, result in zip(keys, batch.results):
+            if isinstance(result, CodeMessageError):
+                self._record((key[0], list(key[1:])), sent, error=[result.code, result.message])
+            elif not isinstance(result, Exception):
+                self._record((key[0], list(key[1:])), sent, result=result)
+        for result in batch.results:
+            if isinstance(result, Exception):
+                raise result
+        return list(batch.results)
 
-    def unsubscribe(self, queue):
-        """Unsubscribe a callback to free object references to enable GC."""
-        # note: we can't unsubscribe from the server, so we keep receiving
-        # subsequent notifications
-        for v in self.subscriptions.values():
-            if queue in v:
-                v.remove(queue)
-        for k in list(self.subscriptions.keys()):
-            if not self.subscriptions[k]:
-                del self.subscriptions[k]
+    def unsubscribe(self, queue) -> List[tuple]:
+        """
+        Unsubscribe a queue to free object references to enable GC. Returns the subscription keys that no longer have
+        any consumers, these can be unsubscribed from the server (where supported)
+        """
+        return self.subscriptions.remove(queue)
 
     def default_framer(self):
-        # overridden so that max_size can be customized
-        # in bytes. 1mb is used for electrum
-        return aiorpcx.NewlineFramer(max_size=1_000_000)
+        # overridden so that max_size can be customized (`electrumx_max_message_size`), large scripthash histories
+        # can exceed the default
+        return aiorpcx.NewlineFramer(max_size=self.max_message_size)
 
     async def teardown(self):
         if self._keepalive is not None:
@@ -135,22 +508,49 @@ class ElectrumX:
     blockchain_transaction_broadcast = "blockchain.transaction.broadcast"
     blockchain_headers_subscribe = "blockchain.headers.subscribe"
     blockchain_scripthash_subscribe = "blockchain.scripthash.subscribe"
+    blockchain_scripthash_unsubscribe = "blockchain.scripthash.unsubscribe"
     blockchain_scripthash_get_history = "blockchain.scripthash.get_history"
     blockchain_scripthash_listunspent = "blockchain.scripthash.listunspent"
+    blockchain_scripthash_get_balance = "blockchain.scripthash.get_balance"
+    blockchain_scripthash_get_mempool = "blockchain.scripthash.get_mempool"
     blockchain_relayfee = "blockchain.relayfee"
     blockchain_estimatefee = "blockchain.estimatefee"
     server_peers_subscribe = "server.peers.subscribe"
+    server_version = "server.version"
+    server_features = "server.features"
 
-    def __init__(self, symbol, default_ports=None):
+    # Optional methods, and the capability a server needs for them
+    method_capabilities = {
+        blockchain_scripthash_unsubscribe: Capability.SCRIPTHASH_UNSUBSCRIBE,
+        blockchain_scripthash_get_mempool: Capability.MEMPOOL,
+    }
+
+    def __init__(self, symbol, default_ports=None, genesis_hash=None, required_capabilities=(Capability.VERBOSE_TX,)):
         self.symbol = symbol
+        self.genesis_hash = genesis_hash
+        self.required_capabilities = set(required_capabilities)
         self.default_servers = read_json(Path(f"data/electrumx-servers.json"), {}).get(symbol)
+        self.default_ports = default_ports or {'t': 50001, 's': 50002}
         self.user_servers = self.load_user_servers()
 
-        self.default_ports = default_ports or {'t': 50001, 's': 50002}
         self.session: Optional[NotificationSession] = None
+        # Connected session to a different server, promoted when the main session fails
+        self.standby: Optional[NotificationSession] = None
+        self._standby_task: Optional[asyncio.Task] = None
+
+        self.retry_budget = RetryBudget(
+            capacity=int(config.get("electrumx_retry_budget", coin=self.symbol, default=20)))
+        self.max_message_size = int(config.get("electrumx_max_message_size", coin=self.symbol,
+                                               default=MAX_MESSAGE_SIZE))
+        record_path = config.get("electrumx_record_traffic", coin=self.symbol)
+        # The setting may be shared by every coin
+        self.recorder = TrafficRecorder(recording_path(record_path, symbol), symbol) if record_path else None
+        self.breakers: Dict[str, CircuitBreaker] = defaultdict(CircuitBreaker)
 
         # This needs to be instantiated inside the asyncio loop
         self.servers: Optional[dict] = None
+        # Hosts whose entry has changed since the last `save_server_list`
+        self._dirty_servers = set()
         self.connection_lock = None
         self.proxy = None
 
@@ -172,9 +572,10 @@ class ElectrumX:
     def load_user_servers(self):
         user_servers = config.get('electrumx_servers', coin=self.symbol)
         if user_servers:
-            user_servers = [self.parse_user_server(x) for x in user_servers]
+            user_servers = [self.parse_user_server(x.strip()) for x in user_servers.split(",") if x.strip()]
             user_servers = [x for x in user_servers if x]
-            self.default_servers.update({k: {} for k in user_servers})
+            known = list(self.default_servers or [])
+            self.default_servers = known + [x for x in user_servers if x not in known]
         return user_servers or None
 
     async def initialize(self):
@@ -192,7 +593,10 @@ class ElectrumX:
             if self.proxy is None:
                 logger.warn(f"Could not connect to tor proxy @ {_tor_host}")
 
-    async def random_server(self, exclude=None):
+    async def ranked_servers(self, exclude=None) -> List[str]:
+        """
+        Returns the top 10 candidate servers, best first
+        """
         if self.servers is None:
             await self.initialize()
 
@@ -206,17 +610,32 @@ class ElectrumX:
 
         if exclude:
             options = [x for x in options if x != exclude]
-
-        if not options:
-            return None
+        options = [x for x in options if (x not in self.breakers or self.breakers[x].available)
+                   and not self.unusable_reason(x)]
 
         # Sort servers by % reachable (rounded to whole percent), followed by last_seen date
         options = sorted(options, key=self.server_priority, reverse=True)
+        return options[:10]
+
+    async def random_server(self, exclude=None):
+        options = await self.ranked_servers(exclude=exclude)
+        if not options:
+            return None
 
         # Pick in exponentially decreasing likelihood
-        options = options[:10] if len(options) > 10 else options
         return random.choices(options, k=1, weights=[100 ** (0.8 ** x) for x in range(len(options))])[0]
 
+    async def race_candidates(self, exclude=None) -> List[str]:
+        """
+        The servers to dial in parallel when connecting, a random pick (as per `random_server`) followed by the next
+        best ranked servers
+        """
+        first = await self.random_server(exclude=exclude)
+        if first is None:
+            return []
+        k = int(config.get("electrumx_connect_race", coin=self.symbol, default=3))
+        return ([first] + [x for x in await self.ranked_servers(exclude=exclude) if x != first])[:max(1, k)]
+
     def server_priority(self, host_string):
         server = self.servers.get(host_string, {})
         reachable = 0
@@ -226,31 +645,51 @@ class ElectrumX:
         return reachable, server.get("last_seen") or EPOCH
 
     async def save_server_list(self):
-        updates = [dict(host=k, symbol=self.symbol, **v) for k, v in self.servers.items() if v.get("id")]
-        new = (dict(host=k, symbol=self.symbol, **v) for k, v in self.servers.items() if not v.get("id"))
-        new = [{k: v for k, v in x.items() if k in ElectrumServer.c} for x in new]
-        for update in updates:
-            await database.execute(ElectrumServer.update()
-                                   .where(ElectrumServer.c.id == update.pop("id")).values(**update))
-        for n in new:
-            pk = await database.execute(ElectrumServer.insert().values(**n))
-            self.servers[n['host']]['id'] = pk
-
-        await database.execute(ElectrumServer.delete()
-                               .where(and_(ElectrumServer.c.last_seen.is_(None),
-                                           ElectrumServer.c.connections > 5)))
-
-    async def _find_peers(self, host_string):
-        session = await self.make_session(host_string, None)
-        if session:
-            try:
-                ret = await self._call(session, ElectrumX.server_peers_subscribe, [])
-                await session.close()
-                return host_string, True, ret
-            except (aiorpcx.CancelledError, aiorpcx.TaskTimeout, ProtocolError,
-                    aiorpcx.RPCError, socket.gaierror, ElectrumError):
-                return host_string, False, []
-        return host_string, False, []
+        """
+        Saves the servers that have changed since the last save, in a single transaction
+        """
+        dirty, self._dirty_servers = self._dirty_servers, set()
+        rows = [dict(symbol=self.symbol, host=host, **{c: self.servers[host].get(c) for c in SERVER_COLUMNS})
+                for host in dirty if host in self.servers]
+        # Servers that have never been reachable are pruned below, don't recreate them
+        rows = [x for x in rows if x['last_seen'] is not None or (x['connections'] or 0) <= 5]
+        updates = [x for x in rows if self.servers[x['host']].get('id')]
+        inserts = [x for x in rows if not self.servers[x['host']].get('id')]
+
+        try:
+            async with database.transaction():
+                if updates:
+                    await database.execute_many(SERVER_UPDATE, [
+                        dict({c: x[c] for c in SERVER_COLUMNS}, server_id=self.servers[x['host']]['id'])
+                        for x in updates])
+                if inserts:
+                    await database.execute_many(ElectrumServer.insert(), inserts)
+                await database.execute(ElectrumServer.delete()
+                                       .where(and_(ElectrumServer.c.last_seen.is_(None),
+                                                   ElectrumServer.c.connections > 5)))
+                if inserts:
+                    ids = await database.fetch_all(select([ElectrumServer.c.host, ElectrumServer.c.id])
+                                                   .where(ElectrumServer.c.symbol == self.symbol))
+                    for host, pk in ids:
+                        if host in self.servers:
+                            self.servers[host]['id'] = pk
+        except:
+            self._dirty_servers |= dirty
+            raise
+
+    async def _find_peers(self, host_string, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            session = await self.make_session(host_string, None)
+            if session:
+                try:
+                    ret = await self._call(session, ElectrumX.server_peers_subscribe, [])
+                    return host_string, True, ret
+                except (aiorpcx.CancelledError, aiorpcx.TaskTimeout, ProtocolError,
+                        aiorpcx.RPCError, socket.gaierror, ElectrumError):
+                    return host_string, False, []
+                finally:
+                    await session.close()
+            return host_string, False, []
 
     async def update_peers(self):
         if self.servers is None:
@@ -261,12 +700,14 @@ class ElectrumX:
         to_query = [k for k, v in self.servers.items() if
                     (v.get("last_check") or EPOCH) < from_time]
 
-        if len(to_query) > 20:
-            logger.info("reducing new servers to query")
-            to_query = list(sorted(to_query, key=lambda x: (self.servers[x].get("last_check") or EPOCH)))
+        budget = int(config.get("electrumx_probe_budget", coin=self.symbol, default=20))
+        if len(to_query) > budget:
+            logger.info(f"reducing servers to query from {len(to_query)} to {budget}")
+            to_query = sorted(to_query, key=lambda x: (self.servers[x].get("last_check") or EPOCH))[:budget]
 
         new_peers = []
-        rets = await asyncio.gather(*[self._find_peers(host) for host in to_query])
+        semaphore = asyncio.Semaphore(int(config.get("electrumx_probe_concurrency", coin=self.symbol, default=5)))
+        rets = await asyncio.gather(*[self._find_peers(host, semaphore) for host in to_query])
         for host, success, peers in rets:
             if success:
                 if isinstance(peers, list):
@@ -289,17 +730,16 @@ class ElectrumX:
             if host not in self.servers:
                 logger.info(f"adding new peer: {host} {dat}")
                 self.servers[host] = dat
+                self._dirty_servers.add(host)
         await self.save_server_list()
 
-    async def check(self, method, param):
-        if method not in self.session.subscriptions or \
-                param not in self.session.subscriptions[method]:
-            return
-        return self.session.subscriptions[method][param]
+    async def check(self, method, params):
+        return self.session.subscriptions.cache.get(SubscriptionMux.key(method, params))
 
-    def unsubscribe(self, queue):
+    def unsubscribe(self, queue) -> List[tuple]:
         if self.session is not None:
-            self.session.unsubscribe(queue)
+            return self.session.unsubscribe(queue)
+        return []
 
     def create_client(self, host_string):
         hostname, p_tcp, p_ssl = host_string.split("|")
@@ -315,16 +755,67 @@ class ElectrumX:
                         p_ssl if p_ssl else p_tcp,
                         ssl=sslc,
                         proxy=proxy,
-                        session_factory=lambda x: NotificationSession(x, host_string=host_string))
+                        session_factory=lambda x: NotificationSession(x, host_string=host_string,
+                                                                      max_message_size=self.max_message_size,
+                                                                      recorder=self.recorder))
+
+    def unusable_reason(self, host_string) -> Optional[str]:
+        """
+        Why a server doesn't meet the requirements of this client, as far as is known from its cached version and
+        features. None if the server is usable
+        """
+        server = self.servers.get(host_string) or {}
+        if server.get("server_software") is not None:
+            missing = self.required_capabilities - server_capabilities(server['server_software'],
+                                                                       server.get('protocol_version'))
+            if missing:
+                return f"missing {', '.join(sorted(missing))}"
+        if self.genesis_hash and server.get("features"):
+            genesis_hash = json.loads(server['features']).get("genesis_hash")
+            if genesis_hash and genesis_hash != self.genesis_hash:
+                return f"wrong network (genesis {genesis_hash})"
+        return None
+
+    async def negotiate(self, session: NotificationSession):
+        """
+        Negotiates the protocol version of a new session, and works out the server's capabilities. Server features are
+        cached per host, and only refetched when the server software changes.
+        Raises IncapableServerError if the server doesn't meet the requirements of this client
+        """
+        host = session.host_string
+        result = await session.send_request(ElectrumX.server_version, [CLIENT_NAME, [PROTOCOL_MIN, PROTOCOL_MAX]])
+        software, protocol = result if isinstance(result, list) and len(result) == 2 else (str(result), PROTOCOL_MIN)
+        server = self.servers.get(host) or {}
+        if server.get("features") is None or server.get("server_software") != software:
+            features = await session.send_request(ElectrumX.server_features, [])
+            self.validate_elextrumx_call(ElectrumX.server_features, features)
+            self.server_set(host, features=json.dumps(features))
+        self.server_set(host, server_software=software, protocol_version=protocol)
+
+        session.protocol_version = protocol
+        session.capabilities = server_capabilities(software, protocol)
+        reason = self.unusable_reason(host)
+        if reason:
+            raise IncapableServerError(reason)
+
+    def record_failure(self, host_string):
+        self.server_increment(host_string, "failures")
+        self.breakers[host_string].record_failure()
 
     def server_increment(self, host_string, key, delta=1):
         if host_string not in self.servers:
             self.servers[host_string] = {}
         self.servers[host_string][key] = (self.servers[host_string].get(key) or 0) + delta
+        self._dirty_servers.add(host_string)
+
+    def server_set(self, host_string, **values):
+        self.servers.setdefault(host_string, {}).update(values)
+        self._dirty_servers.add(host_string)
 
     async def make_session(self, host, subscriptions):
         self.server_increment(host, "connections")
-        self.servers[host]['last_check'] = datetime.datetime.utcnow()
+        self.server_set(host, last_check=datetime.datetime.utcnow())
+        started = time.monotonic()
 
         try:
             client = self.create_client(host)
@@ -332,25 +823,37 @@ class ElectrumX:
                 _transport, protocol = await client.create_connection()
         except (aiorpcx.TaskTimeout, aiorpcx.CancelledError, socket.gaierror,
                 OSError, SOCKSFailure, ConnectionError) as e:
-            self.server_increment(host, "failures")
+            self.record_failure(host)
             logger.info(f"{host} connection failed: {repr(e)}")
             return None
         except:
-            self.server_increment(host, "failures")
+            self.record_failure(host)
             traceback.print_exc()
             return None
 
-        self.servers[host]['first_seen'] = self.servers[host].get('first_seen') or datetime.datetime.utcnow()
-        self.servers[host]['last_seen'] = datetime.datetime.utcnow()
+        self.server_set(host, first_seen=self.servers[host].get('first_seen') or datetime.datetime.utcnow(),
+                        last_seen=datetime.datetime.utcnow())
 
         session: NotificationSession = protocol.session
+        try:
+            async with aiorpcx.timeout_after(10):
+                await self.negotiate(session)
+        except IncapableServerError as e:
+            logger.info(f"{host} excluded: {e}")
+            await session.close()
+            return None
+        except (aiorpcx.TaskTimeout, aiorpcx.CancelledError, aiorpcx.RPCError, ProtocolError, ConnectionError,
+                ElectrumError) as e:
+            self.record_failure(host)
+            logger.info(f"{host} version negotiation failed: {repr(e)}")
+            await session.close()
+            return None
+        # Time to a usable session, in ms
+        self.server_set(host, latency=int((time.monotonic() - started) * 1000))
+
         if subscriptions:
-            for key, val in subscriptions.items():
-                ret = json.loads(key)
-                method, params = ret
-                logger.info(f"Subscribing: {method} {params}")
-                for queue in val:
-                    await session.subscribe(method, params, queue=queue)
+            logger.info(f"Subscribing to {len(subscriptions)} subscriptions @ {host}")
+            await session.resubscribe(subscriptions)
         return session
 
     async def get_session(self, host=None, subscriptions=None, exclude=None):
@@ -360,21 +863,134 @@ class ElectrumX:
             if self.session is not None:
                 return self.session
 
+            failed_rounds = 0
             while True:
-                if host is None:
-                    host = await self.random_server(exclude=exclude)
-                    if host is None:
+                if host is not None:
+                    hosts = [host]
+                else:
+                    hosts = await self.race_candidates(exclude=exclude)
+                    if not hosts and (wait := self.breaker_wait()) is not None:
+                        # Every candidate is cooling off
+                        logger.info(f"{self.symbol} - all servers unavailable, retrying in {wait:.1f}s")
+                        await asyncio.sleep(wait)
+                        continue
+                    if not hosts:
                         await self.update_peers()
-                        host = await self.random_server()
-                        if host is None:
+                        hosts = await self.race_candidates()
+                        if not hosts:
                             raise NoServersError("No available servers")
 
-                self.session = await self.make_session(host, subscriptions)
-                if self.session is None:
+                session = await self.race_sessions(hosts)
+                if session is None:
                     host = None
+                    failed_rounds += 1
+                    await asyncio.sleep(backoff_delay(failed_rounds))
                     continue
+                if subscriptions:
+                    logger.info(f"Subscribing to {len(subscriptions)} subscriptions @ {session.host_string}")
+                    await session.resubscribe(subscriptions)
+                self.session = session
+                self.ensure_standby()
                 return self.session
 
+    async def race_sessions(self, hosts: List[str]) -> Optional[NotificationSession]:
+        """
+        Dials the hosts in parallel, each one starting `CONNECT_STAGGER` seconds after the previous one (or as soon as
+        an attempt fails), and returns the first session to complete its handshake. Attempts still in flight are left
+        to finish in the background so their latency/failures are recorded, the first of them to succeed becomes the
+        standby session
+        """
+        candidates = iter(hosts)
+        pending = set()
+        winner = None
+        extra = []
+        while winner is None:
+            host = next(candidates, None)
+            if host is not None:
+                pending.add(asyncio.create_task(self.make_session(host, None)))
+            if not pending:
+                break
+            done, pending = await asyncio.wait(pending, timeout=CONNECT_STAGGER if host is not None else None,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.result() is None:
+                    continue
+                if winner is None:
+                    winner = task.result()
+                else:
+                    extra.append(task.result())
+
+        if winner is not None and (extra or pending):
+            asyncio.create_task(self._settle_race(winner, extra, pending))
+        return winner
+
+    async def _settle_race(self, winner: NotificationSession, sessions: List[NotificationSession], pending: set):
+        for task in asyncio.as_completed(pending):
+            session = await task
+            if session is not None:
+                sessions.append(session)
+        for session in sessions:
+            await self._keep_as_standby(session, winner)
+
+    async def _keep_as_standby(self, session: NotificationSession, main: Optional[NotificationSession]):
+        if config.check("electrumx_disable_standby", coin=self.symbol) or \
+                (self.standby is not None and not self.standby.is_closing()) or \
+                (main is not None and session.host_string == main.host_string):
+            await session.close()
+            return
+        session._keepalive = asyncio.create_task(session.keep_alive(idle=True))
+        self.standby = session
+        logger.info(f"{self.symbol} - standby session connected @ {session.host_string}")
+
+    def ensure_standby(self):
+        """
+        Opens a standby session in the background, if there isn't one already
+        """
+        if config.check("electrumx_disable_standby", coin=self.symbol):
+            return
+        if self.standby is not None and not self.standby.is_closing():
+            return
+        if self._standby_task is None or self._standby_task.done():
+            self._standby_task = asyncio.create_task(self._open_standby())
+
+    async def _open_standby(self):
+        self.standby = None
+        exclude = self.session.host_string if self.session is not None else None
+        host = await self.random_server(exclude=exclude)
+        if host is None:
+            return
+        session = await self.make_session(host, None)
+        if session is not None:
+            await self._keep_as_standby(session, self.session)
+
+    async def promote_standby(self, subscriptions: Optional[SubscriptionMux]) -> bool:
+        """
+        Replaces the (torn down) main session with the standby session, returns False if there is no usable standby
+        """
+        standby, self.standby = self.standby, None
+        if standby is None or standby.is_closing():
+            return False
+
+        async with self.connection_lock:
+            if self.session is not None:
+                # Another caller has already replaced the session
+                await standby.teardown()
+                return True
+            try:
+                if subscriptions:
+                    async with aiorpcx.timeout_after(10):
+                        await standby.resubscribe(subscriptions)
+            except (aiorpcx.TaskTimeout, aiorpcx.CancelledError, aiorpcx.RPCError, ProtocolError,
+                    ConnectionError) as e:
+                logger.info(f"standby {standby.host_string} failed to resubscribe: {repr(e)}")
+                self.record_failure(standby.host_string)
+                await standby.teardown()
+                return False
+            logger.info(f"{self.symbol} - promoted standby session @ {standby.host_string}")
+            self.session = standby
+        self.ensure_standby()
+        return True
+
     def validate_elextrumx_call(self, method, result, args=None):
         def ensure(statement):
             if not statement:
@@ -414,6 +1030,22 @@ class ElectrumX:
                 ensure(isinstance(result, list))
                 ensure(all(('tx_hash' in x for x in result)))
                 return True
+            if method == ElectrumX.blockchain_scripthash_get_balance:
+                ensure(isinstance(result, dict))
+                ensure(isinstance(result['confirmed'], int) and isinstance(result['unconfirmed'], int))
+                return True
+            if method == ElectrumX.blockchain_scripthash_get_mempool:
+                ensure(isinstance(result, list))
+                ensure(all(('tx_hash' in x and 'height' in x for x in result)))
+                return True
+            if method == ElectrumX.blockchain_transaction_broadcast:
+                # The txid
+                ensure(isinstance(result, str) and len(result) == 64)
+                return True
+            if method == ElectrumX.server_features:
+                ensure(isinstance(result, dict))
+                ensure(isinstance(result.get('protocol_max'), str))
+                return True
         except ElectrumError:
             raise
         except (TypeError, ValueError, KeyError, IndexError) as e:
@@ -422,48 +1054,200 @@ class ElectrumX:
         logger.warning(f"Non-validated call {method} - {json.dumps(result)}")
         return False
 
-    async def _call(self, session, method, args, queue=None):
+    async def _call(self, session, method, args, queue=None, timeout=10, record_timeout=True):
         try:
             self.server_increment(session.host_string, "connections")
-            async with aiorpcx.timeout_after(10):
+            async with aiorpcx.timeout_after(timeout):
                 if queue:
                     result = await session.subscribe(method, args, queue)
                     if result is None:
                         result = await queue.get()
                 else:
                     result = await session.send_request(method, args)
-                self.servers[session.host_string]['last_seen'] = datetime.datetime.utcnow()
+                self.server_set(session.host_string, last_seen=datetime.datetime.utcnow())
                 self.validate_elextrumx_call(method, result, args)
+                self.breakers[session.host_string].record_success()
                 return result
-        except:
-            self.server_increment(session.host_string, "failures")
+        except BaseException as e:
+            if isinstance(e, aiorpcx.TaskTimeout) and not record_timeout:
+                # The timeout was the caller's, which says nothing about the server
+                pass
+            elif isinstance(e, aiorpcx.RPCError) and e.code == aiorpcx.JSONRPC.METHOD_NOT_FOUND:
+                self.server_increment(session.host_string, "failures")
+            else:
+                self.record_failure(session.host_string)
             raise
 
-    async def penalize_server(self):
-        subs = None
-        old_host = self.session.host_string if self.session is not None else None
-        if self.session is not None:
-            self.server_increment(self.session.host_string, "failures")
-            subs = await self.session.teardown()
-            self.session = None
-        await self.get_session(subscriptions=subs, exclude=old_host)
+    async def penalize_server(self, session: Optional[NotificationSession] = None):
+        async with self.connection_lock:
+            if self.session is None or (session is not None and session is not self.session):
+                # The failed session has already been replaced, or is being replaced by another caller
+                return
+            # Detached before the teardown is awaited, concurrent callers failing on the same session return above
+            failed, self.session = self.session, None
+        self.server_increment(failed.host_string, "failures")
+        subs = await failed.teardown()
+        if await self.promote_standby(subs):
+            return
+        await self.get_session(subscriptions=subs, exclude=failed.host_string)
 
-    async def call(self, method, args, queue=None, host=None):
-        while True:
+    def supports(self, method) -> bool:
+        """Whether the current session is not known to lack support for `method`"""
+        if self.session is None:
+            return True
+        if method in self.session.unsupported_methods:
+            return False
+        capability = self.method_capabilities.get(method)
+        return capability is None or capability in self.session.capabilities
+
+    def breaker_wait(self) -> Optional[float]:
+        """
+        Seconds until the first open circuit breaker allows another attempt, None if no breakers are open
+        """
+        now = time.monotonic()
+        waits = [x.open_until - now for x in self.breakers.values() if x.state == CircuitBreaker.OPEN]
+        return max(0.0, min(waits)) if waits else None
+
+    async def broadcast(self, raw_tx: str, fanout: Optional[int] = None) -> str:
+        """
+        Submits a transaction to several servers in parallel (the main and standby sessions, topped up with short lived
+        sessions to the best ranked servers) and returns its txid as soon as the first of them accepts it. Propagation
+        to the other servers is then confirmed in the background. Raises the first error if every server rejects it
+        """
+        fanout = max(1, fanout or int(config.get("electrumx_broadcast_fanout", coin=self.symbol, default=3)))
+        await self.get_session()
+        sessions = [x for x in (self.session, self.standby) if x is not None and not x.is_closing()][:fanout]
+        hosts = [x for x in await self.ranked_servers() if x not in {s.host_string for s in sessions}]
+        reached: List[NotificationSession] = []
+        temporary: List[NotificationSession] = []
+
+        async def submit(session: Optional[NotificationSession] = None, host: Optional[str] = None):
+            if session is None:
+                session = await self.make_session(host, None)
+                if session is None:
+                    raise ConnectionError(f"could not connect to {host}")
+                temporary.append(session)
+            reached.append(session)
             try:
-                await self.get_session(host)
-            except NoServersError:
+                async with aiorpcx.timeout_after(10):
+                    result = await session.send_request(ElectrumX.blockchain_transaction_broadcast, [raw_tx])
+                self.validate_elextrumx_call(ElectrumX.blockchain_transaction_broadcast, result)
+            except aiorpcx.RPCError:
+                # Rejected by the server's node, which says nothing about the server itself
+                raise
+            except BaseException:
+                self.record_failure(session.host_string)
                 raise
+            self.breakers[session.host_string].record_success()
+            return session, result
+
+        tasks = [asyncio.create_task(submit(session=x)) for x in sessions] + \
+                [asyncio.create_task(submit(host=x)) for x in hosts[:fanout - len(sessions)]]
+        errors = []
+        for task in asyncio.as_completed(tasks):
+            try:
+                session, txid = await task
+            except (aiorpcx.TaskTimeout, aiorpcx.CancelledError, aiorpcx.RPCError, ProtocolError, ConnectionError,
+                    ElectrumError) as e:
+                errors.append(e)
+                continue
+            logger.info(f"{self.symbol} - broadcast {txid} accepted by {session.host_string}")
+            asyncio.create_task(self._confirm_propagation(raw_tx, txid, session, tasks, reached, temporary))
+            return txid
+
+        for session in temporary:
+            await session.close()
+        logger.info(f"{self.symbol} - broadcast rejected by all servers: {errors}")
+        raise errors[0]
+
+    async def _confirm_propagation(self, raw_tx: str, txid: str, accepted_by: NotificationSession, tasks: list,
+                                   reached: List[NotificationSession], temporary: List[NotificationSession]):
+        """
+        Polls `blockchain.transaction.get` on the other servers of a broadcast until they all know the transaction,
+        submitting it again to the ones that still don't halfway through
+        """
+        async def knows_tx(session: NotificationSession) -> bool:
+            try:
+                async with aiorpcx.timeout_after(10):
+                    await session.send_request(ElectrumX.blockchain_transaction_get, [txid])
+                return True
+            except (aiorpcx.TaskTimeout, aiorpcx.RPCError, ProtocolError, ConnectionError):
+                return False
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+        missing = [x for x in reached if x is not accepted_by]
+        try:
+            for check in range(PROPAGATION_CHECKS):
+                missing = [x for x in missing if not x.is_closing()]
+                if not missing:
+                    break
+                await asyncio.sleep(PROPAGATION_INTERVAL)
+                found = await asyncio.gather(*[knows_tx(x) for x in missing])
+                missing = [x for x, known in zip(missing, found) if not known]
+                if missing and check == PROPAGATION_CHECKS // 2:
+                    await asyncio.gather(*[x.send_request(ElectrumX.blockchain_transaction_broadcast, [raw_tx])
+                                           for x in missing], return_exceptions=True)
+            if missing:
+                logger.warning(f"{self.symbol} - {txid} has not propagated to {[x.host_string for x in missing]}")
+            else:
+                logger.info(f"{self.symbol} - {txid} propagated to {len(reached)} servers")
+        finally:
+            for session in temporary:
+                await session.close()
+
+    async def call(self, method, args, queue=None, host=None, deadline: Optional[float] = None):
+        """
+        Calls `method` on the current session, failing over to other servers until it succeeds. Retries are backed off
+        exponentially and drawn from the coin's retry budget. If `deadline` (in seconds) is given, DeadlineExceeded is
+        raised once it has passed
+        """
+        expires = None if deadline is None else time.monotonic() + deadline
+
+        def remaining():
+            if expires is None:
+                return None
+            if (left := expires - time.monotonic()) <= 0:
+                raise DeadlineExceeded(f"{method} did not complete within {deadline}s")
+            return left
 
+        attempt = 0
+        while True:
+            try:
+                await asyncio.wait_for(self.get_session(host), remaining())
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded(f"no session available for {method} within {deadline}s")
+
+            session = self.session
+            left = remaining()
+            # Whether the call is bound by the caller's deadline rather than the usual 10s cap
+            bounded = left is not None and left < 10
             try:
-                assert self.session is not None
-                return await self._call(self.session, method, args, queue=queue)
+                assert session is not None
+                return await self._call(session, method, args, queue=queue, timeout=left if bounded else 10,
+                                        record_timeout=not bounded)
             except (AssertionError, aiorpcx.CancelledError, aiorpcx.TaskTimeout,
                     ProtocolError, aiorpcx.RPCError, ElectrumError) as e:
+                if isinstance(e, aiorpcx.TaskTimeout) and bounded:
+                    raise DeadlineExceeded(f"{method} did not complete within {deadline}s") from e
+                if isinstance(e, aiorpcx.RPCError) and e.code == aiorpcx.JSONRPC.METHOD_NOT_FOUND:
+                    # Optional protocol methods shouldn't cause the server to be rotated
+                    logger.info(f"{session.host_string} does not support {method}")
+                    session.unsupported_methods.add(method)
+                    raise UnsupportedMethodError(f"{method} is not supported by {session.host_string}") from e
                 logger.info(f"Electrum call failed - "
-                             f"{f'{self.session.host_string} - ' if self.session is not None else ''}"
+                             f"{f'{session.host_string} - ' if session is not None else ''}"
                              f"{e} - retrying")
-                await self.penalize_server()
+                try:
+                    # Shielded, as the failover must carry the session's subscriptions over even if this call gives up
+                    await asyncio.wait_for(asyncio.shield(self.penalize_server(session)), remaining())
+                except asyncio.TimeoutError:
+                    raise DeadlineExceeded(f"{method} did not complete within {deadline}s")
             except Exception as e:
                 logger.exception("Exception calling electrumx", exc_info=e)
                 raise
+
+            attempt += 1
+            delay = max(backoff_delay(attempt), self.retry_budget.acquire())
+            if expires is not None and time.monotonic() + delay >= expires:
+                raise DeadlineExceeded(f"{method} did not complete within {deadline}s")
+            await asyncio.sleep(delay)
@@ -0,0 +1,178 @@
+"""
+Replays ElectrumX traffic recorded with `electrumx_record_traffic` (see `TrafficRecorder`) into an `ElectrumX` client,
+so that the payment watchers can be measured against real traffic patterns without network access.
+
+    replay = TrafficReplay("data/traffic-BTC.jsonl.gz", speed=None)
+    replay.attach(ALL_COINS['BTC'].electrumX)
+    stats = await replay.run()
+"""
+import asyncio
+import gzip
+import json
+import time
+from collections import defaultdict, deque
+from typing import Optional, List, Tuple
+
+import aiorpcx
+
+from modules.electrumx import ElectrumX, SubscriptionMux, Capability, server_capabilities
+from modules.logging import logger
+
+
+def read_traffic(path) -> Tuple[dict, List[list]]:
+    """
+    Returns the header and entries of a recording
+    """
+    header, entries = {}, []
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        try:
+            for i, line in enumerate(f):
+                if i == 0:
+                    header = json.loads(line)
+                else:
+                    entries.append(json.loads(line))
+        except (EOFError, json.JSONDecodeError):
+            # The recording was cut short, e.g. the process was killed before the file was closed
+            pass
+    return header, entries
+
+
+class ReplaySession:
+    """
+    Stands in for a `NotificationSession`, answering requests from the recorded responses. Repeated requests get the
+    recorded responses in order (the last one is repeated once they run out). Requests that were never recorded
+    fall back to the latest response of the same method, failing that the method is reported as unsupported
+    """
+
+    def __init__(self, calls: List[list], software: str = "ElectrumX 1.16.0", protocol: str = "1.4.2",
+                 speed: Optional[float] = 1.0):
+        self.host_string = "replay||"
+        self.speed = speed
+        self.subscriptions = SubscriptionMux()
+        self.unsupported_methods = set()
+        self.protocol_version = protocol
+        self.capabilities = server_capabilities(software, protocol) - {Capability.BATCH}
+        self.misses = 0
+        self.requests = 0
+        self._closing = False
+        self._responses = defaultdict(deque)
+        self._latest = {}
+        for _, sent, received, _, method, params, result, error in calls:
+            response = (received - sent, result, error)
+            self._responses[(method, json.dumps(params))].append(response)
+            self._latest[method] = response
+
+    async def send_request(self, method, params=None, timeout=None):
+        self.requests += 1
+        responses = self._responses.get((method, json.dumps(list(params or []))))
+        if responses:
+            response = responses.popleft() if len(responses) > 1 else responses[0]
+        elif method in self._latest:
+            self.misses += 1
+            response = self._latest[method]
+        else:
+            self.misses += 1
+            raise aiorpcx.RPCError(aiorpcx.JSONRPC.METHOD_NOT_FOUND, f"{method} is not in the recording")
+
+        latency, result, error = response
+        if self.speed:
+            await asyncio.sleep(latency / self.speed)
+        if error == "timeout":
+            raise ConnectionError(f"request timed out: {method} (replayed)")
+        if error is not None:
+            raise aiorpcx.RPCError(*error)
+        return result
+
+    async def subscribe(self, method: str, params: List, queue: asyncio.Queue):
+        key = SubscriptionMux.key(method, params)
+        self.subscriptions.add(key, queue)
+        if key in self.subscriptions.cache:
+            result = self.subscriptions.cache[key]
+        else:
+            result = await self.send_request(method, params)
+            self.subscriptions.cache[key] = result
+        SubscriptionMux.put(queue, params + [result])
+
+    async def resubscribe(self, subscriptions: SubscriptionMux):
+        for key, queues in list(subscriptions.items()):
+            for queue in queues:
+                await self.subscribe(key[0], list(key[1:]), queue)
+
+    def unsubscribe(self, queue) -> List[tuple]:
+        return self.subscriptions.remove(queue)
+
+    def notify(self, method: str, args: list) -> bool:
+        """
+        Delivers a recorded notification, returns False if nothing was subscribed to it. The latest result is cached
+        either way, so later subscribers start from it as they would with a live server
+        """
+        key = (method, *args[:-1])
+        self.subscriptions.cache[key] = args[-1]
+        if key not in self.subscriptions:
+            return False
+        self.subscriptions.publish(key, args)
+        return True
+
+    def is_closing(self):
+        return self._closing
+
+    async def close(self):
+        self._closing = True
+
+    async def teardown(self) -> SubscriptionMux:
+        await self.close()
+        return self.subscriptions
+
+
+class TrafficReplay:
+    """
+    Feeds a recording into an `ElectrumX` client, at the recorded speed (scaled by `speed`) or, with `speed=None`,
+    as fast as possible
+    """
+
+    def __init__(self, path, speed: Optional[float] = 1.0):
+        self.header, entries = read_traffic(path)
+        self.speed = speed
+        self.notifications = [x for x in entries if x[0] == "notify"]
+        self.session = ReplaySession([x for x in entries if x[0] == "call"], speed=speed)
+
+    def attach(self, client: ElectrumX) -> ReplaySession:
+        """
+        Makes the replay session the only session of `client`
+        """
+        async def get_session(*args, **kwargs):
+            return self.session
+
+        async def penalize_server(*args, **kwargs):
+            # There is nothing to fail over to, retries are answered from the next recorded response
+            pass
+
+        client.session = self.session
+        client.servers = client.servers or {}
+        client.connection_lock = client.connection_lock or asyncio.Lock()
+        client.get_session = get_session
+        client.penalize_server = penalize_server
+        return self.session
+
+    async def run(self) -> dict:
+        """
+        Delivers the recorded notifications, returns replay statistics
+        """
+        started = time.monotonic()
+        delivered = 0
+        for _, received, _, method, args in self.notifications:
+            if self.speed:
+                await asyncio.sleep(max(0.0, received / self.speed - (time.monotonic() - started)))
+            delivered += self.session.notify(method, args)
+            # Let the consumers run, as a live session would between messages
+            await asyncio.sleep(0)
+
+        stats = {
+            "notifications": len(self.notifications),
+            "delivered": delivered,
+            "requests": self.session.requests,
+            "misses": self.session.misses,
+            "duration": round(time.monotonic() - started, 4),
+        }
+        logger.info(f"Replayed {self.header.get('symbol')} traffic - {stats}")
+        return stats
@@ -11,12 +11,17 @@ from modules.coins import ALL_COINS
 from modules.helpers import age_hours
 from modules.logging import logger
 
+KRAKEN_API_URL = "https://api.kraken.com"
+FIXER_API_URL = "http://data.fixer.io"
+
 
 class ExchangeRates:
     def __init__(self):
         exchange_path = Path('data/.cache')
         exchange_path.mkdir(parents=True, exist_ok=True)
         self.fixer_api_key = config.get("fixerio_api_key", namespace="CURRENCY")
+        self.kraken_url = config.get("kraken_api_url", namespace="CURRENCY", default=KRAKEN_API_URL).rstrip("/")
+        self.fixer_url = config.get("fixerio_api_url", namespace="CURRENCY", default=FIXER_API_URL).rstrip("/")
         self.fixer_rates = exchange_path / "currencies.json"
         self.coins_file = exchange_path / "coins.json"
 
@@ -37,7 +42,7 @@ class ExchangeRates:
         pairs = ",".join({x.kraken for x in ALL_COINS.values()})
 
         async with aiohttp.ClientSession() as session:
-            async with session.get('https://api.kraken.com/0/public/Ticker', params={"pair": pairs}) as response:
+            async with session.get(f'{self.kraken_url}/0/public/Ticker', params={"pair": pairs}) as response:
                 if response.status != 200:
                     logger.error(f"could not update coin values: {response.text} - returning cached prices")
                     return self._pairs
@@ -66,7 +71,7 @@ class ExchangeRates:
         symbols = "AUD,CAD,USD,GBP,JPY,EUR,RUB"
 
         async with aiohttp.ClientSession() as session:
-            async with session.get('http://data.fixer.io/api/latest',
+            async with session.get(f'{self.fixer_url}/api/latest',
                                    params={"access_key": self.fixer_api_key,
                                            "base": "EUR",
                                            "symbols": symbols}) as response:
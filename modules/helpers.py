@@ -93,6 +93,14 @@ def timestamp():
     return int(datetime.datetime.now().timestamp() * 1000)
 
 
+def unix_time(dt: datetime.datetime):
+    """
+    Unix timestamp of a naive UTC datetime, as stored in the database
+    :return: integer
+    """
+    return None if dt is None else int(dt.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+
 def to_json(obj, **kwargs) -> str:
     return json.dumps(obj, default=_json_encoder, **kwargs)
 
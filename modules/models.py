@@ -1,10 +1,12 @@
 import datetime
+import json
 
 import databases
 from sqlalchemy import MetaData, Column, Integer, DateTime, Unicode, UnicodeText, LargeBinary
-from sqlalchemy import create_engine, Index, Table
+from sqlalchemy import create_engine, inspect, select, text, Index, Table
 
 from modules import config
+from modules.logging import logger
 
 _db_uri = config.get("database_uri", default="sqlite:///default.db")
 metadata = MetaData()
@@ -48,10 +50,21 @@ Payment = Table(
     Column("payment_date", DateTime),
     Column("last_update", Integer),
     Column("status", Unicode(20)),
-    Column("transactions", UnicodeText),
     Index("IX_Invoice", "symbol", "derivation_path", unique=True)
 )
 
+PaymentTransaction = Table(
+    "payment_transactions", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("payment_id", Integer),
+    Column("txid", Unicode(64)),
+    Column("height", Integer),
+    Column("confirmations", Integer),
+    Column("amount_sats", Integer),
+    Column("time", DateTime),
+    Index("IX_PaymentTransaction", "payment_id", "txid", unique=True)
+)
+
 SeedPhrase = Table(
     "seeds", metadata,
     Column("id", Integer, primary_key=True),
@@ -78,6 +91,9 @@ ElectrumServer = Table(
     Column("connections", Integer),
     Column("failures", Integer),
     Column("latency", Integer),
+    Column("server_software", Unicode(100)),
+    Column("protocol_version", Unicode(20)),
+    Column("features", UnicodeText),
     Index('idx_hosts', 'symbol', 'host', unique=True)
 )
 
@@ -85,8 +101,59 @@ ElectrumServer = Table(
 def create_db():
     engine = synchronous_engine()
     metadata.create_all(bind=engine)
+    add_missing_columns(engine)
+    migrate_payment_transactions(engine)
     engine.dispose()
 
 
+def add_missing_columns(engine):
+    """
+    `create_all` only creates missing tables, columns added to existing tables are created here
+    """
+    inspector = inspect(engine)
+    for table in metadata.sorted_tables:
+        existing = {x['name'] for x in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                engine.execute(f"ALTER TABLE {table.name} ADD COLUMN {column.name} "
+                               f"{column.type.compile(dialect=engine.dialect)}")
+
+
+def migrate_payment_transactions(engine):
+    """
+    Payments used to keep their verbose transactions as json in a `transactions` column, which is no longer read.
+    Copies them into `payment_transactions` records, and clears the column of every migrated payment
+    """
+    if "transactions" not in {x['name'] for x in inspect(engine).get_columns(Payment.name)}:
+        return
+
+    from modules.coins import ALL_COINS
+    from modules.coins.network import CoinNetwork, compact_verbose_transaction
+
+    migrated = 0
+    with engine.begin() as connection:
+        payments = connection.execute(text(f"SELECT id, symbol, address, transactions FROM {Payment.name} "
+                                           f"WHERE transactions IS NOT NULL AND transactions != ''")).fetchall()
+        for payment_id, symbol, address, transactions in payments:
+            decimals = ALL_COINS[symbol].decimals if symbol in ALL_COINS else CoinNetwork.decimals
+            existing = {x for x, in connection.execute(select([PaymentTransaction.c.txid])
+                                                       .where(PaymentTransaction.c.payment_id == payment_id))}
+            try:
+                # Verbose transactions don't include a height, the watchers of open payments refetch the transactions
+                # whose recorded height doesn't match the scripthash history
+                records = [dict(compact_verbose_transaction(tx, address, tx.get('height') or 0, decimals),
+                                confirmations=tx.get('confirmations') or 0, payment_id=payment_id)
+                           for tx in json.loads(transactions) if tx['txid'] not in existing]
+            except (ValueError, TypeError, KeyError) as e:
+                logger.warning(f"Could not migrate the transactions of payment {payment_id} - {e}")
+                continue
+            if records:
+                connection.execute(PaymentTransaction.insert(), records)
+            connection.execute(text(f"UPDATE {Payment.name} SET transactions = NULL WHERE id = :id"), id=payment_id)
+            migrated += 1
+        if migrated:
+            logger.info(f"Migrated the stored transactions of {migrated} payments")
+
+
 def synchronous_engine():
     return create_engine(_db_uri)
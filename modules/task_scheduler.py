@@ -2,14 +2,15 @@ import asyncio
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 
 from modules.electrum_mods.tux_mods import sweep, BIP32Node, PartialTransaction, serialize_privkey, NetworkLock
 from modules import config
 from modules.coins import ALL_COINS
 from modules.credentials import CredentialManager
-from modules.electrumx import ElectrumX
 from modules.logging import logger
 from modules.models import database, Payment
+from modules.watchers import save_watcher_snapshot
 
 
 def _await(promise):
@@ -75,12 +76,17 @@ async def sweep_wallet(symbol, address, max_fee_rate, max_fee_prop, decryption_p
                     f"Inputs: {[(inp.address, inp.value_sats()) for inp in tx.inputs()]} - "
                     f"Outputs: {[(out.address, out.value) for out in tx.outputs()]}")
 
-    await network.electrum_call(ElectrumX.blockchain_transaction_broadcast, [raw_tx])
+    txid = await network.broadcast_transaction(raw_tx)
+    logger.info(f"{symbol} Sweep - broadcast {txid}")
 
 
 def instantiate_task_scheduler():
     scheduler = AsyncIOScheduler()
 
+    # Checkpoint the payment watcher state so that restarts don't need to refetch every payment's history
+    scheduler.add_job(save_watcher_snapshot,
+                      IntervalTrigger(seconds=int(config.get("watcher_snapshot_interval_sec", default=60))))
+
     # Add sweep jobs
     for symbol, coin in ALL_COINS.items():
         if (addr := config.get("sweep_address", coin=symbol)) and \
@@ -0,0 +1,113 @@
+import asyncio
+import functools
+import os
+import time
+
+from modules import config
+from modules.coins import ALL_COINS
+from modules.helpers import read_json, to_json, run_async
+from modules.logging import logger
+from modules.models import database, Payment
+
+SNAPSHOT_FILE = config.data_path / ".watcher-state.json"
+
+
+def rehydration_priority(payment):
+    # Payments that can still receive funds come first (soonest expiry first), followed by the ones that have
+    # already been paid and are only waiting on confirmations
+    return payment['status'] != 'pending', payment['expiry_date']
+
+
+def _log_watcher_exception(payment: dict, task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.exception(f"Exception in payment watcher {payment['uuid']}", exc_info=task.exception())
+
+
+async def _rehydrate_payment(payment: dict, semaphore: asyncio.Semaphore):
+    network = ALL_COINS.get(payment['symbol'])
+    if network is None:
+        logger.warning(f"Not watching payment {payment['uuid']} - {payment['symbol']} is not enabled")
+        return
+
+    async with semaphore:
+        ready = asyncio.Event()
+        watcher = asyncio.create_task(network.watch_payment(payment=payment, ready=ready))
+        watcher.add_done_callback(functools.partial(_log_watcher_exception, payment))
+        waiter = asyncio.create_task(ready.wait())
+        # The semaphore is only held until the watcher has finished its initial sync (or died trying)
+        await asyncio.wait({watcher, waiter}, return_when=asyncio.FIRST_COMPLETED)
+        waiter.cancel()
+
+
+async def rehydrate_watchers():
+    """
+    Restarts the watchers of every open payment after a restart, in priority order and with bounded concurrency so
+    that a large backlog doesn't flood the ElectrumX sessions with subscriptions all at once
+    """
+    payments = await database.fetch_all(Payment.select().where(Payment.c.status.in_(['pending', 'paid'])))
+    payments = sorted((dict(x) for x in payments), key=rehydration_priority)
+    if not payments:
+        _prune_watch_state()
+        return
+
+    # Every payment is registered up front, so that a customer websocket opened while a payment waits for its turn
+    # doesn't start a second watcher for it
+    for payment in payments:
+        if payment['symbol'] in ALL_COINS:
+            ALL_COINS[payment['symbol']].watched_payments.watch(payment)
+
+    concurrency = int(config.get("watcher_rehydration_concurrency", default=10))
+    semaphore = asyncio.Semaphore(concurrency)
+    report_every = max(1, len(payments) // 20)
+    started = time.monotonic()
+
+    logger.info(f"Rehydrating {len(payments)} payment watchers ({concurrency} at a time)")
+    tasks = [asyncio.create_task(_rehydrate_payment(payment, semaphore)) for payment in payments]
+    for i, task in enumerate(asyncio.as_completed(tasks), start=1):
+        try:
+            await task
+        except Exception as e:
+            logger.exception("Exception rehydrating payment watcher", exc_info=e)
+        if i % report_every == 0 or i == len(payments):
+            logger.info(f"Rehydrated {i}/{len(payments)} payment watchers ({time.monotonic() - started:.1f}s)")
+    _prune_watch_state()
+
+
+def _prune_watch_state():
+    # The restored state of payments that are no longer watched is only needed until rehydration is done
+    for symbol, network in ALL_COINS.items():
+        dropped = network.prune_watch_state()
+        if dropped:
+            logger.info(f"{symbol} - dropped the restored state of {dropped} scripthashes without a watcher")
+
+
+def _write_snapshot(data: str):
+    tmp_file = SNAPSHOT_FILE.with_suffix(".tmp")
+    tmp_file.write_text(data)
+    os.replace(tmp_file, SNAPSHOT_FILE)
+
+
+async def save_watcher_snapshot():
+    """
+    Checkpoints the warm state of the payment watchers (scripthash histories with their known transaction heights, from
+    which the status hashes are derived) to disk
+    """
+    snapshot = {
+        "timestamp": time.time(),
+        "coins": {symbol: network.watch_state() for symbol, network in ALL_COINS.items()}
+    }
+    await run_async(_write_snapshot, to_json(snapshot))
+    logger.debug(f"Saved watcher snapshot to {SNAPSHOT_FILE}")
+
+
+def load_watcher_snapshot():
+    snapshot = read_json(SNAPSHOT_FILE, {})
+    if not isinstance(snapshot, dict):
+        logger.warning(f"Ignoring malformed watcher snapshot {SNAPSHOT_FILE}")
+        return
+    for symbol, state in (snapshot.get("coins") or {}).items():
+        if symbol in ALL_COINS:
+            try:
+                ALL_COINS[symbol].restore_watch_state(state)
+            except (AttributeError, KeyError, TypeError):
+                logger.warning(f"{symbol} - ignoring malformed watcher snapshot state")
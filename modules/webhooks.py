@@ -6,9 +6,14 @@ from modules import config
 from modules.helpers import to_json
 from modules.logging import logger
 
+# Version of the callback body, see docs/integration.md. Version 1 (without a "version" field) sent the transactions
+# of the payment as a json string of verbose ElectrumX transactions
+WEBHOOK_VERSION = 2
+
 
 async def send_webhook(invoice, payment):
     json_body = to_json({
+        "version": WEBHOOK_VERSION,
         "invoice": dict(invoice),
         "payment": dict(payment)
     })
@@ -5,8 +5,9 @@ import uvicorn as uvicorn
 from modules import config
 from modules.application import make_application
 from modules.coins import ALL_COINS
-from modules.models import database, create_db, Payment
+from modules.models import database, create_db
 from modules.task_scheduler import instantiate_task_scheduler
+from modules.watchers import rehydrate_watchers, load_watcher_snapshot, save_watcher_snapshot
 
 app = make_application()
 task_scheduler = instantiate_task_scheduler()
@@ -21,12 +22,13 @@ async def startup():
         asyncio.create_task(network.electrumX.update_peers())
 
     task_scheduler.start()
-    for payment in await database.fetch_all(Payment.select().where(Payment.c.status.in_(['pending', 'paid']))):
-        asyncio.create_task(ALL_COINS[payment['symbol']].watch_payment(payment=dict(payment)))
+    load_watcher_snapshot()
+    asyncio.create_task(rehydrate_watchers())
 
 
 @app.on_event("shutdown")
 async def shutdown():
+    await save_watcher_snapshot()
     await task_scheduler.shutdown()
     await database.disconnect()
 
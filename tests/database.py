@@ -0,0 +1,44 @@
+"""
+Throwaway sqlite databases with the application's tables, for tests of the code that reads and writes
+`modules.models.database`
+
+    database = await temporary_database(self, "modules.coins.network.database")
+"""
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import databases
+from sqlalchemy import create_engine
+
+from modules.models import metadata
+
+
+def temporary_url(case: unittest.TestCase) -> str:
+    """
+    The url of an empty sqlite database, removed when `case` is cleaned up
+    """
+    directory = tempfile.TemporaryDirectory()
+    case.addCleanup(directory.cleanup)
+    return f"sqlite:///{Path(directory.name) / 'tuxpay.db'}"
+
+
+async def temporary_database(case: unittest.IsolatedAsyncioTestCase, *targets: str) -> databases.Database:
+    """
+    Connects to a new database with every table created, which replaces the `database` objects named by `targets` for
+    the duration of the test
+    """
+    url = temporary_url(case)
+    engine = create_engine(url)
+    metadata.create_all(engine)
+    engine.dispose()
+
+    database = databases.Database(url)
+    await database.connect()
+    case.addAsyncCleanup(database.disconnect)
+    for target in targets:
+        patch = mock.patch(target, database)
+        patch.start()
+        case.addCleanup(patch.stop)
+    return database
@@ -0,0 +1,333 @@
+"""
+Local stand-in for an ElectrumX server, so that `modules.electrumx` and the payment watchers can be exercised (and load
+tested) offline. The chain and mempool are scripted from the test, and latency, failures and notification storms can be
+injected per method.
+
+    server = await StandInServer().start()
+    client = offline_client(server)
+    txid = await server.pay(scripthash, 10000, address=address, script=script)
+    await server.mine()
+"""
+import asyncio
+import hashlib
+import itertools
+import struct
+import time
+from collections import defaultdict, deque
+from typing import Dict, List, Optional
+
+import aiorpcx
+
+from modules.electrumx import ElectrumX, scripthash_status
+
+BLOCK_INTERVAL = 600
+
+
+def sha256d(data: bytes) -> bytes:
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+
+def raw_transaction(outputs: List[tuple], nonce: int) -> bytes:
+    """
+    Serializes a (non segwit) transaction paying [(script bytes, sats)] from a dummy input, unique per nonce
+    """
+    prevout = hashlib.sha256(struct.pack('<Q', nonce)).digest()
+    raw = struct.pack('<i', 2) + b'\x01' + prevout + struct.pack('<I', 0) + b'\x00' + b'\xff' * 4
+    raw += bytes([len(outputs)])
+    for script, sats in outputs:
+        raw += struct.pack('<q', sats) + bytes([len(script)]) + script
+    return raw + struct.pack('<I', 0)
+
+
+class StandInChain:
+    """
+    Scriptable chain state: transactions paying scripthashes wait in the mempool until a block is mined
+    """
+
+    def __init__(self, height: int = 100, tip_time: Optional[int] = None):
+        self.height = height
+        # Block times are relative to the initial tip, which is mined now unless specified
+        self._base_time = (tip_time or int(time.time())) - height * BLOCK_INTERVAL
+        # txid -> {"raw", "height", "fee", "outputs": [(scripthash, address, script hex, sats)]}
+        self.transactions: Dict[str, dict] = {}
+        self.history: Dict[str, List[str]] = defaultdict(list)
+        self._nonce = itertools.count()
+
+    def header(self, height: int) -> str:
+        prev = sha256d(struct.pack('<I', height - 1)) if height > 0 else b'\x00' * 32
+        return (struct.pack('<i', 0x20000000) + prev + b'\x00' * 32 +
+                struct.pack('<III', self.block_time(height), 0x1d00ffff, height)).hex()
+
+    def block_time(self, height: int) -> int:
+        return self._base_time + height * BLOCK_INTERVAL
+
+    def add(self, outputs: List[tuple], fee: int = 1000) -> str:
+        """
+        Adds a mempool transaction with [(scripthash, address, script hex, sats)] outputs, returns its txid
+        """
+        raw = raw_transaction([(bytes.fromhex(script or ""), sats) for _, _, script, sats in outputs],
+                              next(self._nonce))
+        txid = sha256d(raw)[::-1].hex()
+        self.transactions[txid] = {"raw": raw.hex(), "height": 0, "fee": fee, "outputs": outputs}
+        for scripthash in {x[0] for x in outputs}:
+            self.history[scripthash].append(txid)
+        return txid
+
+    def touched(self, txids) -> set:
+        return {x[0] for txid in txids for x in self.transactions[txid]['outputs']}
+
+    def mempool(self) -> List[str]:
+        return [txid for txid, tx in self.transactions.items() if tx['height'] <= 0]
+
+    def mine(self, count: int = 1) -> List[str]:
+        """
+        Mines `count` blocks, the first of which confirms the whole mempool. Returns the confirmed txids
+        """
+        confirmed = self.mempool()
+        self.height += 1
+        for txid in confirmed:
+            self.transactions[txid]['height'] = self.height
+        self.height += count - 1
+        return confirmed
+
+    def reorg(self, depth: int = 1) -> List[str]:
+        """
+        Rolls back the last `depth` blocks, their transactions return to the mempool. Returns the affected txids
+        """
+        self.height -= depth
+        unconfirmed = [txid for txid, tx in self.transactions.items() if tx['height'] > self.height]
+        for txid in unconfirmed:
+            self.transactions[txid]['height'] = 0
+        return unconfirmed
+
+    def evict(self, txid: str) -> set:
+        """
+        Drops an unconfirmed transaction, as if it was double spent. Returns the scripthashes it paid
+        """
+        assert self.transactions[txid]['height'] <= 0
+        touched = self.touched([txid])
+        for scripthash in touched:
+            self.history[scripthash].remove(txid)
+        del self.transactions[txid]
+        return touched
+
+    def get_history(self, scripthash: str) -> List[dict]:
+        txids = self.history.get(scripthash, [])
+        confirmed = sorted((self.transactions[x]['height'], i, x) for i, x in enumerate(txids)
+                           if self.transactions[x]['height'] > 0)
+        history = [{"tx_hash": txid, "height": height} for height, _, txid in confirmed]
+        return history + [{"tx_hash": txid, "height": 0, "fee": self.transactions[txid]['fee']} for txid in txids
+                          if self.transactions[txid]['height'] <= 0]
+
+    def status(self, scripthash: str) -> Optional[str]:
+        return scripthash_status(self.get_history(scripthash))
+
+    def unspent(self, scripthash: str) -> List[dict]:
+        return [{"tx_hash": txid, "tx_pos": pos, "height": self.transactions[txid]['height'], "value": sats}
+                for txid in self.history.get(scripthash, [])
+                for pos, (sh, _, _, sats) in enumerate(self.transactions[txid]['outputs']) if sh == scripthash]
+
+    def verbose(self, txid: str) -> dict:
+        tx = self.transactions[txid]
+        verbose = {
+            "txid": txid,
+            "hash": txid,
+            "hex": tx['raw'],
+            "vout": [{"value": sats / 10 ** 8, "n": n, "scriptPubKey": {"hex": script or "", "address": address}}
+                     for n, (_, address, script, sats) in enumerate(tx['outputs'])]
+        }
+        if tx['height'] > 0:
+            verbose.update(confirmations=self.height - tx['height'] + 1,
+                           blockhash=sha256d(struct.pack('<I', tx['height']))[::-1].hex(),
+                           time=self.block_time(tx['height']), blocktime=self.block_time(tx['height']))
+        return verbose
+
+
+class StandInSession(aiorpcx.RPCSession):
+
+    def __init__(self, transport, server: 'StandInServer'):
+        super().__init__(transport)
+        self.server = server
+        self.headers_subscribed = False
+        self.scripthashes = set()
+
+    async def handle_request(self, request):
+        return await self.server.handle(self, request)
+
+    async def connection_lost(self):
+        await super().connection_lost()
+        self.server.sessions.discard(self)
+
+
+class StandInServer:
+    """
+    Serves a `StandInChain` over the ElectrumX protocol. Use `latency` ({method: seconds}, "*" for every method) and
+    `fail` to degrade the server
+    """
+
+    def __init__(self, chain: Optional[StandInChain] = None, software: str = "ElectrumX 1.16.0",
+                 protocol: str = "1.4.2", genesis_hash: Optional[str] = None, feerate: float = 0.0001,
+                 peers: Optional[list] = None):
+        self.chain = chain or StandInChain()
+        self.software = software
+        self.protocol = protocol
+        self.genesis_hash = genesis_hash
+        self.feerate = feerate
+        self.peers = peers or []
+        self.latency: Dict[str, float] = {}
+        self.failures: Dict[str, deque] = defaultdict(deque)
+        self.sessions = set()
+        self.requests: Dict[str, int] = defaultdict(int)
+        self._server = None
+        self.port = None
+        self.handlers = {
+            ElectrumX.server_version: self.server_version,
+            ElectrumX.server_features: self.server_features,
+            "server.ping": lambda session: None,
+            ElectrumX.server_peers_subscribe: lambda session: self.peers,
+            ElectrumX.blockchain_headers_subscribe: self.headers_subscribe,
+            ElectrumX.blockchain_scripthash_subscribe: self.scripthash_subscribe,
+            ElectrumX.blockchain_scripthash_unsubscribe: self.scripthash_unsubscribe,
+            ElectrumX.blockchain_scripthash_get_history: lambda session, sh: self.chain.get_history(sh),
+            ElectrumX.blockchain_scripthash_get_mempool: lambda session, sh: [
+                x for x in self.chain.get_history(sh) if x['height'] <= 0],
+            ElectrumX.blockchain_scripthash_get_balance: self.get_balance,
+            ElectrumX.blockchain_scripthash_listunspent: lambda session, sh: self.chain.unspent(sh),
+            ElectrumX.blockchain_transaction_get: self.transaction_get,
+            ElectrumX.blockchain_transaction_broadcast: self.broadcast,
+            ElectrumX.blockchain_estimatefee: lambda session, blocks: self.feerate,
+            ElectrumX.blockchain_relayfee: lambda session: 0.00001,
+        }
+
+    @property
+    def host_string(self):
+        return f"127.0.0.1|{self.port}|"
+
+    async def start(self, port: int = 0) -> 'StandInServer':
+        self._server = await aiorpcx.serve_rs(lambda transport: self._track(StandInSession(transport, self)),
+                                              '127.0.0.1', port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    def _track(self, session):
+        self.sessions.add(session)
+        return session
+
+    async def stop(self):
+        await self.disconnect_all()
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def disconnect_all(self):
+        for session in list(self.sessions):
+            await session.close()
+
+    def fail(self, method: str, times: int = 1, error: Optional[Exception] = None):
+        """
+        Fails the next `times` calls of `method` with `error`, or drops the connection if no error is given
+        """
+        self.failures[method].extend([error] * times)
+
+    async def handle(self, session: StandInSession, request):
+        method = request.method
+        self.requests[method] += 1
+        delay = self.latency.get(method, self.latency.get("*"))
+        if delay:
+            await asyncio.sleep(delay)
+        if self.failures[method]:
+            error = self.failures[method].popleft()
+            if error is None:
+                await session.abort()
+                raise aiorpcx.RPCError(aiorpcx.JSONRPC.INTERNAL_ERROR, "connection dropped")
+            raise error
+        handler = self.handlers.get(method)
+        if handler is None:
+            raise aiorpcx.RPCError(aiorpcx.JSONRPC.METHOD_NOT_FOUND, f"unknown method {method}")
+        result = handler(session, *request.args)
+        return await result if asyncio.iscoroutine(result) else result
+
+    def server_version(self, session, client_name=None, protocol_version=None):
+        return [self.software, self.protocol]
+
+    def server_features(self, session):
+        return {"server_version": self.software, "protocol_min": "1.4", "protocol_max": self.protocol,
+                "genesis_hash": self.genesis_hash, "hash_function": "sha256", "hosts": {}, "pruning": None}
+
+    def headers_subscribe(self, session):
+        session.headers_subscribed = True
+        return {"height": self.chain.height, "hex": self.chain.header(self.chain.height)}
+
+    def scripthash_subscribe(self, session, scripthash):
+        session.scripthashes.add(scripthash)
+        return self.chain.status(scripthash)
+
+    def scripthash_unsubscribe(self, session, scripthash):
+        if scripthash not in session.scripthashes:
+            return False
+        session.scripthashes.discard(scripthash)
+        return True
+
+    def get_balance(self, session, scripthash):
+        unspent = self.chain.unspent(scripthash)
+        return {"confirmed": sum(x['value'] for x in unspent if x['height'] > 0),
+                "unconfirmed": sum(x['value'] for x in unspent if x['height'] <= 0)}
+
+    def transaction_get(self, session, txid, verbose=False):
+        if txid not in self.chain.transactions:
+            raise aiorpcx.RPCError(2, f"daemon error: No such mempool or blockchain transaction {txid}")
+        return self.chain.verbose(txid) if verbose else self.chain.transactions[txid]['raw']
+
+    def broadcast(self, session, raw_tx):
+        txid = sha256d(bytes.fromhex(raw_tx))[::-1].hex()
+        self.chain.transactions.setdefault(txid, {"raw": raw_tx, "height": 0, "fee": 0, "outputs": []})
+        return txid
+
+    async def notify(self, scripthashes=(), headers=False):
+        for session in list(self.sessions):
+            if session.is_closing():
+                continue
+            if headers and session.headers_subscribed:
+                await session.send_notification(ElectrumX.blockchain_headers_subscribe, [
+                    {"height": self.chain.height, "hex": self.chain.header(self.chain.height)}])
+            for scripthash in session.scripthashes.intersection(scripthashes):
+                await session.send_notification(ElectrumX.blockchain_scripthash_subscribe,
+                                                [scripthash, self.chain.status(scripthash)])
+
+    async def pay(self, scripthash: str, sats: int, address: Optional[str] = None, script: Optional[str] = None,
+                  fee: int = 1000) -> str:
+        """
+        Adds a mempool transaction paying `sats` to a scripthash and notifies its subscribers, returns the txid
+        """
+        txid = self.chain.add([(scripthash, address, script, sats)], fee=fee)
+        await self.notify({scripthash})
+        return txid
+
+    async def mine(self, count: int = 1) -> List[str]:
+        confirmed = self.chain.mine(count)
+        await self.notify(self.chain.touched(confirmed), headers=True)
+        return confirmed
+
+    async def reorg(self, depth: int = 1) -> List[str]:
+        unconfirmed = self.chain.reorg(depth)
+        await self.notify(self.chain.touched(unconfirmed), headers=True)
+        return unconfirmed
+
+    async def storm(self, count: int, interval: float = 0):
+        """
+        Sends `count` (redundant) notifications of every subscribed scripthash and of the tip
+        """
+        for _ in range(count):
+            await self.notify({sh for x in self.sessions for sh in x.scripthashes}, headers=True)
+            await asyncio.sleep(interval)
+
+
+def offline_client(*servers: StandInServer, symbol: str = "BTC", **kwargs) -> ElectrumX:
+    """
+    An `ElectrumX` client that only knows about the given stand-in servers, and doesn't touch the database
+    """
+    client = ElectrumX(symbol, **kwargs)
+    client.default_servers = {x.host_string: {} for x in servers}
+    client.user_servers = [x.host_string for x in servers]
+    client.servers = {x.host_string: {} for x in servers}
+    client.connection_lock = asyncio.Lock()
+    return client
@@ -0,0 +1,129 @@
+import asyncio
+import hashlib
+import unittest
+from unittest import mock
+
+from modules.electrumx import scripthash_status, project_history, SubscriptionMux, ElectrumX, CircuitBreaker, \
+    RetryBudget
+
+
+class TestScripthashStatus(unittest.TestCase):
+
+    def test_empty_history(self):
+        self.assertIsNone(scripthash_status([]))
+
+    def test_status_hash(self):
+        history = [
+            {"tx_hash": "a" * 64, "height": 200004},
+            {"tx_hash": "b" * 64, "height": 0, "fee": 250},
+        ]
+        expected = hashlib.sha256(f"{'a' * 64}:200004:{'b' * 64}:0:".encode()).hexdigest()
+        self.assertEqual(scripthash_status(history), expected)
+
+    def test_status_changes_with_height(self):
+        mempool = [{"tx_hash": "a" * 64, "height": 0}]
+        confirmed = [{"tx_hash": "a" * 64, "height": 200004}]
+        self.assertNotEqual(scripthash_status(mempool), scripthash_status(confirmed))
+
+
+class TestProjectHistory(unittest.TestCase):
+
+    def test_new_mempool_transaction(self):
+        history = [{"tx_hash": "a" * 64, "height": 200004}]
+        mempool = [{"tx_hash": "b" * 64, "height": 0, "fee": 250}]
+        self.assertEqual(project_history(history, mempool, 200005), history + mempool)
+
+    def test_mined_transaction(self):
+        history = [{"tx_hash": "a" * 64, "height": 200004}, {"tx_hash": "b" * 64, "height": 0, "fee": 250}]
+        expected = [{"tx_hash": "a" * 64, "height": 200004}, {"tx_hash": "b" * 64, "height": 200005}]
+        self.assertEqual(scripthash_status(project_history(history, [], 200005)), scripthash_status(expected))
+
+
+class TestSubscriptionMux(unittest.TestCase):
+
+    def test_refcounted_unsubscribe(self):
+        mux = SubscriptionMux()
+        key = SubscriptionMux.key(ElectrumX.blockchain_scripthash_subscribe, ["ab"])
+        a, b = asyncio.Queue(), asyncio.Queue()
+        self.assertTrue(mux.add(key, a))
+        self.assertFalse(mux.add(key, b))
+        self.assertEqual(mux.remove(a), [])
+        self.assertIn(key, mux)
+        self.assertEqual(mux.remove(b), [key])
+        self.assertNotIn(key, mux)
+
+    def test_discard(self):
+        mux = SubscriptionMux()
+        headers = SubscriptionMux.key(ElectrumX.blockchain_headers_subscribe, [])
+        scripthash = SubscriptionMux.key(ElectrumX.blockchain_scripthash_subscribe, ["ab"])
+        a, b = asyncio.Queue(), asyncio.Queue()
+        mux.add(headers, a)
+        mux.add(scripthash, a)
+        mux.add(scripthash, b)
+        mux.discard(scripthash, [a, b])
+        self.assertNotIn(scripthash, mux)
+        self.assertEqual(mux.remove(a), [headers])
+
+    def test_publish_drops_oldest(self):
+        mux = SubscriptionMux()
+        key = SubscriptionMux.key(ElectrumX.blockchain_scripthash_subscribe, ["ab"])
+        slow, fast = asyncio.Queue(maxsize=2), asyncio.Queue()
+        mux.add(key, slow)
+        mux.add(key, fast)
+        for status in ("s1", "s2", "s3"):
+            mux.publish(key, ["ab", status])
+        self.assertEqual([slow.get_nowait(), slow.get_nowait()], [["ab", "s2"], ["ab", "s3"]])
+        self.assertEqual(fast.qsize(), 3)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_opens_after_threshold(self):
+        breaker = CircuitBreaker(threshold=2, reset_timeout=60)
+        breaker.record_failure()
+        self.assertTrue(breaker.available)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.available)
+
+    def test_half_open(self):
+        breaker = CircuitBreaker(threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_reopen_backs_off(self):
+        breaker = CircuitBreaker(threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        breaker.reset_timeout = 10
+        breaker.record_failure()
+        self.assertEqual(breaker.opened, 2)
+        self.assertFalse(breaker.available)
+
+
+class TestRetryBudget(unittest.TestCase):
+
+    def test_budget(self):
+        budget = RetryBudget(capacity=2, refill_rate=0.5)
+        self.assertEqual(budget.acquire(), 0)
+        self.assertEqual(budget.acquire(), 0)
+        self.assertAlmostEqual(budget.acquire(), 2, places=1)
+
+
+class TestUserServers(unittest.TestCase):
+
+    def client(self, electrumx_servers) -> ElectrumX:
+        with mock.patch("modules.config.get", lambda key, default=None, **kwargs: {
+                "electrumx_servers": electrumx_servers}.get(key, default)):
+            return ElectrumX("BTC")
+
+    def test_comma_separated(self):
+        client = self.client("electrum1.example.org s50002, electrum2.example.org t,10.0.0.1 t50001 s50002, ,invalid")
+        self.assertEqual(client.user_servers, ["electrum1.example.org||50002", "electrum2.example.org|50001|",
+                                               "10.0.0.1|50001|50002"])
+        self.assertTrue(set(client.user_servers) <= set(client.default_servers))
+
+    def test_no_servers(self):
+        self.assertIsNone(self.client("").user_servers)
+        self.assertIsNone(self.client(None).user_servers)
@@ -0,0 +1,287 @@
+import asyncio
+import datetime
+import unittest
+from unittest import mock
+
+import aiorpcx
+
+from modules.electrumx import Capability, DeadlineExceeded, ElectrumX, SubscriptionMux, project_history, \
+    scripthash_status
+from tests.database import temporary_database
+from tests.electrumx_server import StandInServer, offline_client
+
+SCRIPTHASH = "ab" * 32
+GENESIS = "11" * 32
+
+
+class TestElectrumXClient(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.servers = [await StandInServer().start() for _ in range(2)]
+        for server in self.servers[1:]:
+            server.chain = self.servers[0].chain
+        self.client = offline_client(*self.servers)
+
+    async def asyncTearDown(self):
+        for session in (self.client.session, self.client.standby):
+            if session is not None:
+                await session.close()
+        for server in self.servers:
+            await server.stop()
+
+    async def test_scripthash_notifications(self):
+        queue = asyncio.Queue()
+        _, status = await self.client.call(ElectrumX.blockchain_scripthash_subscribe, [SCRIPTHASH], queue)
+        self.assertIsNone(status)
+
+        server = next(x for x in self.servers if x.host_string == self.client.session.host_string)
+        await server.pay(SCRIPTHASH, 10000)
+        _, status = await asyncio.wait_for(queue.get(), 5)
+        self.assertEqual(status, server.chain.status(SCRIPTHASH))
+
+        await server.mine()
+        _, status = await asyncio.wait_for(queue.get(), 5)
+        history = await self.client.call(ElectrumX.blockchain_scripthash_get_history, [SCRIPTHASH])
+        self.assertEqual(history[0]['height'], server.chain.height)
+        self.assertEqual(status, scripthash_status(history))
+
+    async def test_history_projection(self):
+        server = self.servers[0]
+        await server.pay(SCRIPTHASH, 10000)
+        history = await self.client.call(ElectrumX.blockchain_scripthash_get_history, [SCRIPTHASH])
+        # One transaction mined, another one arriving in the mempool
+        await server.mine()
+        await server.pay(SCRIPTHASH, 20000)
+        mempool = await self.client.call(ElectrumX.blockchain_scripthash_get_mempool, [SCRIPTHASH])
+        self.assertEqual(scripthash_status(project_history(history, mempool, server.chain.height)),
+                         server.chain.status(SCRIPTHASH))
+
+    async def test_failover(self):
+        await self.client.get_session()
+        first = self.client.session.host_string
+        server = next(x for x in self.servers if x.host_string == first)
+        server.fail(ElectrumX.blockchain_relayfee)
+        self.assertEqual(await self.client.call(ElectrumX.blockchain_relayfee, []), 0.00001)
+        self.assertNotEqual(self.client.session.host_string, first)
+
+    async def test_concurrent_penalties(self):
+        await self.client.get_session()
+        await self.client._standby_task
+        session, standby = self.client.session, self.client.standby
+        self.assertIsNotNone(standby)
+
+        with mock.patch.object(session, "teardown", wraps=session.teardown) as teardown, \
+                mock.patch.object(self.client, "promote_standby", wraps=self.client.promote_standby) as promote:
+            await asyncio.gather(self.client.penalize_server(session), self.client.penalize_server(session))
+        self.assertEqual(teardown.await_count, 1)
+        self.assertEqual(promote.await_count, 1)
+        self.assertIs(self.client.session, standby)
+        self.assertFalse(standby.is_closing())
+
+    async def start_servers(self, count: int):
+        servers = [await StandInServer(chain=self.servers[0].chain).start() for _ in range(count)]
+        for server in servers:
+            self.addAsyncCleanup(server.stop)
+            self.client.servers[server.host_string] = {}
+        return servers
+
+    async def race(self, servers: list) -> tuple:
+        """
+        Races the servers in order, returns the winning session, the (host, start time) of every dial and the tasks
+        settling the rest of the race
+        """
+        dials = []
+        settling = []
+        make_session, settle_race = self.client.make_session, self.client._settle_race
+
+        async def dial(host, subscriptions):
+            dials.append((host, asyncio.get_running_loop().time()))
+            session = await make_session(host, subscriptions)
+            if session is not None:
+                self.addAsyncCleanup(session.close)
+            return session
+
+        async def settle(*args):
+            settling.append(asyncio.current_task())
+            await settle_race(*args)
+
+        with mock.patch.object(self.client, "make_session", dial), \
+                mock.patch.object(self.client, "_settle_race", settle), \
+                mock.patch("modules.electrumx.CONNECT_STAGGER", 0.1):
+            winner = await self.client.race_sessions([x.host_string for x in servers])
+        # Lets the settling task start
+        await asyncio.sleep(0)
+        self.addAsyncCleanup(winner.close)
+        return winner, dials, settling
+
+    async def test_race_sessions(self):
+        slow, fast, unused = await self.start_servers(3)
+        slow.latency[ElectrumX.server_version] = 0.4
+        winner, dials, settling = await self.race([slow, fast, unused])
+        # The slow server gets a head start, the next attempt is only started once it has taken too long
+        self.assertEqual(winner.host_string, fast.host_string)
+        self.assertEqual([x for x, _ in dials], [slow.host_string, fast.host_string])
+        self.assertGreaterEqual(dials[1][1] - dials[0][1], 0.1)
+        self.assertEqual(unused.requests, {})
+
+        # The slow attempt completes in the background, and is kept as the standby session
+        await asyncio.wait_for(asyncio.gather(*settling), 5)
+        self.assertEqual(self.client.standby.host_string, slow.host_string)
+        self.assertFalse(self.client.standby.is_closing())
+
+    async def test_race_losers_closed(self):
+        slow, fast, standby = await self.start_servers(3)
+        self.client.standby = await self.client.make_session(standby.host_string, None)
+        self.addAsyncCleanup(self.client.standby.close)
+        slow.latency[ElectrumX.server_version] = 0.4
+        failed = self.servers[0]
+        failed.fail(ElectrumX.server_version)
+
+        winner, dials, settling = await self.race([failed, slow, fast])
+        self.assertEqual(winner.host_string, fast.host_string)
+        # A failed attempt starts the next one straight away
+        self.assertLess(dials[1][1] - dials[0][1], 0.1)
+        await asyncio.wait_for(asyncio.gather(*settling), 5)
+        # There already is a standby session, the slow one is closed once it connects
+        self.assertEqual(self.client.standby.host_string, standby.host_string)
+        self.assertEqual(slow.requests[ElectrumX.server_version], 1)
+        self.assertEqual(slow.sessions, set())
+
+    async def test_deadline(self):
+        await self.client.get_session()
+        host = self.client.session.host_string
+        server = next(x for x in self.servers if x.host_string == host)
+        server.latency[ElectrumX.blockchain_relayfee] = 0.3
+        with self.assertRaises(DeadlineExceeded):
+            await self.client.call(ElectrumX.blockchain_relayfee, [], deadline=0.1)
+        # The caller's deadline running out isn't held against the server
+        self.assertEqual(self.client.session.host_string, host)
+        self.assertEqual(self.client.breakers[host].failures, 0)
+
+        self.assertEqual(await self.client.call(ElectrumX.blockchain_relayfee, [], deadline=1), 0.00001)
+
+    async def test_deadline_failover(self):
+        await self.client.get_session()
+        first = self.client.session.host_string
+        server = next(x for x in self.servers if x.host_string == first)
+        server.fail(ElectrumX.blockchain_relayfee)
+        self.assertEqual(await self.client.call(ElectrumX.blockchain_relayfee, [], deadline=5), 0.00001)
+        self.assertNotEqual(self.client.session.host_string, first)
+
+    async def test_notification_during_resubscribe(self):
+        server = self.servers[0]
+        session = await self.client.make_session(server.host_string, None)
+        self.addAsyncCleanup(session.close)
+        headers, scripthash = asyncio.Queue(), asyncio.Queue()
+        subscriptions = SubscriptionMux()
+        subscriptions.add(SubscriptionMux.key(ElectrumX.blockchain_headers_subscribe, []), headers)
+        subscriptions.add(SubscriptionMux.key(ElectrumX.blockchain_scripthash_subscribe, [SCRIPTHASH]), scripthash)
+
+        # A block is found once the tip is subscribed, while the scripthash subscription is still in flight
+        server.latency[ElectrumX.blockchain_scripthash_subscribe] = 0.3
+        resubscribing = asyncio.create_task(session.resubscribe(subscriptions))
+        while not any(x.headers_subscribed for x in server.sessions):
+            await asyncio.sleep(0.01)
+        await server.mine()
+        await asyncio.wait_for(resubscribing, 5)
+
+        self.assertFalse(session.is_closing())
+        self.assertEqual(len(session.subscriptions), 2)
+        # The (batched) response to the tip subscription is older than the notification, and isn't delivered after it
+        self.assertEqual([headers.get_nowait()[0]['height'] for _ in range(headers.qsize())], [server.chain.height])
+        self.assertEqual(scripthash.get_nowait(), [SCRIPTHASH, None])
+
+    async def test_broadcast(self):
+        for server in self.servers:
+            server.latency[ElectrumX.blockchain_transaction_broadcast] = 0.05
+        self.servers[0].fail(ElectrumX.blockchain_transaction_broadcast, error=aiorpcx.RPCError(1, "rejected"))
+        txid = await self.client.broadcast("00" * 64, fanout=2)
+        self.assertIn(txid, self.servers[0].chain.transactions)
+
+
+class TestNegotiation(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.good = await StandInServer(genesis_hash=GENESIS).start()
+        self.wrong_network = await StandInServer(genesis_hash="00" * 32).start()
+        self.old_protocol = await StandInServer(genesis_hash=GENESIS, protocol="1.4").start()
+        self.electrs = await StandInServer(genesis_hash=GENESIS, software="electrs/0.9.0").start()
+        self.servers = [self.good, self.wrong_network, self.old_protocol, self.electrs]
+        self.client = offline_client(*self.servers, genesis_hash=GENESIS, required_capabilities=(
+            Capability.VERBOSE_TX, Capability.SCRIPTHASH_UNSUBSCRIBE))
+
+    async def asyncTearDown(self):
+        for server in self.servers:
+            await server.stop()
+
+    async def test_exclusions(self):
+        reasons = {self.wrong_network: "wrong network",
+                   self.old_protocol: f"missing {Capability.SCRIPTHASH_UNSUBSCRIBE}",
+                   self.electrs: f"missing {Capability.VERBOSE_TX}"}
+        for server, reason in reasons.items():
+            self.assertIsNone(await self.client.make_session(server.host_string, None))
+            self.assertIn(reason, self.client.unusable_reason(server.host_string))
+            # Excluded, not failed
+            self.assertFalse(self.client.servers[server.host_string].get("failures"))
+
+        session = await self.client.make_session(self.good.host_string, None)
+        self.addAsyncCleanup(session.close)
+        self.assertIsNone(self.client.unusable_reason(self.good.host_string))
+        self.assertIn(Capability.SCRIPTHASH_UNSUBSCRIBE, session.capabilities)
+        self.assertEqual(self.client.servers[self.good.host_string]["protocol_version"], "1.4.2")
+        self.assertEqual(await self.client.ranked_servers(), [self.good.host_string])
+
+    async def test_cached_features(self):
+        for _ in range(2):
+            session = await self.client.make_session(self.good.host_string, None)
+            await session.close()
+        self.assertEqual(self.good.requests[ElectrumX.server_features], 1)
+
+        # Excluded from the cached features alone, once the server has moved networks
+        self.good.software, self.good.genesis_hash = "ElectrumX 1.16.1", "00" * 32
+        self.assertIsNone(await self.client.make_session(self.good.host_string, None))
+        self.assertEqual(self.good.requests[ElectrumX.server_features], 2)
+        self.assertIn("wrong network", self.client.unusable_reason(self.good.host_string))
+        self.assertNotIn(self.good.host_string, await self.client.ranked_servers())
+
+
+class TestServerList(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        await temporary_database(self, "modules.electrumx.database")
+
+    async def test_save_server_list(self):
+        client = offline_client()
+        seen = datetime.datetime(2021, 6, 1, 12, 30)
+        client.server_set("a.example|50002|s", last_seen=seen, connections=1, server_software="ElectrumX 1.16")
+        client.server_set("b.example|50002|s", last_seen=None, connections=6)
+        client.server_set("c.example|50001|t", last_seen=seen, connections=2, latency=250)
+        await client.save_server_list()
+        self.assertTrue(client.servers["a.example|50002|s"]["id"])
+        self.assertTrue(client.servers["c.example|50001|t"]["id"])
+        # Never reachable, and past its connection attempts
+        self.assertNotIn("id", client.servers["b.example|50002|s"])
+
+        ids = {host: x["id"] for host, x in client.servers.items() if "id" in x}
+        client.server_increment("a.example|50002|s", "failures")
+        client.server_set("c.example|50001|t", last_seen=seen + datetime.timedelta(hours=1), latency=500)
+        client.server_set("d.example|50002|s", last_seen=seen, connections=1)
+        await client.save_server_list()
+        self.assertFalse(client._dirty_servers)
+        self.assertEqual({host: client.servers[host]["id"] for host in ids}, ids)
+        self.assertNotIn(client.servers["d.example|50002|s"]["id"], ids.values())
+
+        reloaded = offline_client()
+        await reloaded.initialize()
+        self.assertEqual(set(reloaded.servers), {"a.example|50002|s", "c.example|50001|t", "d.example|50002|s"})
+        self.assertEqual(reloaded.servers["a.example|50002|s"]["failures"], 1)
+        self.assertEqual(reloaded.servers["a.example|50002|s"]["last_seen"], seen)
+        self.assertEqual(reloaded.servers["a.example|50002|s"]["server_software"], "ElectrumX 1.16")
+        self.assertEqual(reloaded.servers["c.example|50001|t"]["last_seen"], seen + datetime.timedelta(hours=1))
+        self.assertEqual(reloaded.servers["c.example|50001|t"]["latency"], 500)
+        for host, x in reloaded.servers.items():
+            self.assertEqual(x["id"], client.servers[host]["id"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from modules.electrumx import ElectrumX, TrafficRecorder
+from modules.electrumx_replay import TrafficReplay, read_traffic
+from tests.electrumx_server import StandInServer, offline_client
+
+SCRIPTHASH = "ab" * 32
+
+
+class TestTrafficReplay(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "traffic.jsonl.gz")
+
+    async def record(self):
+        server = await StandInServer().start()
+        client = offline_client(server)
+        client.recorder = TrafficRecorder(self.path, "BTC")
+        queue = asyncio.Queue()
+        try:
+            await client.call(ElectrumX.blockchain_scripthash_subscribe, [SCRIPTHASH], queue)
+            await server.pay(SCRIPTHASH, 10000)
+            await asyncio.wait_for(queue.get(), 5)
+            return await client.call(ElectrumX.blockchain_scripthash_get_history, [SCRIPTHASH])
+        finally:
+            client.recorder.close()
+            for session in (client.session, client.standby):
+                if session is not None:
+                    await session.close()
+            await server.stop()
+
+    async def test_record_and_replay(self):
+        history = await self.record()
+        header, entries = read_traffic(self.path)
+        self.assertEqual(header['symbol'], "BTC")
+        self.assertEqual(sum(1 for x in entries if x[0] == "notify"), 1)
+
+        client = offline_client()
+        replay = TrafficReplay(self.path, speed=None)
+        replay.attach(client)
+        queue = asyncio.Queue()
+        _, status = await client.call(ElectrumX.blockchain_scripthash_subscribe, [SCRIPTHASH], queue)
+        self.assertIsNone(status)
+
+        stats = await replay.run()
+        self.assertEqual(stats['delivered'], 1)
+        _, status = queue.get_nowait()
+        self.assertIsNotNone(status)
+        self.assertEqual(await client.call(ElectrumX.blockchain_scripthash_get_history, [SCRIPTHASH]), history)
+        self.assertEqual(replay.session.misses, 0)
+
+    async def test_recordings_kept(self):
+        await self.record()
+        first = read_traffic(self.path)
+        recorder = TrafficRecorder(self.path, "BTC")
+        recorder.close()
+        self.assertEqual(recorder.path, Path(self.path).with_name("traffic-1.jsonl.gz"))
+        self.assertEqual(read_traffic(self.path), first)
+        self.assertEqual(read_traffic(recorder.path)[1], [])
+
+    def test_recording_per_coin(self):
+        with mock.patch("modules.config.get", lambda key, default=None, **kwargs: {
+                "electrumx_record_traffic": self.path}.get(key, default)):
+            clients = [ElectrumX(symbol) for symbol in ("BTC", "LTC")]
+        for client in clients:
+            client.recorder.close()
+        self.assertEqual([x.recorder.path.name for x in clients], ["traffic-BTC.jsonl.gz", "traffic-LTC.jsonl.gz"])
+        self.assertEqual([read_traffic(x.recorder.path)[0]['symbol'] for x in clients], ["BTC", "LTC"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import datetime
+import json
+import unittest
+
+from sqlalchemy import create_engine, inspect
+
+from modules.models import metadata, add_missing_columns, migrate_payment_transactions, PaymentTransaction, Payment, \
+    ElectrumServer
+from tests.database import temporary_url
+
+ADDRESS = "bc1qfxn2yv9834367vesdc7ah9prj9nrf67g806jup"
+
+
+def _verbose(txid, outputs, confirmations=0, time=None):
+    tx = {"txid": txid, "confirmations": confirmations,
+          "vout": [{"value": value, "n": n, "scriptPubKey": {"address": address} if address else {"type": "nulldata"}}
+                   for n, (address, value) in enumerate(outputs)]}
+    if time is not None:
+        tx.update(time=time, blocktime=time)
+    return tx
+
+
+class TestPaymentTransactionsMigration(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine(temporary_url(self))
+        self.addCleanup(self.engine.dispose)
+        metadata.create_all(self.engine)
+        # The column the transactions used to be stored in
+        self.engine.execute(f"ALTER TABLE {Payment.name} ADD COLUMN transactions TEXT")
+
+    def add_payment(self, payment_id, transactions):
+        self.engine.execute(Payment.insert().values(id=payment_id, symbol="BTC", uuid=f"payment-{payment_id}",
+                                                    address=ADDRESS, derivation_path=f"0/{payment_id}"))
+        self.engine.execute(f"UPDATE {Payment.name} SET transactions = ? WHERE id = ?", transactions, payment_id)
+
+    def stored_json(self, payment_id):
+        return self.engine.execute(f"SELECT transactions FROM {Payment.name} WHERE id = ?", payment_id).scalar()
+
+    def records(self, payment_id):
+        return {x['txid']: dict(x) for x in self.engine.execute(
+            PaymentTransaction.select().where(PaymentTransaction.c.payment_id == payment_id))}
+
+    def test_migration(self):
+        self.add_payment(1, json.dumps([
+            _verbose("aa" * 32, [(ADDRESS, 0.0001), (None, 0)], confirmations=3, time=1609459200),
+            _verbose("bb" * 32, [("1BoatSLRHtKNngkdXEeobR76b53LETtpyT", 0.5), (ADDRESS, 0.00002)])]))
+        self.add_payment(2, None)
+        self.add_payment(3, '[{"txid": ')
+
+        migrate_payment_transactions(self.engine)
+        records = self.records(1)
+        self.assertEqual({k: (v['amount_sats'], v['confirmations'], v['time']) for k, v in records.items()}, {
+            "aa" * 32: (10000, 3, datetime.datetime(2021, 1, 1)),
+            "bb" * 32: (2000, 0, None)})
+        self.assertIsNone(self.stored_json(1))
+        # Unreadable json is left in place
+        self.assertEqual(self.records(3), {})
+        self.assertEqual(self.stored_json(3), '[{"txid": ')
+
+        migrate_payment_transactions(self.engine)
+        self.assertEqual(self.records(1), records)
+
+    def test_new_database(self):
+        engine = create_engine(temporary_url(self))
+        self.addCleanup(engine.dispose)
+        metadata.create_all(engine)
+        migrate_payment_transactions(engine)
+
+
+class TestAddMissingColumns(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine(temporary_url(self))
+        self.addCleanup(self.engine.dispose)
+
+    def columns(self, table):
+        return [x['name'] for x in inspect(self.engine).get_columns(table.name)]
+
+    def test_existing_database(self):
+        # The server table as created before the negotiation columns were added
+        self.engine.execute(f"CREATE TABLE {ElectrumServer.name} (id INTEGER PRIMARY KEY, symbol VARCHAR(20), "
+                            f"host VARCHAR(150), first_seen DATETIME, last_check DATETIME, last_seen DATETIME, "
+                            f"connections INTEGER, failures INTEGER)")
+        self.engine.execute(f"INSERT INTO {ElectrumServer.name} (symbol, host, connections) "
+                            f"VALUES ('BTC', 'a.example|50002|s', 3)")
+        metadata.create_all(self.engine)
+
+        add_missing_columns(self.engine)
+        expected = {table.name: [x.name for x in table.columns] for table in metadata.sorted_tables}
+        self.assertEqual(sorted(self.columns(ElectrumServer)), sorted(expected[ElectrumServer.name]))
+
+        add_missing_columns(self.engine)
+        for table in metadata.sorted_tables:
+            self.assertEqual(sorted(self.columns(table)), sorted(expected[table.name]))
+        row = self.engine.execute(ElectrumServer.select()).fetchone()
+        self.assertEqual((row['host'], row['connections'], row['features']), ('a.example|50002|s', 3, None))
+
+    def test_new_database(self):
+        metadata.create_all(self.engine)
+        add_missing_columns(self.engine)
+        for table in metadata.sorted_tables:
+            self.assertEqual(self.columns(table), [x.name for x in table.columns])
+
+
+if __name__ == '__main__':
+    unittest.main()
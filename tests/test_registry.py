@@ -0,0 +1,59 @@
+import datetime
+import unittest
+
+from modules.coins.registry import WatchRegistry, WatchedPayment
+
+
+def _payment(uuid, status="pending"):
+    return {"id": 1, "invoice_id": 1, "uuid": uuid, "scripthash": uuid * 2, "address": uuid, "amount_sats": 1000,
+            "creation_height": 100, "creation_date": datetime.datetime(2021, 1, 1),
+            "expiry_date": datetime.datetime(2021, 1, 1, 0, 15),
+            "paid_amount_sats": None, "payment_date": None, "last_update": 0, "status": status}
+
+
+class TestWatchedPayment(unittest.TestCase):
+
+    def test_from_row(self):
+        payment = WatchedPayment.from_row(_payment("a"))
+        self.assertEqual(payment.creation_time, 1609459200)
+        self.assertEqual(payment.expiry_time, 1609459200 + 900)
+        self.assertEqual(payment.creation_height, 100)
+        self.assertIsNone(payment.payment_date)
+        self.assertEqual(payment.pop_changes(), {})
+
+    def test_changes(self):
+        payment = WatchedPayment.from_row(_payment("a"))
+        payment.status = "pending"
+        self.assertEqual(payment.pop_changes(), {})
+
+        payment.status = "paid"
+        payment.payment_time = 1609459260
+        payment.last_update = 5
+        self.assertEqual(payment.pop_changes(), {"status": "paid", "last_update": 5,
+                                                 "payment_date": datetime.datetime(2021, 1, 1, 0, 1)})
+        self.assertEqual(payment.pop_changes(), {})
+
+
+class TestWatchRegistry(unittest.TestCase):
+
+    def test_finished_payments_are_dropped(self):
+        registry = WatchRegistry(grace_period=0)
+        for uuid in ("a", "b"):
+            registry.watch(_payment(uuid))
+        registry["b"].status = "confirmed"
+        registry.updated(registry["b"])
+        self.assertIn("a", registry)
+        self.assertNotIn("b", registry)
+        self.assertEqual(registry.metrics(), {"watched": 1, "finished": 0})
+
+    def test_grace_period(self):
+        registry = WatchRegistry(grace_period=60)
+        entry = registry.watch(_payment("a", status="expired"))
+        registry.updated(entry)
+        self.assertEqual(registry.prune(), 0)
+        self.assertEqual(registry.metrics(), {"watched": 0, "finished": 1})
+        self.assertFalse(registry["a"].is_open)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,12 +3,13 @@ from typing import NamedTuple, Union
 
 from electrum.util import bh2u
 
-from modules.coins import ALL_COINS
+from modules.coins import ALL_COINS, BitcoinCashMainnet
 from modules.electrum_mods.functions import construct_script, opcodes, script_to_p2wsh, \
-    construct_witness, ecc
+    construct_witness, ecc, sha256d
 from modules.electrum_mods.tux_mods import network_context, deserialize_privkey
 from modules.electrum_mods.tux_tx import PartialTransaction, Transaction, BCDataStream, SerializationError, \
-    tx_from_any, convert_raw_tx_to_hex, get_address_from_output_script, TxOutpoint, PartialTxInput, PartialTxOutput
+    tx_from_any, convert_raw_tx_to_hex, get_address_from_output_script, TxOutpoint, PartialTxInput, PartialTxOutput, \
+    LegacyPreimageParts
 from tests import TestCaseForTestnet
 
 BITCOIN = ALL_COINS['BTC']
@@ -79,6 +80,19 @@ class TestBCDataStream(unittest.TestCase):
         self.assertEqual(b'\x01\x00', s.read_bytes(2))
         self.assertFalse(s.can_read_more())
 
+    def test_buffer(self):
+        raw = b'\x05Hello\x01\x00\x00\x00'
+        s = BCDataStream(memoryview(raw))
+        self.assertEqual(s.read_string(), 'Hello')
+        self.assertEqual(s.read_uint32(), 1)
+        self.assertEqual(s.read(1), b'')
+        with self.assertRaises(SerializationError):
+            s.read_bytes(1)
+        # writes go to a copy of the buffer
+        s.write(b'!')
+        self.assertEqual(s.read(), b'!')
+        self.assertEqual(raw, b'\x05Hello\x01\x00\x00\x00')
+
 
 class TestTransaction(unittest.TestCase):
 
@@ -91,6 +105,39 @@ class TestTransaction(unittest.TestCase):
         tx.update_signatures(signed_blob_signatures, BITCOIN)
         self.assertEqual(tx.serialize(), signed_blob)
 
+    def test_legacy_signature_hash(self):
+        inputs = []
+        for i in range(3):
+            txin = PartialTxInput(prevout=TxOutpoint(txid=bytes([i]) * 32, out_idx=i))
+            txin.script_type = 'p2pkh'
+            txin.pubkeys = [bytes.fromhex('02e61d176da16edd1d258a200ad9759ef63adf8e14cd97f53227bae35cdb84d2f6')]
+            txin.num_sig = 1
+            inputs.append(txin)
+        outputs = [PartialTxOutput(scriptpubkey=bytes.fromhex('76a914230ac37834073a42146f11ef8414ae929feaafc388ac'),
+                                   value=1000000)]
+        tx = PartialTransaction.from_io(inputs, outputs, locktime=0, version=1)
+        parts = LegacyPreimageParts(tx)
+        # out of order, which restarts the running hash of the preceding inputs
+        for i in (0, 2, 1, 2):
+            self.assertEqual(sha256d(tx.serialize_preimage_bytes(i, BITCOIN)),
+                             tx.signature_hash(i, BITCOIN, legacy_preimage_parts=parts))
+
+    def test_estimated_legacy_size(self):
+        pubkey = bytes.fromhex('02e61d176da16edd1d258a200ad9759ef63adf8e14cd97f53227bae35cdb84d2f6')
+        inputs = []
+        for i, (script_type, pubkeys, num_sig) in enumerate([('p2pkh', [pubkey], 1), ('p2pk', [pubkey], 1),
+                                                              ('p2sh', [pubkey] * 3, 2), ('p2sh', [pubkey] * 15, 15)]):
+            txin = PartialTxInput(prevout=TxOutpoint(txid=bytes([i]) * 32, out_idx=i))
+            txin.script_type = script_type
+            txin.pubkeys = pubkeys
+            txin.num_sig = num_sig
+            inputs.append(txin)
+        outputs = [PartialTxOutput(scriptpubkey=bytes.fromhex('76a914230ac37834073a42146f11ef8414ae929feaafc388ac'),
+                                   value=1000000)]
+        tx = PartialTransaction.from_io(inputs * 70, outputs, locktime=0, version=1)
+        self.assertEqual(len(tx.serialize_to_network_bytes(estimate_size=True)), tx.estimated_legacy_size())
+        self.assertEqual(tx.estimated_legacy_size(), BitcoinCashMainnet.estimate_tx_size(tx))
+
     @network_context(BITCOIN)
     def test_tx_setting_locktime_invalidates_ser_cache(self):
         tx = tx_from_any(
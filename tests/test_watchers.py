@@ -0,0 +1,317 @@
+import asyncio
+import datetime
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from modules.coins import ALL_COINS, BitcoinMainnet
+from modules.coins.registry import WatchedPayment
+from modules.electrumx import ElectrumX
+from modules.coins.network import CoinNetwork
+from modules.models import Invoice, Payment, PaymentTransaction
+from modules.watchers import rehydrate_watchers, rehydration_priority, save_watcher_snapshot, load_watcher_snapshot
+from tests.database import temporary_database
+from tests.electrumx_server import StandInServer, offline_client
+
+ADDRESS = "bc1qfxn2yv9834367vesdc7ah9prj9nrf67g806jup"
+REQUIRED_CONFIRMATIONS = 2
+
+
+def _payment(scripthash, amount_sats=10000, status="pending", **columns):
+    now = datetime.datetime.utcnow()
+    return dict({"id": 1, "invoice_id": 1, "uuid": "payment-1", "symbol": "BTC", "scripthash": scripthash,
+                 "address": ADDRESS, "amount_sats": amount_sats, "creation_height": 100,
+                 "creation_date": now - datetime.timedelta(minutes=1),
+                 "expiry_date": now + datetime.timedelta(minutes=15),
+                 "paid_amount_sats": None, "payment_date": None, "last_update": 0, "status": status}, **columns)
+
+
+class TestPaymentWatcher(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server = await StandInServer(genesis_hash=BitcoinMainnet.GENESIS).start()
+        self.network = type(BitcoinMainnet)()
+        self.network.electrumX = offline_client(self.server, genesis_hash=self.network.GENESIS,
+                                                required_capabilities=self.network.electrumX.required_capabilities)
+        config = mock.patch.object(self.network, "config", lambda key, default=None: {
+            "required_confirmations": REQUIRED_CONFIRMATIONS}.get(key, default))
+        config.start()
+        self.addCleanup(config.stop)
+        self.scripthash = self.network.address_to_scripthash(ADDRESS)
+
+    async def asyncTearDown(self):
+        for session in (self.network.electrumX.session, self.network.electrumX.standby):
+            if session is not None:
+                await session.close()
+        await self.server.stop()
+
+    def record(self, txid: str, amount_sats: int) -> dict:
+        height = self.server.chain.transactions[txid]['height']
+        return {"txid": txid, "height": height, "confirmations": self.server.chain.height - height + 1,
+                "amount_sats": amount_sats, "time": None}
+
+    async def test_precheck_confirmed_payment(self):
+        txid = await self.server.pay(self.scripthash, 10000, address=ADDRESS)
+        await self.server.mine(REQUIRED_CONFIRMATIONS)
+        payment = WatchedPayment.from_row(_payment(self.scripthash, status="paid"))
+        transactions = await self.network.precheck_payment(payment, self.server.chain.status(self.scripthash),
+                                                           [self.record(txid, 10000)])
+        self.assertEqual([x['confirmations'] for x in transactions], [REQUIRED_CONFIRMATIONS])
+
+    async def test_precheck_top_up_while_offline(self):
+        # A partial payment was recorded, and the rest of it was paid and confirmed while the watcher was down
+        partial = await self.server.pay(self.scripthash, 6000, address=ADDRESS)
+        await self.server.mine()
+        recorded = [self.record(partial, 6000)]
+        await self.server.pay(self.scripthash, 4000, address=ADDRESS)
+        await self.server.mine(REQUIRED_CONFIRMATIONS)
+
+        payment = WatchedPayment.from_row(_payment(self.scripthash))
+        self.assertIsNone(await self.network.precheck_payment(payment, self.server.chain.status(self.scripthash),
+                                                              recorded))
+
+    async def test_precheck_without_balance(self):
+        del self.server.handlers[ElectrumX.blockchain_scripthash_get_balance]
+        txid = await self.server.pay(self.scripthash, 10000, address=ADDRESS)
+        await self.server.mine(REQUIRED_CONFIRMATIONS)
+        payment = WatchedPayment.from_row(_payment(self.scripthash, status="paid"))
+        # Falls through to the transaction detail
+        self.assertIsNone(await self.network.precheck_payment(payment, self.server.chain.status(self.scripthash),
+                                                              [self.record(txid, 10000)]))
+
+    async def test_reorged_out_payment(self):
+        database = await temporary_database(self, "modules.coins.network.database")
+
+        payment = _payment(self.scripthash)
+        await database.execute(Invoice.insert().values(id=1, uuid="invoice-1", status="pending"))
+        await database.execute(Payment.insert().values(**payment))
+        ready = asyncio.Event()
+        watcher = asyncio.create_task(self.network.watch_payment(payment, ready))
+        self.addCleanup(watcher.cancel)
+
+        async def update():
+            ready.clear()
+            await asyncio.wait_for(ready.wait(), 5)
+            return self.network.watched_payments[payment['uuid']]
+
+        await asyncio.wait_for(ready.wait(), 5)
+        txid = await self.server.pay(self.scripthash, 10000, address=ADDRESS)
+        self.assertEqual((await update()).status, "paid")
+        await self.server.mine()
+        self.assertEqual([x['confirmations'] for x in (await update()).transactions], [1])
+
+        # The block is reorged out, and the transaction double spent, before the chain grows past the confirmations
+        # it would have had
+        self.server.chain.reorg()
+        self.server.chain.evict(txid)
+        self.server.chain.mine(REQUIRED_CONFIRMATIONS)
+        await self.server.notify({self.scripthash}, headers=True)
+        watched = await update()
+        self.assertEqual(watched.transactions, [])
+        self.assertNotEqual(watched.status, "confirmed")
+        self.assertNotEqual((await database.fetch_one(Payment.select()))['status'], "confirmed")
+
+    async def test_exact_payment(self):
+        database = await temporary_database(self, "modules.coins.network.database")
+
+        payment = _payment(self.scripthash)
+        await database.execute(Invoice.insert().values(id=1, uuid="invoice-1", status="pending"))
+        await database.execute(Payment.insert().values(**payment))
+        ready = asyncio.Event()
+        watcher = asyncio.create_task(self.network.watch_payment(payment, ready))
+        self.addCleanup(watcher.cancel)
+        await asyncio.wait_for(ready.wait(), 5)
+
+        async def update():
+            ready.clear()
+            await asyncio.wait_for(ready.wait(), 5)
+            return self.network.watched_payments[payment['uuid']]
+
+        await self.server.pay(self.scripthash, payment['amount_sats'], address=ADDRESS)
+        self.assertEqual((await update()).status, "paid")
+        await self.server.mine()
+        self.assertEqual([x['confirmations'] for x in (await update()).transactions], [1])
+        # The scripthash isn't notified again, the watcher has to follow the blocks once the whole amount is mined
+        await self.server.mine()
+        self.assertEqual((await update()).status, "confirmed")
+        self.assertEqual((await database.fetch_one(Payment.select()))['status'], "confirmed")
+
+    async def test_raw_transactions(self):
+        database = await temporary_database(self, "modules.coins.network.database")
+        script = self.network.address_to_script(ADDRESS)
+        other = "1BoatSLRHtKNngkdXEeobR76b53LETtpyT"
+        chain = self.server.chain
+        # Paid to the address before the payment was created
+        before = chain.add([(self.scripthash, ADDRESS, script, 3000)])
+        chain.mine()
+        creation_height = chain.height
+        mined = chain.add([(self.network.address_to_scripthash(other), other, self.network.address_to_script(other),
+                            50000), (self.scripthash, ADDRESS, script, 6000), (self.scripthash, ADDRESS, script, 1000)])
+        chain.mine()
+        pending = chain.add([(self.scripthash, ADDRESS, script, 4000)])
+
+        fields = ('txid', 'height', 'confirmations', 'amount_sats', 'mempool_fee')
+        verbose = await self.network.get_transactions(self.scripthash, ADDRESS)
+        self.network.raw_transactions = True
+        self.network.tx_cache.clear()
+        raw = await self.network.get_transactions(self.scripthash, ADDRESS)
+        self.assertEqual({k: {f: x.get(f) for f in fields} for k, x in raw.items()},
+                         {k: {f: x.get(f) for f in fields} for k, x in verbose.items()})
+        self.assertEqual({k: x['amount_sats'] for k, x in raw.items()}, {before: 3000, mined: 7000, pending: 4000})
+        self.assertIsNone(raw[mined]['time'])
+
+        payment = _payment(self.scripthash, creation_height=creation_height)
+        await database.execute(Invoice.insert().values(id=1, uuid="invoice-1", status="pending"))
+        await database.execute(Payment.insert().values(**payment))
+        ready = asyncio.Event()
+        watcher = asyncio.create_task(self.network.watch_payment(payment, ready))
+        self.addCleanup(watcher.cancel)
+        await asyncio.wait_for(ready.wait(), 5)
+        watched = self.network.watched_payments[payment['uuid']]
+        # Without block times, the transaction mined at the creation height predates the payment
+        self.assertEqual({x['txid']: x['amount_sats'] for x in watched.transactions}, {mined: 7000, pending: 4000})
+        self.assertEqual(watched.status, "paid")
+        stored = await database.fetch_all(PaymentTransaction.select())
+        self.assertEqual({x['txid'] for x in stored}, {mined, pending})
+
+
+class TestPaymentTransactions(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.database = await temporary_database(self, "modules.coins.network.database")
+
+    async def stored(self, payment_id: int = 1) -> dict:
+        return {x['txid']: {k: x[k] for k in ('txid', 'height', 'confirmations', 'amount_sats', 'time')}
+                for x in await self.database.fetch_all(
+                    PaymentTransaction.select().where(PaymentTransaction.c.payment_id == payment_id))}
+
+    async def save(self, transactions: list, recorded_tx: dict) -> bool:
+        return await CoinNetwork.save_payment_transactions(1, transactions, recorded_tx)
+
+    async def test_save_payment_transactions(self):
+        mined = datetime.datetime(2021, 1, 1)
+        first = {"txid": "aa" * 32, "height": 0, "confirmations": 0, "amount_sats": 6000, "time": None,
+                 "mempool_fee": 1000}
+        second = {"txid": "bb" * 32, "height": 0, "confirmations": 0, "amount_sats": 4000, "time": None}
+        # Another payment's records are left alone
+        await CoinNetwork.save_payment_transactions(2, [first], {})
+
+        self.assertTrue(await self.save([first, second], {}))
+        recorded = await self.stored()
+        self.assertEqual(recorded, {x['txid']: {k: v for k, v in x.items() if k != 'mempool_fee'}
+                                    for x in (first, second)})
+        self.assertFalse(await self.save([first, second], recorded))
+
+        # The first transaction is mined, the second one double spent
+        first = dict(first, height=101, confirmations=1, time=mined)
+        self.assertTrue(await self.save([first], recorded))
+        self.assertEqual(await self.stored(), {first['txid']: {k: v for k, v in first.items() if k != 'mempool_fee'}})
+        self.assertEqual(list(await self.stored(2)), [first['txid']])
+
+        self.assertTrue(await self.save([], await self.stored()))
+        self.assertEqual(await self.stored(), {})
+
+
+class TestRehydration(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.database = await temporary_database(self, "modules.watchers.database")
+        self.network = type(BitcoinMainnet)()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.snapshot_file = Path(directory.name) / ".watcher-state.json"
+        for patch in (mock.patch.dict("modules.watchers.ALL_COINS", {"BTC": self.network}, clear=True),
+                      mock.patch("modules.watchers.SNAPSHOT_FILE", self.snapshot_file),
+                      mock.patch("modules.config.get", lambda key, default=None, **kwargs: {
+                          "watcher_rehydration_concurrency": "2"}.get(key, default))):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.started = []
+
+    async def add_payments(self, *payments: dict):
+        for i, payment in enumerate(payments, start=1):
+            await self.database.execute(Payment.insert().values(**dict(payment, id=i)))
+
+    async def watch_payment(self, payment: dict, ready: asyncio.Event):
+        self.started.append(payment['uuid'])
+        await asyncio.sleep(0.01)
+        ready.set()
+
+    async def test_rehydration_order(self):
+        now = datetime.datetime.utcnow()
+        payments = [_payment(str(i) * 64, uuid=f"payment-{i}", status=status,
+                             expiry_date=now + datetime.timedelta(minutes=minutes))
+                    for i, (status, minutes) in enumerate([("paid", 5), ("pending", 15), ("pending", 10),
+                                                           ("confirmed", 5), ("paid", -5), ("pending", 20)])]
+        await self.add_payments(*payments, _payment("ff" * 32, uuid="disabled-coin", symbol="XYZ"))
+        expected = [x['uuid'] for x in sorted((x for x in payments if x['status'] != 'confirmed'),
+                                               key=rehydration_priority)]
+        syncing = set()
+        peak = 0
+        registered = []
+
+        async def watch_payment(payment: dict, ready: asyncio.Event):
+            nonlocal peak
+            registered.append(all(x in self.network.watched_payments for x in expected))
+            syncing.add(payment['uuid'])
+            peak = max(peak, len(syncing))
+            try:
+                if payment['uuid'] == expected[1]:
+                    raise ValueError("watcher failed")
+                await self.watch_payment(payment, ready)
+            finally:
+                syncing.discard(payment['uuid'])
+
+        with mock.patch.object(self.network, "watch_payment", watch_payment):
+            await rehydrate_watchers()
+        self.assertEqual(self.started, [x for x in expected if x != expected[1]])
+        self.assertEqual(expected[:2], ["payment-2", "payment-1"])
+        # Every open payment is registered before the first watcher starts
+        self.assertEqual(registered, [True] * len(expected))
+        # Watchers that died don't hold on to their slot
+        self.assertEqual(peak, 2)
+        self.assertNotIn("disabled-coin", self.network.watched_payments)
+
+    def restart(self):
+        self.network = type(BitcoinMainnet)()
+        ALL_COINS["BTC"] = self.network
+
+    async def test_snapshot_round_trip(self):
+        payments = [_payment(x * 32, uuid=f"payment-{x}") for x in ("aa", "bb")]
+        for payment in payments:
+            self.network.watched_payments.watch(payment)
+        history = {sh: [{"tx_hash": sh[::-1], "height": 101}] for sh in ("aa" * 32, "bb" * 32, "cc" * 32)}
+        self.network.known_history = dict(history)
+        await save_watcher_snapshot()
+        # Only the scripthashes of the watched payments are saved
+        self.assertEqual(set(json.loads(self.snapshot_file.read_text())['coins']['BTC']['scripthashes']),
+                         {"aa" * 32, "bb" * 32})
+
+        self.restart()
+        load_watcher_snapshot()
+        self.assertEqual(self.network.known_history, {sh: history[sh] for sh in ("aa" * 32, "bb" * 32)})
+        self.network.tx_cache = {x[0]['tx_hash']: (101, {}) for x in self.network.known_history.values()}
+
+        # The second payment has been confirmed since the snapshot was taken, its restored state is stale
+        await self.add_payments(payments[0], dict(payments[1], status="confirmed"))
+        with mock.patch.object(self.network, "watch_payment", self.watch_payment):
+            await rehydrate_watchers()
+        self.assertEqual(self.started, ["payment-aa"])
+        self.assertEqual(self.network.known_history, {"aa" * 32: history["aa" * 32]})
+        self.assertEqual(set(self.network.tx_cache), {history["aa" * 32][0]['tx_hash']})
+
+    def test_corrupt_snapshot(self):
+        snapshot = json.dumps({"timestamp": 0, "coins": {"BTC": {"scripthashes": {
+            "aa" * 32: {"history": [{"tx_hash": "dd" * 32, "height": 101}]}, "bb" * 32: {"height": 101}}}}})
+        # Cut short, or well formed json of the wrong shape
+        for contents in (snapshot[:len(snapshot) // 2], snapshot, "[]", '{"coins": []}'):
+            self.restart()
+            self.snapshot_file.write_text(contents)
+            load_watcher_snapshot()
+            self.assertEqual(self.network.known_history, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
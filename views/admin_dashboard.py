@@ -1,5 +1,5 @@
 import datetime
-from typing import List
+from typing import List, Dict
 
 from fastapi import APIRouter
 from fastapi.requests import Request
@@ -7,6 +7,7 @@ from pydantic import BaseModel
 from sqlalchemy import select, or_
 
 from modules.authentication import requires_auth
+from modules.coins import ALL_COINS
 from modules.helpers import JSONResponse
 from modules.models import database, Invoice
 
@@ -34,11 +35,17 @@ class SummaryResponseWithInvoices(BaseModel):
     invoices: List[DashboardInvoice]
 
 
+class WatcherMetrics(BaseModel):
+    watched: int
+    finished: int
+
+
 class DashboardResponse(BaseModel):
     created: SummaryResponse
     paid: SummaryResponse
     expired: SummaryResponseWithInvoices
     open: List[DashboardInvoice]
+    watchers: Dict[str, WatcherMetrics]
 
 
 
@@ -85,5 +92,6 @@ async def admin_dashboard(_: Request):
         "created": {"count": created_n, "dollars": round(created_cents / 100, 2)},
         "paid": {"count": paid_n, "dollars": round(paid_cents / 100, 2)},
         "expired": {"count": expired_n, "dollars": round(expired_cents / 100, 2), "invoices": expired},
-        "open": open_inv
+        "open": open_inv,
+        "watchers": {symbol: network.watched_payments.metrics() for symbol, network in ALL_COINS.items()}
     })
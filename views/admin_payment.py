@@ -8,7 +8,7 @@ from modules.authentication import requires_auth
 from modules.coins import ALL_COINS
 from modules.exchanges import exchangeRates
 from modules.helpers import JSONResponse, NOT_FOUND
-from modules.models import database, Payment
+from modules.models import database, Payment, PaymentTransaction
 from modules.payments import TuxPayment
 from views.admin_invoice import create_invoice_from_payload
 from views.api_models import PaymentCreationModel, PaymentAdminReadModel
@@ -20,7 +20,11 @@ router = APIRouter(prefix='/api')
 @requires_auth
 async def admin_payment_get(payment_id: int, _: Request):
     ret = await database.fetch_one(Payment.select().where(Payment.c.id == payment_id))
-    return JSONResponse({"payment": ret}) if ret else NOT_FOUND
+    if not ret:
+        return NOT_FOUND
+    transactions = await database.fetch_all(
+        PaymentTransaction.select().where(PaymentTransaction.c.payment_id == payment_id))
+    return JSONResponse({"payment": ret, "transactions": transactions})
 
 
 @router.get('/admin/payments', response_model=List[PaymentAdminReadModel], tags=['admin', 'payment'])
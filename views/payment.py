@@ -55,23 +55,23 @@ async def watch_payment(websocket):
         network = ALL_COINS[payment['symbol']]
 
         if payment['uuid'] not in network.watched_payments:
+            # Registered before the watcher starts, so that other websockets of the payment don't start their own
+            network.watched_payments.watch(payment)
             asyncio.create_task(network.watch_payment(payment))
-            await asyncio.sleep(0.01)
-            while payment['uuid'] not in network.watched_payments:
-                logger.info("waiting for watcher to instantiate")
-                await asyncio.sleep(0.1)
 
         last_update = 0
         while True:
-            ret = network.watched_payments[payment['uuid']]
-            if ret['last_update'] > last_update:
-                last_update = int(ret['last_update'])
+            ret = network.watched_payments.get(payment['uuid'])
+            if ret is None:
+                break
+            if ret.last_update > last_update:
+                last_update = int(ret.last_update)
                 await websocket.send_text(to_json({
-                    "status": ret["status"],
-                    "transactions": ret.get('transactions', [])
+                    "status": ret.status,
+                    "transactions": ret.transactions
                 }))
 
-            if ret['status'] == 'expired' or ret['status'] == 'confirmed':
+            if not ret.is_open:
                 break
 
             await asyncio.sleep(0.01)